@@ -17,7 +17,7 @@ if __name__ == "__main__":
     parser.add_argument("dirSource", type=str, help="directory to copy")
     parser.add_argument("dirDest", type=str, help="destination to copy to")
     parser.add_argument("--noNpz", dest='noNpz', default=False, action='store_true',
-                        help="skip the .npz files")
+                        help="skip the metric data (.npz and .npy) files")
     parser.add_argument("--noPdf", dest='noPdf', default=False, action='store_true',
                         help="skip the .pdf files")
     args = parser.parse_args()
@@ -30,7 +30,7 @@ if __name__ == "__main__":
 
     callList = ['rsync', '-rav']
     if args.noNpz:
-        callList.append("--exclude '*.npz'")
+        callList.append("--exclude '*.npz' --exclude '*.npy'")
     if args.noPdf:
         callList.append("--exclude '*.pdf'")
     callList = callList + [source, dest]
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import lsst.sims.maf.db as db
+import lsst.sims.maf.metricBundles as metricBundles
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run the metric calculation tasks in a MAF work queue "
+                                                 "(put there by a MetricBundleGroup with a workQueue).")
+    parser.add_argument("queueDir", type=str, help="Work queue directory.")
+    parser.add_argument("dbFile", type=str, help="Opsim sqlite filename (the same as the coordinator's).")
+    parser.add_argument("--leaseTime", type=float, default=600.,
+                        help="Time (s) after which the tasks of a worker which stopped are run again.")
+    parser.add_argument("--wait", dest='wait', action='store_true', default=False,
+                        help="Wait for new tasks, instead of stopping when there are none left.")
+    parser.add_argument("-v", "--verbose", dest='verbose', action='store_true', default=False,
+                        help="Print the tasks run.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.queueDir):
+        print 'There is no work queue at %s.' % (args.queueDir)
+        print 'Exiting.'
+        exit(-1)
+
+    opsdb = db.OpsimDatabase(args.dbFile)
+    workQueue = metricBundles.WorkQueue(args.queueDir, leaseTime=args.leaseTime)
+    worker = metricBundles.WorkQueueWorker(workQueue, opsdb, verbose=args.verbose)
+    worker.run(wait=args.wait)
+    print 'Ran %d tasks.' % (worker.nRun)
@@ -57,7 +57,10 @@ class DataHandler(web.RequestHandler):
             if npz is None:
                 self.write('No npz file available.')
             else:
-                self.redirect(npz)
+                npzName, contents = npz
+                self.set_header('Content-Type', 'application/octet-stream')
+                self.set_header('Content-Disposition', 'attachment; filename=%s' % npzName)
+                self.write(contents)
         elif datatype == 'json':
             jsn = run.getJson(metric)
             if jsn is None:
@@ -0,0 +1,29 @@
+#! /usr/bin/env python
+# A little script to time the light curve metrics on synthetic data slices of different sizes.
+
+import timeit
+
+setup = """
+import numpy as np
+import lsst.sims.maf.metrics as metrics
+
+np.random.seed(42)
+names = ['expMJD', 'fiveSigmaDepth', 'filter']
+types = [float, float, '|S1']
+dataSlice = np.zeros(%d, dtype=zip(names, types))
+dataSlice['expMJD'] = np.sort(np.random.rand(dataSlice.size) * 3652.5) + 59580.
+dataSlice['fiveSigmaDepth'] = np.random.rand(dataSlice.size) * 2. + 23.
+dataSlice['filter'] = np.random.choice(['u', 'g', 'r', 'i', 'z', 'y'], dataSlice.size)
+transient = metrics.TransientMetric(riseSlope=-2. / 5., declineSlope=1.4 / 30.0, transDuration=60.,
+                                    peakTime=5., nPrePeak=1, nPerLC=2, nFilters=2, nPhaseCheck=5)
+supernova = metrics.SupernovaMetric()
+"""
+
+if __name__ == "__main__":
+
+    number = 20
+    print 'nVisits  TransientMetric (ms)  SupernovaMetric (ms)'
+    for nVisits in [100, 500, 1000, 2000, 5000]:
+        tTransient = timeit.timeit('transient.run(dataSlice)', setup=setup % nVisits, number=number)
+        tSupernova = timeit.timeit('supernova.run(dataSlice)', setup=setup % nVisits, number=number)
+        print '%7d  %20.2f  %20.2f' % (nVisits, tTransient / number * 1000., tSupernova / number * 1000.)
@@ -15,7 +15,7 @@ import numpy as np
 
 Base = declarative_base()
 
-__all__ = ['MetricRow', 'DisplayRow', 'PlotRow', 'SummaryStatRow', 'ResultsDb']
+__all__ = ['MetricRow', 'DisplayRow', 'PlotRow', 'SummaryStatRow', 'ProfileRow', 'ResultsDb']
 
 class MetricRow(Base):
     """
@@ -96,6 +96,30 @@ class SummaryStatRow(Base):
         return "<SummaryStat(metricId='%d', summaryName='%s', summaryValue='%f')>" \
           %(self.metricId, self.summaryName, self.summaryValue)
 
+class ProfileRow(Base):
+    """
+    Define contents and format of the profile table.
+
+    (Table to list the time and memory used by each stage of running the metrics, see Profiler).
+    """
+    __tablename__ = "profile"
+    # Define columns in profile table.
+    profileId = Column(Integer, primary_key=True)
+    stage = Column(String)
+    name = Column(String)
+    sqlConstraint = Column(String)
+    wallTime = Column(Float)
+    cpuTime = Column(Float)
+    peakMemory = Column(Float)
+    memoryGrowth = Column(Float)
+    nCalls = Column(Integer)
+    medianTime = Column(Float)
+    maxTime = Column(Float)
+    cacheHitRate = Column(Float)
+    def __repr__(self):
+        return "<Profile(stage='%s', name='%s', sqlConstraint='%s', wallTime='%s')>" \
+          %(self.stage, self.name, self.sqlConstraint, self.wallTime)
+
 class ResultsDb(object):
     def __init__(self, outDir= None, database=None, driver='sqlite',
                  host=None, port=None, verbose=False):
@@ -170,7 +194,7 @@ class ResultsDb(object):
         - metricDatafile: the data file the metric data is stored in
 
         If same metric (same metricName, slicerName, simDataName, sqlConstraint, metadata)
-        already exists, it does nothing.
+        already exists, it does nothing (except to add the metricDataFile, if it was not known before).
 
         Returns metricId: the Id number of this metric in the metrics table.
         """
@@ -193,6 +217,10 @@ class ResultsDb(object):
             self.session.commit()
         else:
             metricinfo = prev[0]
+            if metricinfo.metricDataFile == 'NULL' and metricDataFile != 'NULL':
+                # The metric was added (such as with its summary statistics) before its data file was written.
+                metricinfo.metricDataFile = metricDataFile
+                self.session.commit()
         return metricinfo.metricId
 
     def updateDisplay(self, metricId, displayDict, overwrite=True):
@@ -290,6 +318,32 @@ class ResultsDb(object):
             else:
                 warnings.warn('Warning! Cannot save summary statistic that is not a simple float or int')
 
+    def updateProfile(self, stage, name, sqlConstraint, wallTime=None, cpuTime=None, peakMemory=None,
+                      memoryGrowth=None, nCalls=None, medianTime=None, maxTime=None, cacheHitRate=None):
+        """
+        Add a row to the profile table.
+
+        - stage: the stage of running the metrics (such as 'query', 'stacker', 'metric' or 'plot')
+        - name: what was run in this stage (such as the stacker or metricBundle name)
+        - sqlConstraint: the sql constraint of the metricBundles being run
+        - wallTime, cpuTime: the time taken (seconds)
+        - peakMemory: the peak memory use of the process at the end of this stage (MB)
+        - memoryGrowth: the increase of the peak memory use during this stage (MB)
+        - nCalls: the number of calls (such as the number of slicePoints a metric was run on)
+        - medianTime, maxTime: the median and maximum time per call (seconds)
+        - cacheHitRate: the fraction of slicePoints which used the slicer cache
+
+        Values which were not measured may be None.
+        """
+        if sqlConstraint is None:
+            sqlConstraint = 'NULL'
+        profileinfo = ProfileRow(stage=stage, name=name, sqlConstraint=sqlConstraint, wallTime=wallTime,
+                                 cpuTime=cpuTime, peakMemory=peakMemory, memoryGrowth=memoryGrowth,
+                                 nCalls=nCalls, medianTime=medianTime, maxTime=maxTime,
+                                 cacheHitRate=cacheHitRate)
+        self.session.add(profileinfo)
+        self.session.commit()
+
     def getMetricId(self, metricName, slicerName=None, metricMetadata=None, simDataName=None):
         """
         Given a metric name and optional slicerName/metricMetadata/simData information,
@@ -386,6 +440,28 @@ class ResultsDb(object):
         return dataFiles
 
 
+    def getProfile(self, stage=None):
+        """
+        Get the contents of the profile table (optionally only for one stage).
+        Returns a numpy array of the profile information (values which were not measured are nan).
+        """
+        query = self.session.query(ProfileRow)
+        if stage is not None:
+            query = query.filter(ProfileRow.stage == stage)
+        profile = []
+        for p in query.order_by(ProfileRow.profileId):
+            values = [p.wallTime, p.cpuTime, p.peakMemory, p.memoryGrowth, p.nCalls,
+                      p.medianTime, p.maxTime, p.cacheHitRate]
+            values = [np.nan if v is None else v for v in values]
+            profile.append(tuple([p.stage, p.name, p.sqlConstraint] + values))
+        # Convert to numpy array.
+        dtype = np.dtype([('stage', self.stype), ('name', self.stype), ('sqlConstraint', self.stype),
+                          ('wallTime', float), ('cpuTime', float), ('peakMemory', float),
+                          ('memoryGrowth', float), ('nCalls', float), ('medianTime', float),
+                          ('maxTime', float), ('cacheHitRate', float)])
+        profile = np.array(profile, dtype)
+        return profile
+
     def getMetricDisplayInfo(self, metricId=None):
         """
         Get the contents of the metrics and displays table, together with the 'basemetricname'
@@ -3,11 +3,19 @@ import healpy as hp
 import os
 from lsst.sims.maf.utils import radec2pix
 from lsst.utils import getPackageDir
+from .mapCache import mapCache
 
 
 __all__ = ['EBVhp']
 
 
+def _dustMap(nside):
+    """Return the (read-only) healpix dust map at nside, shared by all calls in this process."""
+    ebvDataDir = getPackageDir('sims_maps')
+    filename = 'DustMaps/dust_nside_%i.npz'%nside
+    return mapCache.get(os.path.join(ebvDataDir,filename), 'ebvMap')
+
+
 def EBVhp(nside, ra=None,dec=None, pixels=None, interp=False):
     """
     Read in a healpix dust map and return values for given RA, Dec values
@@ -22,26 +30,23 @@ def EBVhp(nside, ra=None,dec=None, pixels=None, interp=False):
     if (ra is None) & (dec is None) & (pixels is None):
         raise RuntimeError("Need to set ra,dec or pixels.")
 
-    # Load the map
-    if not hasattr(EBVhp, 'nside'):
-        EBVhp.nside = nside
-
-    if (not hasattr(EBVhp, 'dustmap')) | (EBVhp.nside != nside) :
-        EBVhp.nside = nside
-        ebvDataDir = getPackageDir('sims_maps')
-        filename = 'DustMaps/dust_nside_%i.npz'%EBVhp.nside
-        EBVhp.dustMap = np.load(os.path.join(ebvDataDir,filename))['ebvMap']
+    # Load the map (shared by all calls in this process, for each nside).
+    dustMap = _dustMap(nside)
 
     # If we are interpolating to arbitrary positions
     if interp:
-        result = hp.get_interp_val(EBVhp.dustMap, np.pi/2. - dec , ra )
+        result = hp.get_interp_val(dustMap, np.pi/2. - dec , ra )
     else:
         # If we know the pixel indices we want
         if pixels is not None:
-            result = EBVhp.dustMap[pixels]
+            if np.size(pixels) == np.size(dustMap) and np.array_equal(pixels, np.arange(np.size(dustMap))):
+                # All of the healpixels, in order: use the map itself rather than a copy.
+                result = dustMap
+            else:
+                result = dustMap[pixels]
         # Look up
         else:
-            pixels = radec2pix(EBVhp.nside,ra,dec)
-            result = EBVhp.dustMap[pixels]
+            pixels = radec2pix(nside,ra,dec)
+            result = dustMap[pixels]
 
     return result
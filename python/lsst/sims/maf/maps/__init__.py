@@ -1,4 +1,6 @@
 from .baseMap import *
+from .mapCache import *
+from .healpixResampler import *
 from .dustMap import *
 from .galCoordsMap import *
 from .stellarDensityMap import *
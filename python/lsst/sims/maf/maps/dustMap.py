@@ -1,5 +1,6 @@
 from lsst.sims.maf.maps import BaseMap
-from .EBVhp import EBVhp
+from .EBVhp import EBVhp, _dustMap
+from .healpixResampler import healpixResampler
 import warnings
 
 __all__ = ['DustMap']
@@ -24,9 +25,14 @@ class DustMap(BaseMap):
                 warnings.warn('Slicer value of nside (%i) different from map value (%i), using slicer value'%(slicePoints['nside'],self.nside ))
             slicePoints['ebv'] = EBVhp(slicePoints['nside'], pixels=slicePoints['sid'])
         # Not a healpix slicer, look up values based on RA,dec with possible interpolation
+        # (using the nearest healpixels, or interpolating between them, cached for these slicePoints).
         else:
-            slicePoints['ebv'] = EBVhp(self.nside, ra=slicePoints['ra'],
-                                            dec=slicePoints['dec'], interp=self.interp)
+            if self.interp:
+                method = 'bilinear'
+            else:
+                method = 'nearest'
+            slicePoints['ebv'] = healpixResampler.resample(_dustMap(self.nside), ra=slicePoints['ra'],
+                                                           dec=slicePoints['dec'], method=method)
 
         return slicePoints
 
@@ -0,0 +1,173 @@
+import os
+import hashlib
+import threading
+import numpy as np
+import healpy as hp
+from lsst.sims.maf.utils import radec2pix
+from .mapCache import mapCache
+
+__all__ = ['HealpixResampler', 'healpixResampler']
+
+
+class HealpixResampler(object):
+    """
+    Resample healpix maps to other healpix resolutions or to arbitrary points, with a single gather.
+
+    The correspondence between the map healpixels (at nsideFrom) and the slicePoints (the healpixels at
+    nsideTo, or a set of ra/dec points) depends only on the geometry, so it is calculated once and
+    saved in cacheDir (as .npy files, which are memory-mapped when read back). The methods are:
+
+    'nearest': the map healpixel containing each slicePoint (as radec2pix).
+    'average': the mean of the map healpixels within each slicePoint healpixel (as healpy's ud_grade,
+       for maps without UNSEEN healpixels; the same as 'nearest' when nsideTo >= nsideFrom).
+       Only for healpix slicePoints.
+    'bilinear': the weighted mean of the four nearest map healpixels (as healpy's get_interp_val).
+
+    Parameters
+    ----------
+    cacheDir : str, optional
+        The directory for the correspondence tables. Default is the directory of the map cache.
+    """
+    methods = ('nearest', 'average', 'bilinear')
+
+    def __init__(self, cacheDir=None):
+        if cacheDir is None:
+            cacheDir = mapCache.cacheDir
+        self.cacheDir = cacheDir
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _table(self, name, compute):
+        """Return the table name: from memory, or from cacheDir, or calculated with compute() and saved."""
+        with self._lock:
+            if name in self._tables:
+                return self._tables[name]
+        filename = os.path.join(self.cacheDir, name + '.npy')
+        if os.path.isfile(filename):
+            table = np.load(filename, mmap_mode='r')
+        else:
+            table = compute()
+            try:
+                if not os.path.isdir(self.cacheDir):
+                    os.makedirs(self.cacheDir)
+            except OSError:
+                # Another process may have made it.
+                pass
+            # Write to a temporary file first, so other processes never see a partly written file.
+            tmpFilename = filename + '.%d.tmp' % os.getpid()
+            try:
+                with open(tmpFilename, 'wb') as f:
+                    np.save(f, table)
+                os.rename(tmpFilename, filename)
+            except (IOError, OSError):
+                pass
+            table.setflags(write=False)
+        with self._lock:
+            self._tables[name] = table
+        return table
+
+    def _pointsName(self, ra, dec):
+        """Identify a set of points by a hash of their coordinates."""
+        md5 = hashlib.md5()
+        for values in (ra, dec):
+            values = np.ascontiguousarray(values, dtype=float)
+            md5.update(values.tostring())
+        return md5.hexdigest()[:16]
+
+    def index(self, nsideFrom, nsideTo=None, ra=None, dec=None, method='nearest'):
+        """
+        Return the correspondence table from healpixels at nsideFrom to slicePoints.
+
+        The slicePoints are either all of the (RING) healpixels at nsideTo, or the points ra/dec (radians).
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray
+            The map healpixels and their weights for each slicePoint, shape (number of slicePoints, n):
+            n is 1 for 'nearest', (nsideFrom/nsideTo)**2 for 'average' and 4 for 'bilinear'.
+            The weights of each slicePoint add up to 1.
+        """
+        if method not in self.methods:
+            raise ValueError('method should be one of %s' % (', '.join(self.methods)))
+        if nsideTo is None:
+            if ra is None or dec is None:
+                raise ValueError('Need to set nsideTo or ra and dec.')
+            if method == 'average':
+                raise ValueError('The average method is only available for healpix slicePoints.')
+            name = 'points_%s_%d_%s' % (method, nsideFrom, self._pointsName(ra, dec))
+        else:
+            name = 'healpix_%s_%d_%d' % (method, nsideFrom, nsideTo)
+
+        def slicePointAngles():
+            if nsideTo is None:
+                return np.pi/2. - np.asarray(dec, float), np.asarray(ra, float)
+            return hp.pix2ang(nsideTo, np.arange(hp.nside2npix(nsideTo)))
+
+        if method == 'average' and nsideTo < nsideFrom:
+            def compute():
+                # The (NESTED) children of each healpixel at nsideTo are consecutive at nsideFrom.
+                nChildren = (nsideFrom // nsideTo)**2
+                parents = hp.ring2nest(nsideTo, np.arange(hp.nside2npix(nsideTo)))
+                children = parents[:, np.newaxis] * nChildren + np.arange(nChildren)
+                return hp.nest2ring(nsideFrom, children)
+            pixels = self._table(name, compute)
+            weights = np.ones(pixels.shape) / pixels.shape[1]
+        elif method == 'bilinear':
+            def compute():
+                pixels, weights = hp.get_interp_weights(nsideFrom, *slicePointAngles())
+                return np.concatenate([pixels.T, weights.T], axis=1)
+            table = self._table(name, compute)
+            pixels = table[:, :4].astype(int)
+            weights = table[:, 4:]
+        else:
+            def compute():
+                if nsideTo is None:
+                    return radec2pix(nsideFrom, ra, dec)[:, np.newaxis]
+                # Go through the slicePoint ra/dec (as the HealpixSlicer does), so that healpixel centers
+                # on the edges of the map healpixels are assigned in the same way as by radec2pix.
+                lat, lon = slicePointAngles()
+                return radec2pix(nsideFrom, lon, np.pi/2. - lat)[:, np.newaxis]
+            pixels = self._table(name.replace('average', 'nearest'), compute)
+            weights = np.ones(pixels.shape)
+        return pixels, weights
+
+    def resample(self, mapValues, nsideTo=None, ra=None, dec=None, pixels=None, method='nearest'):
+        """
+        Resample a healpix map (RING ordering) to healpixels at nsideTo or to the points ra/dec (radians).
+
+        Parameters
+        ----------
+        mapValues : numpy.ndarray
+            The map; the first dimension is the healpixels (other dimensions, such as magnitude bins,
+            are resampled together).
+        nsideTo : int, optional
+            Resample to the healpixels at nsideTo.
+        ra, dec : numpy.ndarray, optional
+            Resample to these points (if nsideTo is None).
+        pixels : numpy.ndarray, optional
+            Only return the values for these healpixels at nsideTo (such as the slicePoints of a sparse slicer).
+        method : str, optional
+            'nearest' (default), 'average' or 'bilinear'.
+
+        Returns
+        -------
+        numpy.ndarray
+            The resampled map.
+        """
+        nsideFrom = hp.npix2nside(len(mapValues))
+        if nsideTo == nsideFrom:
+            if pixels is None:
+                return mapValues
+            return mapValues[pixels]
+        index, weights = self.index(nsideFrom, nsideTo=nsideTo, ra=ra, dec=dec, method=method)
+        if pixels is not None:
+            index = index[pixels]
+            weights = weights[pixels]
+        if index.shape[1] == 1:
+            return mapValues[index[:, 0]]
+        weights = weights.reshape(weights.shape + (1,) * (np.ndim(mapValues) - 1))
+        return np.sum(mapValues[index] * weights, axis=1)
+
+
+# The resampler shared by all of the maps in this process.
+healpixResampler = HealpixResampler()
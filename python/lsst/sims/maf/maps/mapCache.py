@@ -0,0 +1,121 @@
+import os
+import tempfile
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ['MapCache', 'mapCache']
+
+
+class MapCache(object):
+    """
+    Cache of the arrays read from map files (such as the dust and stellar density maps).
+
+    Each array is read from its (npz) file only once: it is then saved as a .npy file in cacheDir
+    and memory-mapped (read-only), so all the maps using it, and all the processes on the machine
+    reading the same map, share the same memory. The most recently used arrays are kept open,
+    up to maxBytes in total.
+
+    The arrays are read-only: maps should attach them (or slices of them) to the slicePoints
+    without copying where possible.
+
+    Parameters
+    ----------
+    cacheDir : str, optional
+        The directory for the .npy files. Default is maf_mapcache in the temporary directory.
+        If the directory can't be written, the arrays are kept in memory instead.
+    maxBytes : float, optional
+        The maximum total size of the arrays kept open, in bytes. Default 4GB.
+    """
+    def __init__(self, cacheDir=None, maxBytes=4e9):
+        if cacheDir is None:
+            cacheDir = os.path.join(tempfile.gettempdir(), 'maf_mapcache')
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._arrays = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename, key):
+        """
+        Return the array key of the (npz) map file filename.
+
+        Parameters
+        ----------
+        filename : str
+            The map file.
+        key : str
+            The name of the array in the map file.
+
+        Returns
+        -------
+        numpy.ndarray
+            The (read-only, usually memory-mapped) array.
+        """
+        cacheKey = (os.path.abspath(filename), key)
+        with self._lock:
+            if cacheKey in self._arrays:
+                # Move this array to the end of the OrderedDict (the most recently used).
+                values = self._arrays.pop(cacheKey)
+                self._arrays[cacheKey] = values
+                self.hits += 1
+                return values
+        values = self._read(filename, key)
+        with self._lock:
+            if cacheKey not in self._arrays:
+                self._arrays[cacheKey] = values
+                self.nbytes += values.nbytes
+                self.misses += 1
+            values = self._arrays[cacheKey]
+            # Drop the least recently used arrays until below maxBytes (always keeping this one).
+            while self.nbytes > self.maxBytes and len(self._arrays) > 1:
+                oldKey, oldValues = self._arrays.popitem(last=False)
+                self.nbytes -= oldValues.nbytes
+        return values
+
+    def clear(self):
+        """Close all of the arrays (the .npy files are kept in cacheDir)."""
+        with self._lock:
+            self._arrays = OrderedDict()
+            self.nbytes = 0
+
+    def _npyFilename(self, filename, key):
+        """Name the .npy file for array key of filename (changing if the map file changes)."""
+        stat = os.stat(filename)
+        tag = hashlib.md5('%s %d %d' % (os.path.abspath(filename), stat.st_size, stat.st_mtime)).hexdigest()
+        root = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.cacheDir, '%s_%s_%s.npy' % (root, key, tag[:16]))
+
+    def _read(self, filename, key):
+        """Read array key of filename, memory-mapping it through a .npy file if possible."""
+        npyFilename = self._npyFilename(filename, key)
+        if os.path.isfile(npyFilename):
+            return np.load(npyFilename, mmap_mode='r')
+        values = np.load(filename)[key]
+        if values.dtype.hasobject or values.size == 0:
+            # These can't be memory-mapped.
+            values.setflags(write=False)
+            return values
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+        except OSError:
+            # Another process may have made it.
+            pass
+        # Write to a temporary file first, so other processes never see a partly written file.
+        tmpFilename = npyFilename + '.%d.tmp' % os.getpid()
+        try:
+            with open(tmpFilename, 'wb') as f:
+                np.save(f, values)
+            os.rename(tmpFilename, npyFilename)
+        except (IOError, OSError):
+            values.setflags(write=False)
+            return values
+        return np.load(npyFilename, mmap_mode='r')
+
+
+# The cache shared by all of the maps in this process.
+mapCache = MapCache()
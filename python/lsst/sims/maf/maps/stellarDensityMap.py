@@ -1,9 +1,10 @@
 from . import BaseMap
+from .mapCache import mapCache
+from .healpixResampler import healpixResampler
 import numpy as np
 from lsst.utils import getPackageDir
 import os
 import healpy as hp
-from lsst.sims.maf.utils import radec2pix
 
 __all__ = ['StellarDensityMap']
 
@@ -35,23 +36,39 @@ class StellarDensityMap(BaseMap):
 
     def _readMap(self):
         filename = 'starDensity_%s_%snside_64.npz' % (self.filtername, self.startype)
-        starMap = np.load(os.path.join(self.mapDir,filename))
-        self.starMap = starMap['starDensity'].copy()
-        self.starMapBins = starMap['bins'].copy()
+        self.starMapFile = os.path.join(self.mapDir, filename)
+        # The (read-only) map arrays are shared by all the StellarDensityMaps in this process.
+        self.starMap = mapCache.get(self.starMapFile, 'starDensity')
+        self.starMapBins = mapCache.get(self.starMapFile, 'bins')
         self.starmapNside = hp.npix2nside(np.size(self.starMap[:,0]))
 
     def run(self, slicePoints):
+        """Add the luminosity function ('starLumFunc') and the index of the map healpixel ('starMapPix')
+        for each slicepoint, and the magnitude bins ('starMapBins') and map file ('starMapFile') to slicePoints.
+        """
         self._readMap()
 
         nsideMatch = False
         if 'nside' in slicePoints.keys():
             if slicePoints['nside'] == self.starmapNside:
-                slicePoints['starLumFunc'] = self.starMap
+                if np.size(slicePoints['sid']) == np.size(self.starMap[:,0]):
+                    slicePoints['starLumFunc'] = self.starMap
+                else:
+                    # Sparse healpix slicer.
+                    slicePoints['starLumFunc'] = self.starMap[slicePoints['sid'],:]
+                slicePoints['starMapPix'] = np.array(slicePoints['sid'], int)
                 nsideMatch = True
         if not nsideMatch:
-            # Compute the healpix for each slicepoint on the nside=64 grid
-            indx = radec2pix(self.starmapNside, slicePoints['ra'], slicePoints['dec'])
+            # Find the healpix for each slicepoint on the nside=64 grid (cached for these slicePoints).
+            if 'nside' in slicePoints.keys():
+                indx = healpixResampler.index(self.starmapNside, nsideTo=slicePoints['nside'])[0]
+                indx = indx[slicePoints['sid'], 0]
+            else:
+                indx = healpixResampler.index(self.starmapNside, ra=slicePoints['ra'],
+                                              dec=slicePoints['dec'])[0][:, 0]
             slicePoints['starLumFunc'] = self.starMap[indx,:]
+            slicePoints['starMapPix'] = indx
 
         slicePoints['starMapBins'] = self.starMapBins
+        slicePoints['starMapFile'] = self.starMapFile
         return slicePoints
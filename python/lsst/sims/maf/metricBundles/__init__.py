@@ -1,2 +1,9 @@
 from .metricBundle import *
 from .metricBundleGroup import *
+from .resultCache import *
+from .metricFileCache import *
+from .bundleWriter import *
+from .checkpoint import *
+from .memoryBudget import *
+from .workQueue import *
+from .profiler import *
@@ -0,0 +1,118 @@
+import threading
+import traceback
+from copy import copy
+from Queue import Queue
+
+__all__ = ['BundleWriter']
+
+
+def _snapshot(metricBundle):
+    """Return a copy of metricBundle, with a copy of the slicer metadata that setupSlicer changes."""
+    snapshot = copy(metricBundle)
+    snapshot.slicer = copy(metricBundle.slicer)
+    snapshot.slicer.slicePoints = dict(metricBundle.slicer.slicePoints)
+    snapshot.plotDict = dict(metricBundle.plotDict)
+    snapshot.displayDict = dict(metricBundle.displayDict)
+    return snapshot
+
+
+class BundleWriter(object):
+    """
+    Write MetricBundles to disk (and record them in the resultsDb) in a background thread.
+
+    MetricBundle.write is called in the writer thread on a copy of each bundle (and of its slicer) taken
+    when it is queued, so the bundle can be given new metricValues (or have them deleted), and its slicer
+    set up again (as for the next constraint), as soon as write returns.
+    Writes of a bundle which is already waiting in the queue replace the waiting write, so a bundle
+    written early and again after its summary statistics is only written once if the writer is behind.
+    At most maxQueue bundles wait to be written: write blocks when the queue is full, limiting the
+    memory held by the queued metric values.
+
+    Anything else using the resultsDb while the writer is running should hold lock.
+    Errors raised while writing are kept, and raised (as a RuntimeError) by flush.
+
+    Parameters
+    ----------
+    outDir : str
+        The output directory.
+    resultsDb : ResultsDb, optional
+        The results database to record the output files in.
+    maxQueue : int, optional
+        The maximum number of bundles waiting to be written. Default 20.
+    """
+    def __init__(self, outDir, resultsDb=None, maxQueue=20):
+        self.outDir = outDir
+        self.resultsDb = resultsDb
+        self.maxQueue = maxQueue
+        # Held while using the resultsDb.
+        self.lock = threading.RLock()
+        self.nWritten = 0
+        self.nCoalesced = 0
+        self.errors = []
+        self._pending = {}
+        self._pendingLock = threading.Lock()
+        self._queue = Queue(maxsize=maxQueue)
+        self._thread = None
+
+    def write(self, metricBundle, outfileSuffix=None):
+        """
+        Queue a MetricBundle to be written to outDir (as MetricBundle.write).
+
+        Parameters
+        ----------
+        metricBundle : MetricBundle
+            The metric bundle.
+        outfileSuffix : str, optional
+            Additional suffix for the output file.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='BundleWriter')
+            self._thread.daemon = True
+            self._thread.start()
+        key = (metricBundle.fileRoot, outfileSuffix)
+        with self._pendingLock:
+            queued = key in self._pending
+            self._pending[key] = _snapshot(metricBundle)
+            if queued:
+                self.nCoalesced += 1
+        if not queued:
+            self._queue.put(key)
+
+    def _run(self):
+        """Write the queued bundles, until stopped by a None key."""
+        while True:
+            key = self._queue.get()
+            try:
+                if key is None:
+                    return
+                with self._pendingLock:
+                    metricBundle = self._pending.pop(key)
+                metricBundle.write(outDir=self.outDir, outfileSuffix=key[1])
+                if self.resultsDb is not None:
+                    with self.lock:
+                        metricBundle.writeDb(self.resultsDb, outfileSuffix=key[1])
+                self.nWritten += 1
+            except Exception as e:
+                self.errors.append((key[0], e, traceback.format_exc()))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Wait for all the queued bundles to be written, and stop the writer thread.
+
+        Raises
+        ------
+        RuntimeError
+            If any bundles could not be written (since the last flush).
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if len(self.errors) > 0:
+            errors = self.errors
+            self.errors = []
+            message = 'Could not write %d metric bundle(s): %s' % (len(errors),
+                                                                   ', '.join([e[0] for e in errors]))
+            raise RuntimeError(message + '\n' + errors[0][2])
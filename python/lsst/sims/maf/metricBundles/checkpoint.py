@@ -0,0 +1,155 @@
+import os
+import json
+import shutil
+
+import lsst.sims.maf.slicers as slicers
+from lsst.sims.maf.utils import configHash, metricHash
+
+__all__ = ['Checkpoint']
+
+
+class Checkpoint(object):
+    """
+    The progress of a MetricBundleGroup run, saved so that an interrupted run can be resumed.
+
+    The metric values of each bundle are saved when its compatible list is finished, and (if every
+    is set) the partly calculated metric values of the bundles being run are saved every 'every'
+    slicePoints. The files (in the npz format of BaseSlicer.writeData) are listed in a progress
+    file, progress.json. Everything is written to a temporary file which is then renamed, so an
+    interrupted write leaves the previous checkpoint in place.
+
+    Bundles are identified by their fileRoot, metric configuration, slicer configuration and constraint,
+    so bundles which have been changed are not resumed. Resuming assumes the data are the same.
+
+    Parameters
+    ----------
+    checkpointDir : str
+        The directory for the checkpoint files.
+    every : int, optional
+        Save the partly calculated metric values every 'every' slicePoints. Default None (only save
+        the metric values of finished bundles).
+    """
+    def __init__(self, checkpointDir, every=None):
+        self.checkpointDir = checkpointDir
+        self.every = every
+        self.progressFile = os.path.join(self.checkpointDir, 'progress.json')
+        self.finished = set()
+        self.partial = {}
+
+    def key(self, metricBundle):
+        """Identify a MetricBundle (by its fileRoot, metric, slicer and constraint)."""
+        return configHash([metricBundle.fileRoot, metricHash(metricBundle.metric),
+                           metricBundle.slicer.slicerName, metricBundle.slicer.slicer_init,
+                           metricBundle.constraint])
+
+    def read(self):
+        """Read the progress saved by an earlier run (if any)."""
+        self.finished = set()
+        self.partial = {}
+        if os.path.isfile(self.progressFile):
+            with open(self.progressFile, 'r') as f:
+                progress = json.load(f)
+            self.finished = set([str(key) for key in progress['finished']])
+            self.partial = dict([(str(key), nextSlice) for key, nextSlice in progress['partial'].iteritems()])
+
+    def clear(self):
+        """Forget all progress, deleting the checkpoint files."""
+        self.finished = set()
+        self.partial = {}
+        if os.path.isdir(self.checkpointDir):
+            shutil.rmtree(self.checkpointDir)
+
+    def _filename(self, key):
+        return os.path.join(self.checkpointDir, key + '.npz')
+
+    def _save(self, key, metricBundle):
+        """Save the metric values of metricBundle as key."""
+        if not os.path.isdir(self.checkpointDir):
+            os.makedirs(self.checkpointDir)
+        filename = self._filename(key)
+        tmpFilename = filename.replace('.npz', '.%d.tmp.npz' % os.getpid())
+        metricBundle.slicer.writeData(tmpFilename, metricBundle.metricValues,
+                                      metricName=metricBundle.metric.name,
+                                      simDataName=metricBundle.runName,
+                                      constraint=metricBundle.constraint,
+                                      metadata=metricBundle.metadata)
+        os.rename(tmpFilename, filename)
+
+    def _writeProgress(self):
+        """Save the list of finished and partly calculated bundles."""
+        tmpFilename = self.progressFile + '.%d.tmp' % os.getpid()
+        with open(tmpFilename, 'w') as f:
+            json.dump({'finished': sorted(self.finished), 'partial': self.partial}, f)
+        os.rename(tmpFilename, self.progressFile)
+
+    def finish(self, metricBundles):
+        """
+        Save the metric values of MetricBundles which have been calculated.
+
+        Parameters
+        ----------
+        metricBundles : list of MetricBundle
+            The metric bundles.
+        """
+        for metricBundle in metricBundles:
+            key = self.key(metricBundle)
+            self._save(key, metricBundle)
+            self.finished.add(key)
+            if key in self.partial:
+                del self.partial[key]
+                os.remove(self._filename(key + '_partial'))
+        self._writeProgress()
+
+    def savePartial(self, metricBundles, nextSlice):
+        """
+        Save the metric values of MetricBundles which have been calculated up to slicePoint nextSlice.
+
+        Parameters
+        ----------
+        metricBundles : list of MetricBundle
+            The metric bundles (run together).
+        nextSlice : int
+            The first slicePoint which has not been calculated.
+        """
+        for metricBundle in metricBundles:
+            key = self.key(metricBundle)
+            self._save(key + '_partial', metricBundle)
+            self.partial[key] = nextSlice
+        self._writeProgress()
+
+    def getFinished(self, metricBundle):
+        """
+        Read the metric values of a MetricBundle finished in an earlier run.
+
+        Returns
+        -------
+        numpy.ma.MaskedArray, BaseSlicer
+            The metric values and the slicer they were calculated with, or None if the bundle wasn't finished.
+        """
+        key = self.key(metricBundle)
+        if key not in self.finished:
+            return None
+        metricValues, slicer, header = slicers.BaseSlicer().readData(self._filename(key))
+        metricValues.fill_value = slicer.badval
+        return metricValues, slicer
+
+    def restorePartial(self, metricBundles):
+        """
+        Restore the partly calculated metric values of MetricBundles (run together) from an earlier run.
+
+        The metric values are only restored if all of the bundles were saved up to the same slicePoint.
+
+        Returns
+        -------
+        int
+            The first slicePoint to calculate (0 if nothing was restored).
+        """
+        keys = [self.key(metricBundle) for metricBundle in metricBundles]
+        nextSlices = set([self.partial.get(key) for key in keys])
+        if len(nextSlices) != 1 or None in nextSlices:
+            return 0
+        for key, metricBundle in zip(keys, metricBundles):
+            metricValues, slicer, header = slicers.BaseSlicer().readData(self._filename(key + '_partial'))
+            metricValues.fill_value = metricBundle.slicer.badval
+            metricBundle.metricValues = metricValues
+        return nextSlices.pop()
@@ -0,0 +1,166 @@
+import os
+import mmap
+import atexit
+import shutil
+import tempfile
+import threading
+import itertools
+import numpy as np
+import numpy.ma as ma
+
+__all__ = ['MemoryBudget']
+
+
+def _isMapped(array):
+    """Return True if array is a view of a memory-mapped file."""
+    while array is not None:
+        if isinstance(array, mmap.mmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def _residentBytes(metricValues):
+    """Return the bytes of metricValues (data and mask) held in memory (not mapped from a file)."""
+    nbytes = 0
+    if metricValues is None:
+        return nbytes
+    data = ma.getdata(metricValues)
+    if not _isMapped(data):
+        nbytes += data.nbytes
+    mask = ma.getmask(metricValues)
+    if mask is not ma.nomask and not _isMapped(mask):
+        nbytes += mask.nbytes
+    return nbytes
+
+
+class MemoryBudget(object):
+    """
+    Keep the metric values of MetricBundles held in memory below a limit, by spilling them to disk.
+
+    When enforce is called and the metric values held in memory exceed maxBytes, the metric values
+    of the least recently used MetricBundles are written to .npy files in a spill directory and
+    replaced by (copy-on-write) memory maps of those files. The spilled metric values are used
+    exactly as before: the operating system pages them back in from the files as they are read,
+    and can drop them from memory again when memory is short.
+
+    MetricBundles report changes to (and use of) their metricValues to the budget they are added to.
+    Metric values with an object dtype can't be memory-mapped, so are never spilled.
+    The spill directory (a new directory in outDir) is removed by close, or when python exits.
+
+    Parameters
+    ----------
+    outDir : str
+        The directory in which to make the spill directory.
+    maxBytes : float
+        The maximum size of the metric values (data and mask) to hold in memory, in bytes.
+    """
+    def __init__(self, outDir, maxBytes):
+        self.outDir = outDir
+        self.maxBytes = maxBytes
+        self.spillDir = None
+        self.nbytes = 0
+        self.nSpilled = 0
+        # The managed MetricBundles, by id: [metricBundle, bytes in memory, last use, spill files].
+        self._bundles = {}
+        self._clock = itertools.count()
+        self._lock = threading.RLock()
+
+    def add(self, metricBundle):
+        """
+        Manage the memory used by the metric values of a MetricBundle.
+
+        Parameters
+        ----------
+        metricBundle : MetricBundle
+            The metric bundle.
+        """
+        metricBundle._memoryBudget = self
+        self.update(metricBundle)
+
+    def update(self, metricBundle):
+        """Record new metric values of a MetricBundle (called by MetricBundle when they are set)."""
+        with self._lock:
+            entry = self._bundles.get(id(metricBundle))
+            if entry is None or entry[0] is not metricBundle:
+                entry = [metricBundle, 0, 0, []]
+                self._bundles[id(metricBundle)] = entry
+            # Any spilled metric values have been replaced.
+            self._removeFiles(entry)
+            self.nbytes -= entry[1]
+            entry[1] = _residentBytes(metricBundle._metricValues)
+            entry[2] = next(self._clock)
+            self.nbytes += entry[1]
+
+    def touch(self, metricBundle):
+        """Record the use of the metric values of a MetricBundle."""
+        entry = self._bundles.get(id(metricBundle))
+        if entry is not None and entry[0] is metricBundle:
+            entry[2] = next(self._clock)
+
+    def _removeFiles(self, entry):
+        for filename in entry[3]:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        entry[3] = []
+
+    def _spill(self, entry):
+        """Write the metric values of a MetricBundle to disk, replacing them with memory maps of the files."""
+        metricBundle = entry[0]
+        metricValues = metricBundle._metricValues
+        if self.spillDir is None:
+            self.spillDir = tempfile.mkdtemp(prefix='spill_', dir=self.outDir)
+            atexit.register(shutil.rmtree, self.spillDir, True)
+        root = os.path.join(self.spillDir, '%s_%d' % (metricBundle.fileRoot, self.nSpilled))
+        np.save(root + '_values.npy', ma.getdata(metricValues))
+        data = np.load(root + '_values.npy', mmap_mode='c')
+        files = [root + '_values.npy']
+        if isinstance(metricValues, ma.MaskedArray):
+            np.save(root + '_mask.npy', ma.getmaskarray(metricValues))
+            mask = np.load(root + '_mask.npy', mmap_mode='c')
+            files.append(root + '_mask.npy')
+            metricBundle._metricValues = ma.MaskedArray(data=data, mask=mask,
+                                                        fill_value=metricValues.fill_value)
+        else:
+            metricBundle._metricValues = data
+        self._removeFiles(entry)
+        entry[3] = files
+        self.nbytes -= entry[1]
+        entry[1] = 0
+        self.nSpilled += 1
+
+    def enforce(self, keep=None):
+        """
+        Spill the metric values of the least recently used MetricBundles, until those held in memory
+        are below maxBytes.
+
+        Only call this when none of the MetricBundles are being filled in (e.g. not while running metrics).
+
+        Parameters
+        ----------
+        keep : MetricBundle, optional
+            A metric bundle to keep in memory (e.g. one being used now).
+        """
+        if self.nbytes <= self.maxBytes:
+            return
+        with self._lock:
+            entries = [entry for entry in self._bundles.itervalues()
+                       if entry[1] > 0 and entry[0] is not keep
+                       and not ma.getdata(entry[0]._metricValues).dtype.hasobject]
+            entries.sort(key=lambda entry: entry[2])
+            for entry in entries:
+                if self.nbytes <= self.maxBytes:
+                    break
+                self._spill(entry)
+
+    def close(self):
+        """Stop managing the MetricBundles, and remove the spill directory.
+        Spilled metric values remain usable until they are replaced."""
+        with self._lock:
+            for entry in self._bundles.itervalues():
+                entry[0]._memoryBudget = None
+            self._bundles = {}
+            self.nbytes = 0
+            if self.spillDir is not None:
+                shutil.rmtree(self.spillDir, True)
+                self.spillDir = None
@@ -11,6 +11,7 @@ import lsst.sims.maf.maps as maps
 import lsst.sims.maf.plots as plots
 from lsst.sims.maf.stackers import ColInfo
 import lsst.sims.maf.utils as utils
+from .metricFileCache import metricFileCache, writableValues
 
 __all__ = ['MetricBundle', 'createEmptyMetricBundle']
 
@@ -110,9 +111,40 @@ class MetricBundle(object):
         self.displayDict = {}
         self.setDisplayDict(displayDict)
         # This is where we store the metric values and summary stats.
+        # (The MemoryBudget managing the memory used by the metric values, if any).
+        self._memoryBudget = None
         self.metricValues = None
         self.summaryValues = None
 
+    @property
+    def metricValues(self):
+        """The metric values (read from the metric data file when first used, after setMetricFile)."""
+        if self._metricValues is None and self._metricFile is not None:
+            self.metricValues = writableValues(metricFileCache.read(self._metricFile)[0])
+            if self._memoryBudget is not None:
+                self._memoryBudget.enforce(keep=self)
+        elif self._memoryBudget is not None:
+            self._memoryBudget.touch(self)
+        return self._metricValues
+
+    @metricValues.setter
+    def metricValues(self, metricValues):
+        self._metricValues = metricValues
+        self._metricFile = None
+        if self._memoryBudget is not None:
+            self._memoryBudget.update(self)
+
+    def setMetricFile(self, filename):
+        """Set the metric values to be read from a metric data file when they are first used.
+
+        Parameters
+        ----------
+        filename : str
+           The file holding the metric values (as written by write).
+        """
+        self.metricValues = None
+        self._metricFile = filename
+
     def _resetMetricBundle(self):
         """Reset all properties of MetricBundle.
         """
@@ -161,7 +193,7 @@ class MetricBundle(object):
 
     def _buildFileRoot(self):
         """
-        Build an auto-generated output filename root (i.e. minus the plot type or .npz ending).
+        Build an auto-generated output filename root (i.e. minus the plot type or data file ending).
         """
         # Build basic version.
         self.fileRoot = '_'.join([self.runName, self.metric.name, self.metadata,
@@ -345,10 +377,7 @@ class MetricBundle(object):
         resultsD : Optional[ResultsDb]
             Results database to store information on the file output
         """
-        if outfileSuffix is not None:
-            outfile = self.fileRoot + '_' + outfileSuffix + '.npz'
-        else:
-            outfile = self.fileRoot + '.npz'
+        outfile = self._outfile(outfileSuffix)
         self.slicer.writeData(os.path.join(outDir, outfile),
                               self.metricValues,
                               metricName=self.metric.name,
@@ -358,10 +387,28 @@ class MetricBundle(object):
                               displayDict=self.displayDict,
                               plotDict=self.plotDict)
         if resultsDb:
-            metricId = resultsDb.updateMetric(self.metric.name, self.slicer.slicerName,
-                                              self.runName, self.constraint,
-                                              self.metadata, outfile)
-            resultsDb.updateDisplay(metricId, self.displayDict)
+            self.writeDb(resultsDb, outfileSuffix=outfileSuffix)
+
+    def writeDb(self, resultsDb, outfileSuffix=None):
+        """Record the output file written by write (and the display parameters) in the results database.
+
+        Parameters
+        ----------
+        resultsDb : ResultsDb
+            Results database to store information on the file output
+        outfileSuffix : Optional[str]
+            The suffix added to the output file by write.
+        """
+        metricId = resultsDb.updateMetric(self.metric.name, self.slicer.slicerName,
+                                          self.runName, self.constraint,
+                                          self.metadata, self._outfile(outfileSuffix))
+        resultsDb.updateDisplay(metricId, self.displayDict)
+
+    def _outfile(self, outfileSuffix=None):
+        """Return the name of the output file (the JSON header) written by write."""
+        if outfileSuffix is not None:
+            return self.fileRoot + '_' + outfileSuffix + '.json'
+        return self.fileRoot + '.json'
 
     def outputJSON(self):
         """Set up and call the baseSlicer outputJSON method, to output to IO string.
@@ -378,7 +425,7 @@ class MetricBundle(object):
                                     plotDict=self.plotDict)
         return io
 
-    def read(self, filename):
+    def read(self, filename, useCache=False):
         """Read metricValues and associated metadata from disk.
         Overwrites any data currently in metricbundle.
 
@@ -386,15 +433,22 @@ class MetricBundle(object):
         ----------
         filename : str
            The file from which to read the metric bundle data.
+        useCache : bool, optional
+           If True, read the file through the metricFileCache, so the file is only read once in this process.
+           The metricValues and slicer are then shared with the cache, and must not be changed.
+           Default False.
         """
         if not os.path.isfile(filename):
             raise IOError('%s not found' % filename)
 
         self._resetMetricBundle()
-        # Set up a base slicer to read data (we don't know type yet).
-        baseslicer = slicers.BaseSlicer()
-        # Use baseslicer to read file.
-        metricValues, slicer, header = baseslicer.readData(filename)
+        if useCache:
+            metricValues, slicer, header = metricFileCache.read(filename)
+        else:
+            # Set up a base slicer to read data (we don't know type yet).
+            baseslicer = slicers.BaseSlicer()
+            # Use baseslicer to read file.
+            metricValues, slicer, header = baseslicer.readData(filename)
         self.slicer = slicer
         self.metricValues = metricValues
         self.metricValues.fill_value = slicer.badval
@@ -422,7 +476,7 @@ class MetricBundle(object):
         if 'displayDict' in header:
             self.setDisplayDict(header['displayDict'])
         path, head = os.path.split(filename)
-        self.fileRoot = head.replace('.npz', '')
+        self.fileRoot = os.path.splitext(head)[0]
         self.setPlotFuncs(None)
 
     def computeSummaryStats(self, resultsDb=None):
@@ -436,9 +490,11 @@ class MetricBundle(object):
         if self.summaryValues is None:
             self.summaryValues = {}
         if self.summaryMetrics is not None:
+            # Expand metric values evaluated at fewer points than the slicer represents (adaptive slicers).
+            metricValues = self.slicer.expandValues(self.metricValues)
             # Build array of metric values, to use for (most) summary statistics.
-            rarr_std = np.array(zip(self.metricValues.compressed()),
-                                dtype=[('metricdata', self.metricValues.dtype)])
+            rarr_std = np.array(zip(metricValues.compressed()),
+                                dtype=[('metricdata', metricValues.dtype)])
             for m in self.summaryMetrics:
                 # The summary metric colname should already be set to 'metricdata', but in case it's not:
                 m.colname = 'metricdata'
@@ -446,8 +502,8 @@ class MetricBundle(object):
                 if hasattr(m, 'maskVal'):
                     # summary metric requests to use the mask value, as specified by itself,
                     #  rather than skipping masked vals.
-                    rarr = np.array(zip(self.metricValues.filled(m.maskVal)),
-                                    dtype=[('metricdata', self.metricValues.dtype)])
+                    rarr = np.array(zip(metricValues.filled(m.maskVal)),
+                                    dtype=[('metricdata', metricValues.dtype)])
                 else:
                     rarr = rarr_std
                 if np.size(rarr) == 0:
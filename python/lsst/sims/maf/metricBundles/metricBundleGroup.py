@@ -1,19 +1,34 @@
 import os
+import time
 import numpy as np
 import numpy.ma as ma
 import matplotlib.pyplot as plt
 from collections import OrderedDict
+from copy import copy
+from contextlib import contextmanager
 
 import lsst.sims.maf.db as db
 import lsst.sims.maf.utils as utils
 from lsst.sims.maf.plots import PlotHandler
 import lsst.sims.maf.maps as maps
 from .metricBundle import MetricBundle, createEmptyMetricBundle
+from .metricFileCache import metricFileCache, writableValues
+from .bundleWriter import BundleWriter
+from .checkpoint import Checkpoint
+from .memoryBudget import MemoryBudget
+from .workQueue import WorkQueueWorker
 import warnings
 
 __all__ = ['makeBundlesDictFromList', 'MetricBundleGroup']
 
 
+@contextmanager
+def _nullContext():
+    """Context manager which does nothing, used in place of Profiler.stage when not profiling
+    (and of the BundleWriter lock when not writing in the background)."""
+    yield
+
+
 def makeBundlesDictFromList(bundleList):
     """Utility to convert a list of MetricBundles into a dictionary, keyed by the fileRoot names.
 
@@ -75,9 +90,54 @@ class MetricBundleGroup(object):
         If False, metric values will only be saved after summary statistics are calculated.
     dbTable : Optional[str]
         The name of the table in the dbObj to query for data.
+    resultCache : Optional[ResultCache]
+        A store of previously calculated metric values. If set, the metric values for bundles found
+        in the cache are read instead of being calculated, and newly calculated values are added to it.
+    profiler : Optional[Profiler]
+        If set, the time and memory used by each stage of running the MetricBundles (query, stackers,
+        slicer setup, metrics, reduce, summary statistics, write and plot) are recorded in the profiler,
+        and written (by runAll and plotAll, or writeProfile) to the resultsDb and to profile.json and
+        profile.csv in the outDir.
+    backgroundWrite : Optional[bool]
+        If True, metric bundles are written to disk (and recorded in the resultsDb) by a BundleWriter
+        in a background thread, while the next metrics are calculated. runAll and writeAll wait for
+        the writes to finish (and raise any errors); call flush to do so after runCurrent or writeCurrent.
+        Default False.
+    maxWriteQueue : Optional[int]
+        The maximum number of metric bundles waiting to be written in the background (runs wait
+        for the writer when this is reached). Default 20.
+    checkpoint : Optional[bool]
+        If True, the metric values of each compatible list of MetricBundles are saved (with a record of
+        the progress) in outDir/checkpoint as soon as they are calculated, so that an interrupted runAll
+        can be continued with runAll(resume=True). The checkpoint is deleted when runAll finishes.
+        Default False.
+    checkpointEvery : Optional[int]
+        If checkpointing, also save the partly calculated metric values every checkpointEvery slicePoints,
+        so that resuming continues from the last of these. Default None.
+    maxMemory : Optional[float]
+        If set, the metric values held in memory are limited to about maxMemory bytes: when there are
+        more, the metric values of the least recently used MetricBundles are spilled to disk (in outDir)
+        by a MemoryBudget, and paged back in when they are used (by reduce, summary statistics, plots,
+        or any other code). This keeps the metric values for plotAll and summaryAll without holding
+        them all in memory. Default None (no limit).
+    workQueue : Optional[WorkQueue]
+        If set, runAll calculates the metric values in parallel, with any number of WorkQueueWorkers (in
+        other processes, on any nodes which share the filesystem of the work queue). This group is the
+        coordinator: it queries the data and sets up the slicers, puts a task in the work queue for each
+        chunkSize slicePoints of each compatible list of MetricBundles (for all constraints), and then
+        collects the metric values calculated by the workers (running tasks itself while it waits),
+        running the reduce methods and summary statistics and writing the resultsDb as usual.
+        Tasks whose worker dies are run again by another worker when their lease expires.
+        The work queue is cleared (emptied) when runAll finishes: until then, a new coordinator using the
+        same work queue reuses the results of the tasks which were finished. Can't be used with checkpoint.
+        Default None.
+    chunkSize : Optional[int]
+        The number of slicePoints in each task, if using a workQueue. Default 10000.
     """
     def __init__(self, bundleDict, dbObj, outDir='.', resultsDb=None, verbose=True,
-                 saveEarly=True, dbTable='Summary'):
+                 saveEarly=True, dbTable='Summary', resultCache=None, profiler=None,
+                 backgroundWrite=False, maxWriteQueue=20, checkpoint=False, checkpointEvery=None,
+                 maxMemory=None, workQueue=None, chunkSize=10000):
         """Set up the MetricBundleGroup.
         """
         # Print occasional messages to screen.
@@ -109,6 +169,29 @@ class MetricBundleGroup(object):
             if not isinstance(resultsDb, db.ResultsDb):
                 raise ValueError('resultsDb should be an ResultsDb object')
         self.resultsDb = resultsDb
+        self.resultCache = resultCache
+        # Count the metric evaluations saved by calculating duplicate metrics only once.
+        self.evalsSaved = 0
+        self.profiler = profiler
+        self.currentConstraint = None
+        if backgroundWrite:
+            self.writer = BundleWriter(self.outDir, resultsDb=self.resultsDb, maxQueue=maxWriteQueue)
+        else:
+            self.writer = None
+        if checkpoint:
+            self.checkpoint = Checkpoint(os.path.join(self.outDir, 'checkpoint'), every=checkpointEvery)
+        else:
+            self.checkpoint = None
+        if checkpoint and workQueue is not None:
+            raise ValueError('A checkpoint can not be used with a workQueue (which keeps the finished tasks).')
+        self.workQueue = workQueue
+        self.chunkSize = chunkSize
+        if maxMemory is not None:
+            self.memoryBudget = MemoryBudget(self.outDir, maxMemory)
+            for b in self.bundleDict.itervalues():
+                self.memoryBudget.add(b)
+        else:
+            self.memoryBudget = None
 
         # Dict to keep track of what's been run:
         self.hasRun = {}
@@ -122,6 +205,73 @@ class MetricBundleGroup(object):
         newdict = {key: origdict.get(key) for key in subsetkeys}
         return newdict
 
+    def _profile(self, stage, name=''):
+        """Private utility to return a context manager recording a stage in the profiler (if profiling).
+        """
+        if self.profiler is None:
+            return _nullContext()
+        return self.profiler.stage(stage, name=name, sqlConstraint=self.currentConstraint)
+
+    def _resultsDbLock(self):
+        """Private utility to return a context manager to hold while using the resultsDb
+        (so it is not used at the same time by the background writer).
+        """
+        if self.writer is None:
+            return _nullContext()
+        return self.writer.lock
+
+    def _write(self, b):
+        """Private utility to write a MetricBundle to disk (in the background, if using backgroundWrite).
+        """
+        with self._profile('write', b.fileRoot):
+            if self.writer is None:
+                b.write(outDir=self.outDir, resultsDb=self.resultsDb)
+            else:
+                self.writer.write(b)
+
+    def _enforceMemoryBudget(self, keep=None):
+        """Private utility to spill metric values to disk, if using a memory budget and it is exceeded.
+        """
+        if self.memoryBudget is None:
+            return
+        with self._profile('spill'):
+            self.memoryBudget.enforce(keep=keep)
+
+    def _manageMemory(self, b):
+        """Private utility to add a (new or newly read) MetricBundle to the memory budget, if using one.
+        """
+        if self.memoryBudget is None:
+            return
+        self.memoryBudget.add(b)
+        self._enforceMemoryBudget(keep=b)
+
+    def flush(self):
+        """Wait for the MetricBundles being written in the background (if using backgroundWrite) to be written.
+
+        Raises
+        ------
+        RuntimeError
+            If any of the MetricBundles could not be written.
+        """
+        if self.writer is None:
+            return
+        with self._profile('flush'):
+            self.writer.flush()
+        if self.verbose:
+            print 'Wrote %d metric bundles in the background (%d repeated writes combined).' \
+                % (self.writer.nWritten, self.writer.nCoalesced)
+
+    def writeProfile(self):
+        """Write the profile (if profiling) to the resultsDb and to profile.json and profile.csv in the outDir.
+        """
+        if self.profiler is None:
+            return
+        self.profiler.writeJson(os.path.join(self.outDir, 'profile.json'))
+        self.profiler.writeCsv(os.path.join(self.outDir, 'profile.csv'))
+        if self.resultsDb is not None:
+            with self._resultsDbLock():
+                self.profiler.writeResultsDb(self.resultsDb)
+
     def setCurrent(self, constraint):
         """Utility to set the currentBundleDict (i.e. a set of metricBundles with the same SQL constraint).
 
@@ -132,6 +282,7 @@ class MetricBundleGroup(object):
             included in a subset identified as the currentBundleDict.
             These are the active metrics to be calculated and plotted, etc.
         """
+        self.currentConstraint = constraint
         self.currentBundleDict = {}
         for k, b in self.bundleDict.iteritems():
             if b.constraint == constraint:
@@ -197,7 +348,7 @@ class MetricBundleGroup(object):
                 compatibleLists.append([k, ])
         self.compatibleLists = compatibleLists
 
-    def runAll(self, clearMemory=False, plotNow=False, plotKwargs=None):
+    def runAll(self, clearMemory=False, plotNow=False, plotKwargs=None, resume=False):
         """Runs all the metricBundles in the metricBundleGroup, over all constraints.
 
         Calculates metric values, then runs reduce functions and summary statistics for
@@ -211,13 +362,156 @@ class MetricBundleGroup(object):
             If True, plots the metric values immediately after calculation.
         plotKwargs : Optional[kwargs]
             kwargs to pass to plotCurrent.
+        resume : Optional[bool]
+            If True, continue a checkpointed run which was interrupted: the metric values of the
+            MetricBundles finished in that run are read from the checkpoint instead of being calculated
+            (and the data for constraints where all bundles were finished is not queried), and partly
+            calculated metric values are continued from the last saved slicePoint. Implies checkpoint.
+            (With a workQueue, the results of the tasks finished before are always reused instead).
+            Default False.
+        """
+        if resume and self.checkpoint is None and self.workQueue is None:
+            self.checkpoint = Checkpoint(os.path.join(self.outDir, 'checkpoint'))
+        if self.checkpoint is not None:
+            if resume:
+                self.checkpoint.read()
+            else:
+                # Start again.
+                self.checkpoint.clear()
+        if self.workQueue is not None:
+            self._runDistributed(clearMemory=clearMemory, plotNow=plotNow, plotKwargs=plotKwargs)
+        else:
+            for constraint in self.constraints:
+                # Set the 'currentBundleDict' which is a dictionary of the metricBundles which match this
+                #  constraint.
+                self.setCurrent(constraint)
+                self.runCurrent(constraint, clearMemory=clearMemory,
+                                plotNow=plotNow, plotKwargs=plotKwargs)
+        # Wait for any metric bundles still being written.
+        self.flush()
+        if self.memoryBudget is not None and self.verbose:
+            print 'Spilled metric values to disk %d times (to keep within the memory budget).' \
+                % (self.memoryBudget.nSpilled)
+        self.writeProfile()
+        # The run is complete, so the checkpoint is no longer needed.
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+
+    def _runDistributed(self, clearMemory=False, plotNow=False, plotKwargs=None):
+        """Run all the metricBundles, over all constraints, with the workers of the workQueue.
+
+        The tasks for all the constraints are put in the work queue first, so that the workers can run
+        them all in parallel; then the metric values are collected, constraint by constraint.
         """
+        submitted = OrderedDict()
         for constraint in self.constraints:
-            # Set the 'currentBundleDict' which is a dictionary of the metricBundles which match this
-            #  constraint.
             self.setCurrent(constraint)
-            self.runCurrent(constraint, clearMemory=clearMemory,
-                            plotNow=plotNow, plotKwargs=plotKwargs)
+            submitted[constraint] = self._submitCurrent(constraint)
+        worker = WorkQueueWorker(self.workQueue, self.dbObj, verbose=self.verbose)
+        for constraint, (resultKeys, compatibleLists) in submitted.iteritems():
+            if compatibleLists is None:
+                # There was no data for this constraint.
+                continue
+            self.setCurrent(constraint)
+            self.resultKeys = resultKeys
+            for bDict, runDict, duplicateKeys, tasks in compatibleLists:
+                self._collectCompatible(bDict, runDict, duplicateKeys, tasks, worker)
+            self._finishCurrent(clearMemory=clearMemory, plotNow=plotNow, plotKwargs=plotKwargs)
+        if self.verbose:
+            print 'Ran %d tasks of the work queue here.' % (worker.nRun)
+        # The run is complete, so the tasks are no longer needed.
+        self.workQueue.clear()
+
+    def _submitCurrent(self, constraint):
+        """Query the data for the currentBundleDict, set up the slicers, and put a task in the workQueue for
+        each chunkSize slicePoints of each compatible list of MetricBundles.
+
+        Returns the result cache keys of the bundles, and, for each compatible list, the bundles, the bundles
+        to run and their duplicates (see _setupCompatible), and the (task id, start, stop) of each task
+        (or None, if the data could not be queried).
+        """
+        self.dbCols = []
+        for b in self.currentBundleDict.itervalues():
+            self.dbCols.extend(b.dbCols)
+        self.dbCols = sorted(set(self.dbCols))
+        self.simData = None
+        compatibleLists = []
+        try:
+            with self._profile('query'):
+                self.getData(constraint)
+        except UserWarning:
+            warnings.warn('No data matching constraint %s' % constraint)
+            return {}, None
+        except ValueError:
+            warnings.warn('One of the columns requested from the database was not available.' +
+                          ' Skipping constraint %s' % constraint)
+            return {}, None
+        with self._profile('resultCache'):
+            cachedKeys = self._readResultCache()
+        self._findCompatibleLists()
+        for compatibleList in self.compatibleLists:
+            compatibleList = [key for key in compatibleList if key not in cachedKeys]
+            if len(compatibleList) == 0 or len(self.simData) == 0:
+                continue
+            # The metric values are set up as they are collected (so they are limited by any memory budget).
+            bDict, slicer, runDict, duplicateKeys = self._setupCompatible(compatibleList, setupMetricValues=False)
+            # The slicer may be shared with the bundles of a later constraint, and set up again for them before
+            # these bundles are collected: give these bundles their own copy of the set-up slicer.
+            slicer = copy(slicer)
+            slicer.slicePoints = dict(slicer.slicePoints)
+            for b in bDict.itervalues():
+                b.slicer = slicer
+            # The workers make their own slicer (with the same arguments) and bundles,
+            # so only send their configuration.
+            task = {'constraint': constraint, 'dbTable': self.dbTable, 'dbCols': self.dbCols,
+                    'slicer': slicer.getInitArgs(), 'nslice': slicer.nslice,
+                    'keys': [b.fileRoot for b in runDict.itervalues()],
+                    'bundles': [(b.metric, b.stackerList, b.mapsList) for b in runDict.itervalues()]}
+            tasks = []
+            for start in xrange(0, slicer.nslice, self.chunkSize):
+                task['start'] = start
+                task['stop'] = min(start + self.chunkSize, slicer.nslice)
+                tasks.append((self.workQueue.put(task), task['start'], task['stop']))
+            if self.verbose:
+                print 'Queued %d tasks for: ' % (len(tasks)), compatibleList
+            compatibleLists.append((bDict, runDict, duplicateKeys, tasks))
+        # The workers query the data for themselves.
+        self.simData = None
+        self.fieldData = None
+        return self.resultKeys, compatibleLists
+
+    def _collectCompatible(self, bDict, runDict, duplicateKeys, tasks, worker):
+        """Collect the metric values calculated by the workers for a compatible list of MetricBundles
+        (running the tasks not yet claimed by a worker with worker, rather than waiting).
+        """
+        for b in runDict.itervalues():
+            b._setupMetricValues()
+        taskIds = [taskId for taskId, start, stop in tasks]
+        pending = list(tasks)
+        nRun = 0
+        while len(pending) > 0:
+            finished = [(taskId, start, stop) for taskId, start, stop in pending if self.workQueue.isDone(taskId)]
+            if len(finished) == 0:
+                with self._profile('workQueue'):
+                    if not worker.runOne(taskIds=taskIds):
+                        time.sleep(self.workQueue.pollInterval)
+                continue
+            for taskId, start, stop in finished:
+                result = self.workQueue.getResult(taskId)
+                for i, b in enumerate(runDict.itervalues()):
+                    b.metricValues.data[start:stop] = result['data%d' % i]
+                    b.metricValues.mask[start:stop] = result['mask%d' % i]
+                nRun += int(result['nRun'])
+                pending.remove((taskId, start, stop))
+        if self.verbose:
+            print 'Collected metric values for: ', bDict.keys()
+        self._finishCompatible(bDict, runDict, duplicateKeys, nRun)
+        for key, b in bDict.iteritems():
+            if self.resultCache is not None:
+                with self._profile('resultCache', b.fileRoot):
+                    self.resultCache.put(self.resultKeys[key], b)
+            self.hasRun[key] = True
+        self._enforceMemoryBudget()
 
     def runCurrent(self, constraint, simData=None, clearMemory=False, plotNow=False, plotKwargs=None):
         """Run all the metricBundles which match this constraint in the metricBundleGroup.
@@ -246,15 +540,23 @@ class MetricBundleGroup(object):
             self.dbCols.extend(b.dbCols)
         self.dbCols = list(set(self.dbCols))
 
+        # Read the metric values of bundles finished before an interruption, if resuming a checkpointed run.
+        resumedKeys = self._readCheckpoint()
+
         # Can pass simData directly (if had other method for getting data)
         if simData is not None:
             self.simData = simData
 
+        elif len(resumedKeys) == len(self.currentBundleDict):
+            # All of the metric values were read from the checkpoint: no need for the data.
+            self.simData = None
+
         else:
             self.simData = None
             # Query for the data.
             try:
-                self.getData(constraint)
+                with self._profile('query'):
+                    self.getData(constraint)
             except UserWarning:
                 warnings.warn('No data matching constraint %s' % constraint)
                 return
@@ -263,18 +565,43 @@ class MetricBundleGroup(object):
                               ' Skipping constraint %s' % constraint)
                 return
 
+        # Read the metric values which were calculated before, if using a result cache.
+        with self._profile('resultCache'):
+            cachedKeys = self._readResultCache(skipKeys=resumedKeys)
+
         # Find compatible subsets of the MetricBundle dictionary,
         # which can be run/metrics calculated/ together.
         self._findCompatibleLists()
 
         for compatibleList in self.compatibleLists:
+            compatibleList = [key for key in compatibleList if key not in cachedKeys and key not in resumedKeys]
+            if len(compatibleList) == 0:
+                continue
             if self.verbose:
                 print 'Running: ', compatibleList
             self._runCompatible(compatibleList)
             if self.verbose:
                 print 'Completed metric generation.'
+            if self.resultCache is not None and len(self.simData) > 0:
+                for key in compatibleList:
+                    with self._profile('resultCache', self.currentBundleDict[key].fileRoot):
+                        self.resultCache.put(self.resultKeys[key], self.currentBundleDict[key])
+            if self.checkpoint is not None and len(self.simData) > 0:
+                # Bundles in the checkpoint are not written again on resuming: they must be written
+                # (if written in the background) before they are recorded there.
+                if self.saveEarly:
+                    self.flush()
+                with self._profile('checkpoint'):
+                    self.checkpoint.finish([self.currentBundleDict[key] for key in compatibleList])
             for key in compatibleList:
                 self.hasRun[key] = True
+            self._enforceMemoryBudget()
+        self._finishCurrent(clearMemory=clearMemory, plotNow=plotNow, plotKwargs=plotKwargs)
+
+    def _finishCurrent(self, clearMemory=False, plotNow=False, plotKwargs=None):
+        """Run the reduce methods and summary statistics (and optionally plot, and clear the metric values
+        from memory) for the currentBundleDict, after calculating the metric values.
+        """
         # Run the reduce methods.
         if self.verbose:
             print 'Running reduce methods.'
@@ -333,6 +660,61 @@ class MetricBundleGroup(object):
         else:
             self.fieldData = None
 
+    def _readCheckpoint(self):
+        """Read the metric values for the bundles in the currentBundleDict which were finished in an
+        interrupted run, from the checkpoint.
+
+        Returns the bundleDict keys of the bundles which were found in the checkpoint.
+        """
+        resumedKeys = set()
+        if self.checkpoint is None:
+            return resumedKeys
+        for k, b in self.currentBundleDict.iteritems():
+            result = self.checkpoint.getFinished(b)
+            if result is None:
+                continue
+            b.metricValues, b.slicer = result
+            self.hasRun[k] = True
+            resumedKeys.add(k)
+        if self.verbose and len(resumedKeys) > 0:
+            print 'Read %d metric bundles from the checkpoint.' % (len(resumedKeys))
+        return resumedKeys
+
+    def _readResultCache(self, skipKeys=()):
+        """Read the metric values for the bundles in the currentBundleDict from the result cache.
+
+        Sets self.resultKeys, the cache key of each bundle.
+        Returns the bundleDict keys of the bundles which were found in the cache (leaving out skipKeys).
+        """
+        self.resultKeys = {}
+        cachedKeys = set()
+        if self.resultCache is None or self.simData is None:
+            return cachedKeys
+        colHashes = {}
+        for k, b in self.currentBundleDict.iteritems():
+            if k in skipKeys:
+                continue
+            # Identify the data by the (database) columns the bundle uses.
+            cols = sorted(set([col for col in b.dbCols if col in self.simData.dtype.names]))
+            for col in cols:
+                if col not in colHashes:
+                    colHashes[col] = utils.configHash(self.simData[col])
+            dataHash = utils.configHash([(col, colHashes[col]) for col in cols])
+            self.resultKeys[k] = self.resultCache.key(b, dataHash)
+            result = self.resultCache.get(self.resultKeys[k])
+            if result is None:
+                if self.verbose:
+                    print 'Result cache miss for %s' % (k)
+                continue
+            if self.verbose:
+                print 'Result cache hit for %s' % (k)
+            b.metricValues, b.slicer = result
+            if self.saveEarly:
+                self._write(b)
+            self.hasRun[k] = True
+            cachedKeys.add(k)
+        return cachedKeys
+
     def _runCompatible(self, compatibleList):
         """Runs a set of 'compatible' metricbundles in the MetricBundleGroup dictionary,
         identified by 'compatibleList' keys.
@@ -348,6 +730,26 @@ class MetricBundleGroup(object):
         if len(self.simData) == 0:
             return
 
+        bDict, slicer, runDict, duplicateKeys = self._setupCompatible(compatibleList)
+        # Continue from the last checkpoint, if these metrics were partly calculated before an interruption.
+        startSlice = 0
+        checkpointEvery = None
+        if self.checkpoint is not None:
+            startSlice = self.checkpoint.restorePartial(runDict.values())
+            if self.verbose and startSlice > 0:
+                print 'Continuing from slicePoint %d of the checkpoint.' % (startSlice)
+            checkpointEvery = self.checkpoint.every
+        nRun = self._runSlices(runDict, slicer, start=startSlice, checkpointEvery=checkpointEvery)
+        self._finishCompatible(bDict, runDict, duplicateKeys, nRun)
+
+    def _setupCompatible(self, compatibleList, setupMetricValues=True):
+        """Run the stackers, and set up the slicer and the metric values, for a compatible list of MetricBundles.
+
+        Returns the bundles in the compatible list, the (set up) slicer, the bundles to run (one for each
+        distinct metric) and the keys of the bundles which duplicate them (with the key of the bundle
+        each duplicates). If setupMetricValues is False, the metric values of the bundles to run are
+        not set up (allocated) yet.
+        """
         # Grab a dictionary representation of this subset of the dictionary, for easier iteration.
         bDict = self._getDictSubset(self.currentBundleDict, compatibleList)
 
@@ -374,25 +776,49 @@ class MetricBundleGroup(object):
         # Run stackers.
         for stacker in compatStackers:
             # Note that stackers will clobber previously existing rows with the same name.
-            self.simData = stacker.run(self.simData)
+            with self._profile('stacker', stacker.__class__.__name__):
+                self.simData = stacker.run(self.simData)
 
         # Pull out one of the slicers to use as our 'slicer'.
         # This will be forced back into all of the metricBundles at the end (so that they track
         #  the same metadata such as the slicePoints, in case the same actual object wasn't used).
         slicer = bDict.itervalues().next().slicer
-        if (slicer.slicerName == 'OpsimFieldSlicer'):
-            slicer.setupSlicer(self.simData, self.fieldData, maps=compatMaps)
-        else:
-            slicer.setupSlicer(self.simData, maps=compatMaps)
+        with self._profile('slicerSetup', slicer.slicerName):
+            if (slicer.slicerName == 'OpsimFieldSlicer'):
+                slicer.setupSlicer(self.simData, self.fieldData, maps=compatMaps)
+            else:
+                slicer.setupSlicer(self.simData, maps=compatMaps)
         # Copy the slicer (after setup) back into the individual metricBundles.
         if slicer.slicerName != 'HealpixSlicer' or slicer.slicerName != 'UniSlicer':
             for b in bDict.itervalues():
                 b.slicer = slicer
 
+        # Bundles whose metrics do the same calculation (differing only in their names, plotDicts, etc.)
+        # are only calculated once: find one bundle to run for each distinct metric.
+        runKeys = OrderedDict()
+        duplicateKeys = {}
+        for k, b in bDict.iteritems():
+            metricHash = utils.metricHash(b.metric)
+            if metricHash in runKeys:
+                duplicateKeys[k] = runKeys[metricHash]
+            else:
+                runKeys[metricHash] = k
+        runDict = self._getDictSubset(bDict, runKeys.values())
+
         # Set up (masked) arrays to store metric data in each metricBundle.
-        for b in bDict.itervalues():
-            b._setupMetricValues()
+        if setupMetricValues:
+            for b in runDict.itervalues():
+                b._setupMetricValues()
+        return bDict, slicer, runDict, duplicateKeys
+
+    def _runSlices(self, runDict, slicer, start=0, stop=None, checkpointEvery=None):
+        """Calculate the metric values of the MetricBundles in runDict at slicePoints start to stop
+        (default, the last slicePoint), saving them in the checkpoint every checkpointEvery slicePoints.
 
+        Returns the number of slicePoints where the metrics were run (rather than found in the slicer cache).
+        """
+        if stop is None:
+            stop = slicer.nslice
         # Set up an ordered dictionary to be the cache if needed:
         # (Currently using OrderedDict, it might be faster to use 2 regular Dicts instead)
         if slicer.cacheSize > 0:
@@ -400,43 +826,78 @@ class MetricBundleGroup(object):
             cache = True
         else:
             cache = False
+        # Count the slicepoints where the metrics are run, and where the cache is used.
+        nRun = 0
+        nCached = 0
+        # If profiling, record the time taken by each metric at each slicepoint.
+        profile = self.profiler is not None
+        if profile:
+            callTimes = dict([(k, []) for k in runDict])
         # Run through all slicepoints and calculate metrics.
-        for i, slice_i in enumerate(slicer):
-            slicedata = self.simData[slice_i['idxs']]
-            if len(slicedata) == 0:
-                # No data at this slicepoint. Mask data values.
-                for b in bDict.itervalues():
-                    b.metricValues.mask[i] = True
-            else:
-                # There is data! Should we use our data cache?
-                if cache:
-                    # Make the data idxs hashable.
-                    cacheKey = frozenset(slice_i['idxs'])
-                    # If key exists, set flag to use it, otherwise add it
-                    if cacheKey in cacheDict:
-                        useCache = True
-                        cacheVal = cacheDict[cacheKey]
-                        # Move this value to the end of the OrderedDict
-                        del cacheDict[cacheKey]
-                        cacheDict[cacheKey] = cacheVal
-                    else:
-                        cacheDict[cacheKey] = i
-                        useCache = False
-                    for b in bDict.itervalues():
-                        if useCache:
-                            b.metricValues.data[i] = b.metricValues.data[cacheDict[cacheKey]]
-                        else:
-                            b.metricValues.data[i] = b.metric.run(slicedata, slicePoint=slice_i['slicePoint'])
-                    # If we are above the cache size, drop the oldest element from the cache dict.
-                    if len(cacheDict) > slicer.cacheSize:
-                        del cacheDict[cacheDict.keys()[0]]
-
-                # Not using memoize, just calculate things normally
+        with self._profile('runMetrics', slicer.slicerName):
+            for i, idxs, slicePoint in slicer.iterSlices(start=start):
+                if i >= stop:
+                    break
+                slicedata = self.simData[idxs]
+                if len(slicedata) == 0:
+                    # No data at this slicepoint. Mask data values.
+                    for b in runDict.itervalues():
+                        b.metricValues.mask[i] = True
                 else:
-                    for b in bDict.itervalues():
-                        b.metricValues.data[i] = b.metric.run(slicedata, slicePoint=slice_i['slicePoint'])
+                    # There is data! Should we use our data cache?
+                    if cache:
+                        # Make the data idxs hashable.
+                        cacheKey = frozenset(idxs)
+                        # If key exists, set flag to use it, otherwise add it
+                        if cacheKey in cacheDict:
+                            useCache = True
+                            cacheVal = cacheDict[cacheKey]
+                            # Move this value to the end of the OrderedDict
+                            del cacheDict[cacheKey]
+                            cacheDict[cacheKey] = cacheVal
+                            nCached += 1
+                        else:
+                            cacheDict[cacheKey] = i
+                            useCache = False
+                            nRun += 1
+                        for k, b in runDict.iteritems():
+                            if useCache:
+                                b.metricValues.data[i] = b.metricValues.data[cacheDict[cacheKey]]
+                            else:
+                                if profile:
+                                    callStart = time.time()
+                                b.metricValues.data[i] = b.metric.run(slicedata, slicePoint=slicePoint)
+                                if profile:
+                                    callTimes[k].append(time.time() - callStart)
+                        # If we are above the cache size, drop the oldest element from the cache dict.
+                        if len(cacheDict) > slicer.cacheSize:
+                            del cacheDict[cacheDict.keys()[0]]
+
+                    # Not using memoize, just calculate things normally
+                    else:
+                        nRun += 1
+                        for k, b in runDict.iteritems():
+                            if profile:
+                                callStart = time.time()
+                            b.metricValues.data[i] = b.metric.run(slicedata, slicePoint=slicePoint)
+                            if profile:
+                                callTimes[k].append(time.time() - callStart)
+                if checkpointEvery and (i + 1) % checkpointEvery == 0 and i + 1 < slicer.nslice:
+                    with self._profile('checkpoint'):
+                        self.checkpoint.savePartial(runDict.values(), i + 1)
+        if profile:
+            for k in runDict:
+                self.profiler.addCallTimes('metric', runDict[k].fileRoot, self.currentConstraint, callTimes[k])
+            if cache:
+                self.profiler.addCacheStats(slicer.slicerName, self.currentConstraint, nCached, nRun)
+        return nRun
+
+    def _finishCompatible(self, bDict, runDict, duplicateKeys, nRun):
+        """Mask the metric values which could not be calculated, share the metric values with the duplicate
+        bundles and (if saveEarly) write the bundles in a compatible list, after calculating the metric values.
+        """
         # Mask data where metrics could not be computed (according to metric bad value).
-        for b in bDict.itervalues():
+        for b in runDict.itervalues():
             if b.metricValues.dtype.name == 'object':
                 for ind, val in enumerate(b.metricValues.data):
                     if val is b.metric.badval:
@@ -446,10 +907,19 @@ class MetricBundleGroup(object):
                 b.metricValues.mask = np.where(b.metricValues.data == b.metric.badval,
                                                True, b.metricValues.mask)
 
+        # Share the metric values with the duplicate bundles.
+        for k, runKey in duplicateKeys.iteritems():
+            bDict[k].metricValues = ma.copy(bDict[runKey].metricValues)
+        if len(duplicateKeys) > 0:
+            self.evalsSaved += nRun * len(duplicateKeys)
+            if self.verbose:
+                print 'Calculated %d duplicate metrics once, saving %d metric evaluations.' \
+                    % (len(duplicateKeys), nRun * len(duplicateKeys))
+
         # Save data to disk as we go, although this won't keep summary values, etc. (just failsafe).
         if self.saveEarly:
             for b in bDict.itervalues():
-                b.write(outDir=self.outDir, resultsDb=self.resultsDb)
+                self._write(b)
 
     def reduceAll(self, updateSummaries=True):
         """Run the reduce methods for all metrics in bundleDict.
@@ -484,14 +954,16 @@ class MetricBundleGroup(object):
             if len(b.metric.reduceFuncs) > 0:
                 # Apply reduce functions, creating a new metricBundle in the process (new metric values).
                 for reduceFunc in b.metric.reduceFuncs.itervalues():
-                    newmetricbundle = b.reduceMetric(reduceFunc)
+                    with self._profile('reduce', b.fileRoot):
+                        newmetricbundle = b.reduceMetric(reduceFunc)
                     # Add the new metricBundle to our metricBundleGroup dictionary.
                     name = newmetricbundle.metric.name
                     if name in self.bundleDict:
                         name = newmetricbundle.fileRoot
                     reduceBundleDict[name] = newmetricbundle
+                    self._manageMemory(newmetricbundle)
                     if self.saveEarly:
-                        newmetricbundle.write(outDir=self.outDir, resultsDb=self.resultsDb)
+                        self._write(newmetricbundle)
                 # Remove summaryMetrics from top level metricbundle if desired.
                 if updateSummaries:
                     b.summaryMetrics = []
@@ -514,7 +986,9 @@ class MetricBundleGroup(object):
         """Run summary statistics on all the metricBundles in the currently active set of MetricBundles.
         """
         for b in self.currentBundleDict.itervalues():
-            b.computeSummaryStats(self.resultsDb)
+            with self._profile('summary', b.fileRoot), self._resultsDbLock():
+                b.computeSummaryStats(self.resultsDb)
+            self._enforceMemoryBudget()
 
     def plotAll(self, savefig=True, outfileSuffix=None, figformat='pdf', dpi=600, thumbnail=True,
                 closefigs=True):
@@ -547,6 +1021,7 @@ class MetricBundleGroup(object):
             self.setCurrent(constraint)
             self.plotCurrent(savefig=savefig, outfileSuffix=outfileSuffix, figformat=figformat, dpi=dpi,
                              thumbnail=thumbnail, closefigs=closefigs)
+        self.writeProfile()
 
     def plotCurrent(self, savefig=True, outfileSuffix=None, figformat='pdf', dpi=600, thumbnail=True,
                     closefigs=True):
@@ -573,9 +1048,11 @@ class MetricBundleGroup(object):
         plotHandler = PlotHandler(outDir=self.outDir, resultsDb=self.resultsDb,
                                   savefig=savefig, figformat=figformat, dpi=dpi, thumbnail=thumbnail)
         for b in self.currentBundleDict.itervalues():
-            b.plot(plotHandler=plotHandler, outfileSuffix=outfileSuffix, savefig=savefig)
-            if closefigs:
-                plt.close('all')
+            with self._profile('plot', b.fileRoot), self._resultsDbLock():
+                b.plot(plotHandler=plotHandler, outfileSuffix=outfileSuffix, savefig=savefig)
+                if closefigs:
+                    plt.close('all')
+            self._enforceMemoryBudget()
         if self.verbose:
             print 'Plotting complete.'
 
@@ -587,6 +1064,7 @@ class MetricBundleGroup(object):
         for constraint in self.constraints:
             self.setCurrent(constraint)
             self.writeCurrent()
+        self.flush()
 
     def writeCurrent(self):
         """Save all the MetricBundles in the currently active set to disk.
@@ -597,70 +1075,91 @@ class MetricBundleGroup(object):
             else:
                 print 'Saving metric bundles.'
         for b in self.currentBundleDict.itervalues():
-            b.write(outDir=self.outDir, resultsDb=self.resultsDb)
+            self._write(b)
+
+    def _dataFile(self, fileRoot):
+        """Return the metric data file for fileRoot in outDir (the JSON header, or an older npz file)."""
+        filename = os.path.join(self.outDir, fileRoot + '.json')
+        npzFilename = os.path.join(self.outDir, fileRoot + '.npz')
+        if not os.path.isfile(filename) and os.path.isfile(npzFilename):
+            return npzFilename
+        return filename
 
-    def readAll(self):
+    def readAll(self, lazy=False, nThreads=None):
         """Attempt to read all MetricBundles from disk.
 
         You must set the metrics/slicer/constraint/runName for a metricBundle appropriately;
-        then this method will search for files in the location self.outDir/metricBundle.fileRoot.
+        then this method will search for files in the location self.outDir/metricBundle.fileRoot
+        (the .json header of the .npy files, or an .npz file written by earlier versions).
         Reads all the files associated with all metricbundles in self.bundleDict.
+
+        The files are read through the metricFileCache, so files already read in this process are not read again.
+
+        Parameters
+        ----------
+        lazy : bool, optional
+            If True, only look for the files now: the metricValues of each MetricBundle are read from its file
+            when they are first used. Default False (read all the files now, in parallel threads).
+        nThreads : int, optional
+            The number of threads used to read the files. Default metricFileCache.nThreads.
         """
         reduceBundleDict = {}
+        # Find the file for each bundle, and for the 'reduce' bundles of complex metrics.
+        bundleFiles = []
         for b in self.bundleDict.itervalues():
-            filename = os.path.join(self.outDir, b.fileRoot + '.npz')
-            try:
-                # Create a temporary metricBundle to read the data into.
-                #  (we don't use b directly, as this overrides plotDict/etc).
-                tmpBundle = createEmptyMetricBundle()
-                tmpBundle.read(filename)
-                # Copy the tmpBundle metricValues into b.
-                b.metricValues = ma.copy(tmpBundle.metricValues)
-                del tmpBundle
-            except:
-                warnings.warn('Warning: file %s not found, bundle not restored.' % filename)
-
-                # Look to see if this is a complex metric, with associated 'reduce' functions,
-                # and read those in too.
-                if len(b.metric.reduceFuncs) > 0:
-                    origMetricName = b.metric.name
-                    for reduceFunc in b.metric.reduceFuncs.itervalues():
-                        reduceName = origMetricName + '_' + reduceFunc.__name__.replace('reduce', '')
-                        # Borrow the fileRoot in b (we'll reset it appropriately afterwards).
-                        b.metric.name = reduceName
-                        b._buildFileRoot()
-                        filename = os.path.join(self.outDir, b.fileRoot + '.npz')
-                        tmpBundle = createEmptyMetricBundle()
-                        try:
-                            tmpBundle.read(filename)
-                            # This won't necessarily recreate the plotDict and displayDict exactly
-                            # as they would have been made if you calculated the reduce metric from scratch.
-                            # Perhaps update these metric reduce dictionaries after reading them in?
-                            newmetricBundle = MetricBundle(metric=b.metric, slicer=b.slicer,
-                                                           constraint=b.constraint,
-                                                           stackerList=b.stackerList, runName=b.runName,
-                                                           metadata=b.metadata,
-                                                           plotDict=b.plotDict, displayDict=b.displayDict,
-                                                           summaryMetrics=b.summaryMetrics,
-                                                           mapsList=b.mapsList,
-                                                           fileRoot=b.fileRoot, plotFuncs=b.plotFuncs)
-                            newmetricBundle.metric.name = reduceName
-                            newmetricBundle.metricValues = ma.copy(tmpBundle.metricValues)
-                            del tmpBundle
-
-                            # Add the new metricBundle to our metricBundleGroup dictionary.
-                            name = newmetricBundle.metric.name
-                            if name in self.bundleDict:
-                                name = newmetricBundle.fileRoot
-                            reduceBundleDict[name] = newmetricBundle
-                        except:
-                            warnings.warn('Warning: file %s not found, bundle not restored.' % filename)
-
-                    # Remove summaryMetrics from top level metricbundle.
-                    b.summaryMetrics = []
-                    # Update parent MetricBundle name.
-                    b.metric.name = origMetricName
+            bundleFiles.append((b, self._dataFile(b.fileRoot)))
+            # Look to see if this is a complex metric, with associated 'reduce' functions,
+            # and read those in too.
+            if len(b.metric.reduceFuncs) > 0:
+                origMetricName = b.metric.name
+                for reduceFunc in b.metric.reduceFuncs.itervalues():
+                    reduceName = origMetricName + '_' + reduceFunc.__name__.replace('reduce', '')
+                    # Borrow the fileRoot in b (we'll reset it appropriately afterwards).
+                    b.metric.name = reduceName
                     b._buildFileRoot()
+                    filename = self._dataFile(b.fileRoot)
+                    if not os.path.isfile(filename):
+                        warnings.warn('Warning: file %s not found, bundle not restored.' % filename)
+                        continue
+                    # This won't necessarily recreate the plotDict and displayDict exactly
+                    # as they would have been made if you calculated the reduce metric from scratch.
+                    # Perhaps update these metric reduce dictionaries after reading them in?
+                    # (The metric is copied so that resetting the name of b below doesn't rename it).
+                    newmetricBundle = MetricBundle(metric=copy(b.metric), slicer=b.slicer,
+                                                   constraint=b.constraint,
+                                                   stackerList=b.stackerList, runName=b.runName,
+                                                   metadata=b.metadata,
+                                                   plotDict=b.plotDict, displayDict=b.displayDict,
+                                                   summaryMetrics=b.summaryMetrics,
+                                                   mapsList=b.mapsList,
+                                                   fileRoot=b.fileRoot, plotFuncs=b.plotFuncs)
+                    # Add the new metricBundle to our metricBundleGroup dictionary.
+                    name = newmetricBundle.metric.name
+                    if name in self.bundleDict:
+                        name = newmetricBundle.fileRoot
+                    reduceBundleDict[name] = newmetricBundle
+                    bundleFiles.append((newmetricBundle, filename))
+                # Remove summaryMetrics from top level metricbundle.
+                b.summaryMetrics = []
+                # Update parent MetricBundle name.
+                b.metric.name = origMetricName
+                b._buildFileRoot()
+        if lazy:
+            for b, filename in bundleFiles:
+                if os.path.isfile(filename):
+                    b.setMetricFile(filename)
+                    self._manageMemory(b)
+                else:
+                    warnings.warn('Warning: file %s not found, bundle not restored.' % filename)
+        else:
+            restored = metricFileCache.readFiles([filename for b, filename in bundleFiles], nThreads=nThreads)
+            for (b, filename), r in zip(bundleFiles, restored):
+                if isinstance(r, Exception):
+                    warnings.warn('Warning: file %s not found, bundle not restored.' % filename)
+                    continue
+                # Give b its own (copy-on-write) metricValues, rather than the shared, read-only ones.
+                b.metricValues = writableValues(r[0])
+                self._manageMemory(b)
                 if self.verbose:
                     print 'Read %s from disk.' % (b.fileRoot)
         # Add the reduce bundles into the bundleDict.
@@ -0,0 +1,176 @@
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import numpy.ma as ma
+
+import lsst.sims.maf.slicers as slicers
+
+__all__ = ['MetricFileCache', 'metricFileCache', 'writableValues']
+
+
+class MetricFileCache(object):
+    """
+    Cache of the metric data files (written by BaseSlicer.writeData) read in this process.
+
+    Each file is read once (with BaseSlicer.readData) and its metric values, slicer and header are kept
+    for later requests, so the pages of showMaf and repeated reads of the same output directory don't
+    re-read the files. A file is read again if it changes on disk. The most recently used files are kept,
+    up to maxBytes of metric values in total.
+
+    The cached metric values are read-only and shared: use writableValues for metric values which can be changed.
+
+    Parameters
+    ----------
+    maxBytes : float, optional
+        The maximum total size of the cached metric values, in bytes. Default 1GB.
+    nThreads : int, optional
+        The number of threads used to read files in readFiles. Default 8.
+    """
+    def __init__(self, maxBytes=1e9, nThreads=8):
+        self.maxBytes = maxBytes
+        self.nThreads = nThreads
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, filename):
+        """Identify a file by its path, size and modification time (raises OSError if missing)."""
+        stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+
+    def read(self, filename):
+        """
+        Read a metric data file.
+
+        Parameters
+        ----------
+        filename : str
+            The metric data file.
+
+        Returns
+        -------
+        numpy.ma.MaskedArray, BaseSlicer, dict
+            The (read-only) metric values, the slicer and the header, as from BaseSlicer.readData.
+        """
+        if not os.path.isfile(filename):
+            raise IOError('%s not found' % filename)
+        key = self._key(filename)
+        with self._lock:
+            if key in self._files:
+                # Move this file to the end of the OrderedDict (the most recently used).
+                restored = self._files.pop(key)
+                self._files[key] = restored
+                self.hits += 1
+                return restored
+        metricValues, slicer, header = slicers.BaseSlicer().readData(filename)
+        metricValues.fill_value = slicer.badval
+        metricValues.setflags(write=False)
+        if metricValues.mask is not None and metricValues.mask.ndim > 0:
+            metricValues.mask.setflags(write=False)
+        restored = (metricValues, slicer, header)
+        with self._lock:
+            if key not in self._files:
+                self._files[key] = restored
+                self.nbytes += metricValues.nbytes
+                self.misses += 1
+            restored = self._files[key]
+            # Drop the least recently used files until below maxBytes (always keeping this one).
+            while self.nbytes > self.maxBytes and len(self._files) > 1:
+                oldKey, oldRestored = self._files.popitem(last=False)
+                self.nbytes -= oldRestored[0].nbytes
+        return restored
+
+    def readFiles(self, filenames, nThreads=None):
+        """
+        Read many metric data files, in parallel threads.
+
+        Parameters
+        ----------
+        filenames : list of str
+            The metric data files.
+        nThreads : int, optional
+            The number of threads. Default self.nThreads.
+
+        Returns
+        -------
+        list
+            For each file, the (metric values, slicer, header) tuple from read,
+            or the exception raised while reading it.
+        """
+        if nThreads is None:
+            nThreads = self.nThreads
+
+        def _read(filename):
+            try:
+                return self.read(filename)
+            except Exception as e:
+                return e
+
+        nThreads = min(nThreads, len(filenames))
+        if nThreads <= 1:
+            return [_read(filename) for filename in filenames]
+        pool = ThreadPool(nThreads)
+        try:
+            return pool.map(_read, filenames)
+        finally:
+            pool.close()
+            pool.join()
+
+    def clear(self):
+        """Drop all of the cached files."""
+        with self._lock:
+            self._files = OrderedDict()
+            self.nbytes = 0
+
+
+def writableValues(metricValues):
+    """
+    Return metric values (read through the metricFileCache) which can be changed.
+
+    Memory-mapped (.npy) metric values are mapped again from their files (copy-on-write), so
+    the values are shared with the cache until they are changed, and only the changed pages are
+    copied. Other (npz) metric values are copied.
+
+    Parameters
+    ----------
+    metricValues : numpy.ma.MaskedArray
+        The (read-only) metric values from MetricFileCache.read.
+
+    Returns
+    -------
+    numpy.ma.MaskedArray
+        The metric values, for a single user.
+    """
+    data = _remap(ma.getdata(metricValues))
+    if data is None:
+        return ma.copy(metricValues)
+    mask = ma.getmask(metricValues)
+    if mask is not ma.nomask:
+        remapped = _remap(mask)
+        mask = np.array(mask) if remapped is None else remapped
+    return ma.MaskedArray(data=data, mask=mask, fill_value=metricValues.fill_value)
+
+
+def _remap(array):
+    """Return a new copy-on-write memory map of the .npy file array is mapped from (or None)."""
+    base = array
+    while base is not None and not isinstance(base, np.memmap):
+        base = getattr(base, 'base', None)
+    filename = getattr(base, 'filename', None)
+    if filename is None or not os.path.isfile(filename):
+        return None
+    try:
+        remapped = np.load(filename, mmap_mode='c')
+    except (IOError, ValueError):
+        return None
+    if remapped.shape != array.shape or remapped.dtype != array.dtype:
+        return None
+    return np.array(remapped, copy=False)
+
+
+# The cache shared by all of the metric bundles in this process.
+metricFileCache = MetricFileCache()
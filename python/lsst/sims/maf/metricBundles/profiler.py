@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import json
+import csv
+import resource
+from contextlib import contextmanager
+import numpy as np
+
+__all__ = ['Profiler']
+
+
+def _cpuTime():
+    """Return the (user + system) CPU time used by this process, in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _peakMemory():
+    """Return the peak memory (maximum resident set size) used by this process so far, in MB."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X, in kB elsewhere.
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0**2
+    return maxrss / 1024.0
+
+
+class Profiler(object):
+    """
+    Record the time and memory used by each stage of running a MetricBundleGroup.
+
+    Pass a Profiler to the MetricBundleGroup to profile it. The stages recorded are the database
+    query, each stacker, the slicer setup, each metric (the total time and the distribution of the
+    time per slicePoint), the reduce functions, summary statistics, writing and plotting of each
+    metricBundle, as well as the hit rate of the slicer cache.
+
+    Each stage is recorded as a row (a dictionary) in self.rows, with keys:
+    stage, name (such as the stacker or metricBundle name), sqlConstraint,
+    wallTime and cpuTime (seconds), peakMemory (the peak memory of the process at the end of the
+    stage, MB), memoryGrowth (the increase of the peak memory during the stage, MB), nCalls,
+    medianTime and maxTime (seconds per call) and cacheHitRate. Values which were not measured are None.
+    The peak memory is that of the whole process, so memoryGrowth is only non-zero for the stages
+    which reached a new peak.
+
+    The rows can be written to a ResultsDb (the profile table) and to JSON or CSV files.
+    """
+    columns = ['stage', 'name', 'sqlConstraint', 'wallTime', 'cpuTime', 'peakMemory', 'memoryGrowth',
+               'nCalls', 'medianTime', 'maxTime', 'cacheHitRate']
+
+    def __init__(self):
+        self.rows = []
+        # The number of rows already written to the resultsDb.
+        self._nWritten = 0
+
+    def _addRow(self, stage, name, sqlConstraint, **kwargs):
+        row = dict([(col, None) for col in self.columns])
+        row.update(stage=stage, name=name, sqlConstraint=sqlConstraint, **kwargs)
+        self.rows.append(row)
+
+    @contextmanager
+    def stage(self, stage, name='', sqlConstraint=None):
+        """
+        Context manager to record the time and memory used by the code within it.
+
+        Parameters
+        ----------
+        stage : str
+            The stage being run (such as 'query' or 'plot').
+        name : str, optional
+            What is being run (such as the stacker or metricBundle name).
+        sqlConstraint : str, optional
+            The sql constraint of the metricBundles being run.
+        """
+        wallStart = time.time()
+        cpuStart = _cpuTime()
+        memStart = _peakMemory()
+        try:
+            yield
+        finally:
+            peakMemory = _peakMemory()
+            self._addRow(stage, name, sqlConstraint, wallTime=time.time() - wallStart,
+                         cpuTime=_cpuTime() - cpuStart, peakMemory=peakMemory,
+                         memoryGrowth=peakMemory - memStart, nCalls=1)
+
+    def addCallTimes(self, stage, name, sqlConstraint, callTimes):
+        """
+        Record a stage run as many separate calls (such as a metric run at each slicePoint).
+
+        Parameters
+        ----------
+        stage : str
+            The stage being run (such as 'metric').
+        name : str
+            What is being run (such as the metricBundle name).
+        sqlConstraint : str
+            The sql constraint of the metricBundles being run.
+        callTimes : list of float
+            The (wall clock) time taken by each call, in seconds.
+        """
+        callTimes = np.asarray(callTimes, float)
+        if len(callTimes) == 0:
+            self._addRow(stage, name, sqlConstraint, wallTime=0.0, nCalls=0)
+        else:
+            self._addRow(stage, name, sqlConstraint, wallTime=float(callTimes.sum()),
+                         nCalls=len(callTimes), medianTime=float(np.median(callTimes)),
+                         maxTime=float(callTimes.max()))
+
+    def addCacheStats(self, name, sqlConstraint, hits, misses):
+        """
+        Record the use of a cache (such as the slicer cache).
+
+        Parameters
+        ----------
+        name : str
+            The name of the cache (such as the slicer name).
+        sqlConstraint : str
+            The sql constraint of the metricBundles being run.
+        hits : int
+            The number of lookups found in the cache.
+        misses : int
+            The number of lookups not found in the cache.
+        """
+        nCalls = hits + misses
+        cacheHitRate = None
+        if nCalls > 0:
+            cacheHitRate = hits / float(nCalls)
+        self._addRow('cache', name, sqlConstraint, nCalls=nCalls, cacheHitRate=cacheHitRate)
+
+    def totals(self):
+        """
+        Return the total wall clock time of each stage, in seconds, as a dictionary.
+        """
+        totals = {}
+        for row in self.rows:
+            if row['wallTime'] is not None:
+                totals[row['stage']] = totals.get(row['stage'], 0.0) + row['wallTime']
+        return totals
+
+    def writeResultsDb(self, resultsDb):
+        """
+        Add the rows recorded since the last call to the profile table of a ResultsDb.
+
+        Parameters
+        ----------
+        resultsDb : ResultsDb
+            The results database.
+        """
+        for row in self.rows[self._nWritten:]:
+            resultsDb.updateProfile(**row)
+        self._nWritten = len(self.rows)
+
+    def writeJson(self, filename):
+        """
+        Write all of the rows to a JSON file (a list of dictionaries).
+
+        Parameters
+        ----------
+        filename : str
+            The output file.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.rows, f, indent=1)
+
+    def writeCsv(self, filename):
+        """
+        Write all of the rows to a CSV file (with a header line; values which were not measured are empty).
+
+        Parameters
+        ----------
+        filename : str
+            The output file.
+        """
+        with open(filename, 'wb') as f:
+            writer = csv.DictWriter(f, self.columns)
+            writer.writeheader()
+            writer.writerows(self.rows)
@@ -0,0 +1,142 @@
+import os
+import glob
+import numpy as np
+
+import lsst.sims.maf.slicers as slicers
+from lsst.sims.maf.utils import configHash, metricHash, getDateVersion
+
+__all__ = ['ResultCache']
+
+
+class ResultCache(object):
+    """
+    A store of metric values on disk, shared between runs and keyed by the content of the calculation.
+
+    The key for a MetricBundle is a hash of its metric (class and configuration), its slicer
+    (class, slicer_init and slicePoints), its constraint, stackers and maps, a hash of the simData
+    columns it uses and the MAF version. So when an identical bundle is run again on the same data
+    (in any MetricBundleGroup using this cache), its metric values can be read rather than calculated.
+    Metric values are only as reproducible as the metric configuration: metrics which depend on
+    anything besides their (public) attributes and the data should not be cached.
+
+    The metric values are stored in the cache directory in the single file npz format (see
+    BaseSlicer.writeData), one file per key. When the files total more than maxSize bytes, the least
+    recently used files are deleted.
+
+    Parameters
+    ----------
+    cacheDir : str
+        The directory to hold the cached metric values.
+    maxSize : float, optional
+        The maximum total size of the cached files, in bytes. Default 2GB.
+    """
+    def __init__(self, cacheDir, maxSize=2e9):
+        self.cacheDir = cacheDir
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, metricBundle, dataHash):
+        """
+        Calculate the cache key for a MetricBundle.
+
+        Parameters
+        ----------
+        metricBundle : MetricBundle
+            The metric bundle (before it is run).
+        dataHash : str
+            A hash of the simData columns used by the bundle.
+
+        Returns
+        -------
+        str
+            The cache key.
+        """
+        slicer = metricBundle.slicer
+        mapNames = list(getattr(metricBundle.metric, 'maps', []))
+        content = {'metric': [metricBundle.metric.__class__.__name__, metricHash(metricBundle.metric)],
+                   'slicer': [slicer.slicerName, configHash(slicer.slicer_init),
+                              configHash(slicer.slicePoints),
+                              getattr(slicer, 'useCamera', None), getattr(slicer, 'chipsToUse', None)],
+                   'constraint': metricBundle.constraint,
+                   'stackers': sorted([configHash(s) for s in metricBundle.stackerList]),
+                   'maps': sorted([configHash(m) for m in metricBundle.mapsList]) + sorted(mapNames),
+                   'data': dataHash,
+                   'version': getDateVersion()[1]['__version__']}
+        return configHash(content)
+
+    def _filename(self, key):
+        return os.path.join(self.cacheDir, key + '.npz')
+
+    def get(self, key):
+        """
+        Read the metric values for key from the cache.
+
+        Parameters
+        ----------
+        key : str
+            The cache key (see key).
+
+        Returns
+        -------
+        numpy.ma.MaskedArray, BaseSlicer
+            The metric values and the slicer they were calculated with, or None if key is not in the cache.
+        """
+        filename = self._filename(key)
+        if os.path.isfile(filename):
+            try:
+                metricValues, slicer, header = slicers.BaseSlicer().readData(filename)
+            except (IOError, ValueError, KeyError, EOFError):
+                # Treat unreadable files (such as those being written by another process) as misses.
+                metricValues = None
+            if metricValues is not None:
+                metricValues.fill_value = slicer.badval
+                # Mark the file as recently used.
+                os.utime(filename, None)
+                self.hits += 1
+                return metricValues, slicer
+        self.misses += 1
+        return None
+
+    def put(self, key, metricBundle):
+        """
+        Add the metric values of a MetricBundle (which has been run) to the cache.
+
+        Parameters
+        ----------
+        key : str
+            The cache key (see key), calculated before the bundle was run.
+        metricBundle : MetricBundle
+            The metric bundle.
+        """
+        filename = self._filename(key)
+        # Write to a temporary file first, so other processes never see a partly written file.
+        tmpFilename = filename.replace('.npz', '.%d.tmp.npz' % os.getpid())
+        metricBundle.slicer.writeData(tmpFilename, metricBundle.metricValues,
+                                      metricName=metricBundle.metric.name,
+                                      simDataName=metricBundle.runName,
+                                      constraint=metricBundle.constraint,
+                                      metadata=metricBundle.metadata)
+        os.rename(tmpFilename, filename)
+        self._evict()
+
+    def _evict(self):
+        """Delete the least recently used files until the cache is no larger than maxSize."""
+        filenames = [f for f in glob.glob(os.path.join(self.cacheDir, '*.npz')) if not f.endswith('.tmp.npz')]
+        stats = [os.stat(f) for f in filenames]
+        sizes = np.array([s.st_size for s in stats], float)
+        if sizes.sum() <= self.maxSize:
+            return
+        order = np.argsort([s.st_mtime for s in stats])
+        excess = sizes.sum() - self.maxSize
+        for i in order:
+            if excess <= 0:
+                break
+            try:
+                os.remove(filenames[i])
+            except OSError:
+                # Already removed (by another process).
+                pass
+            excess -= sizes[i]
@@ -0,0 +1,435 @@
+import os
+import time
+import errno
+import socket
+import cPickle
+import threading
+import warnings
+import traceback
+import numpy as np
+
+import lsst.sims.maf.utils as utils
+
+__all__ = ['WorkQueue', 'WorkQueueWorker']
+
+
+class WorkQueue(object):
+    """
+    A queue of tasks in a directory, shared by processes (on any nodes) which can see the same filesystem.
+
+    Each task (a pickled dict) is a file in queueDir/tasks, named by the hash of the task. A worker claims
+    a task by creating its lock file in queueDir/locks (which only one worker can do), and holds it by
+    renewing the lease: if the lock file is not touched for leaseTime seconds, the worker is assumed to
+    have died and another worker can claim the task. The result of a task is written to queueDir/results
+    (and the error, if the task failed, to queueDir/errors). All files are written to a temporary file
+    which is then renamed, so they are never seen part-written.
+
+    Tasks which are put again (by a new coordinator using the same queueDir) are not run again if their
+    result is already in the queue.
+
+    Parameters
+    ----------
+    queueDir : str
+        The queue directory (on a filesystem shared by the coordinator and the workers).
+    leaseTime : float, optional
+        The time (in seconds) after which a task whose lease has not been renewed can be claimed by
+        another worker. Default 600.
+    pollInterval : float, optional
+        The time (in seconds) between looking for tasks (or results), when waiting. Default 5.
+    """
+    _subdirs = ['tasks', 'locks', 'results', 'errors']
+
+    def __init__(self, queueDir, leaseTime=600., pollInterval=5.):
+        self.queueDir = queueDir
+        self.leaseTime = leaseTime
+        self.pollInterval = pollInterval
+        self._makeDirs()
+
+    def _makeDirs(self):
+        for subdir in self._subdirs:
+            path = os.path.join(self.queueDir, subdir)
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST or not os.path.isdir(path):
+                    raise
+
+    def _filename(self, subdir, taskId, ext):
+        return os.path.join(self.queueDir, subdir, taskId + ext)
+
+    def _atomicWrite(self, filename, write):
+        """Write a file with write(tmpFilename), then rename it to filename."""
+        tmpFilename = '%s.%s.%d.tmp' % (filename, socket.gethostname(), os.getpid())
+        write(tmpFilename)
+        os.rename(tmpFilename, filename)
+
+    def _now(self):
+        """Return the current time according to the shared filesystem (the clocks of the nodes may differ)."""
+        clockFile = os.path.join(self.queueDir, 'locks', 'clock.%s.%d' % (socket.gethostname(), os.getpid()))
+        with open(clockFile, 'w'):
+            pass
+        now = os.stat(clockFile).st_mtime
+        os.remove(clockFile)
+        return now
+
+    def put(self, task):
+        """
+        Add a task to the queue (unless it has already been added).
+
+        Parameters
+        ----------
+        task : dict
+            The task (which must be picklable).
+
+        Returns
+        -------
+        str
+            The task id.
+        """
+        taskId = utils.configHash(task)
+        filename = self._filename('tasks', taskId, '.pkl')
+        if not os.path.isfile(filename):
+            def write(tmpFilename):
+                with open(tmpFilename, 'wb') as f:
+                    cPickle.dump(task, f, protocol=cPickle.HIGHEST_PROTOCOL)
+            self._atomicWrite(filename, write)
+        # Run a task which failed before again.
+        errorFile = self._filename('errors', taskId, '.txt')
+        if os.path.isfile(errorFile):
+            os.remove(errorFile)
+        return taskId
+
+    def getTask(self, taskId):
+        """Read a task."""
+        with open(self._filename('tasks', taskId, '.pkl'), 'rb') as f:
+            return cPickle.load(f)
+
+    def taskIds(self):
+        """Return the ids of all of the tasks in the queue."""
+        if not os.path.isdir(os.path.join(self.queueDir, 'tasks')):
+            # The queue directory has been removed.
+            return []
+        return sorted([filename[:-len('.pkl')] for filename in os.listdir(os.path.join(self.queueDir, 'tasks'))
+                       if filename.endswith('.pkl')])
+
+    def isDone(self, taskId):
+        """Return True if the task has finished (with a result or an error)."""
+        return (os.path.isfile(self._filename('results', taskId, '.npz')) or
+                os.path.isfile(self._filename('errors', taskId, '.txt')))
+
+    def claim(self, workerId, taskIds=None):
+        """
+        Claim a task which has not finished, and is not being run by another (live) worker.
+
+        Parameters
+        ----------
+        workerId : str
+            The id of the worker claiming the task.
+        taskIds : list of str, optional
+            Only claim one of these tasks. Default all the tasks in the queue.
+
+        Returns
+        -------
+        str
+            The id of the claimed task, or None if there are no tasks to claim.
+        """
+        if taskIds is None:
+            taskIds = self.taskIds()
+        now = None
+        for taskId in taskIds:
+            if self.isDone(taskId):
+                continue
+            lockFile = self._filename('locks', taskId, '.lock')
+            if os.path.isfile(lockFile):
+                if now is None:
+                    now = self._now()
+                try:
+                    lockStat = os.stat(lockFile)
+                except OSError:
+                    # Released in the meantime.
+                    lockStat = None
+                if lockStat is not None:
+                    if now - lockStat.st_mtime <= self.leaseTime:
+                        continue
+                    # The worker holding the lock stopped renewing it: break the lock, and try to claim the task.
+                    self._breakLock(lockFile, lockStat, workerId)
+            try:
+                fd = os.open(lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            os.write(fd, workerId)
+            os.close(fd)
+            # The task may have finished between checking and claiming it.
+            if self.isDone(taskId):
+                self.release(taskId, workerId)
+                continue
+            return taskId
+        return None
+
+    def _breakLock(self, lockFile, lockStat, workerId):
+        """
+        Remove an expired lock file, whose os.stat was lockStat.
+
+        Other workers may be breaking the same lock, and one may already have broken it and made a new
+        lock: if the lock file renamed away is not the expired one, it is put back.
+        """
+        brokenFile = '%s.expired.%s' % (lockFile, workerId)
+        try:
+            os.rename(lockFile, brokenFile)
+        except OSError:
+            # Another worker broke the lock first (or it was released).
+            return
+        try:
+            brokenStat = os.stat(brokenFile)
+            if (brokenStat.st_ino, brokenStat.st_mtime) != (lockStat.st_ino, lockStat.st_mtime):
+                # A new lock (or the old one, renewed just in time): put it back, unless there is yet
+                # another new lock.
+                os.link(brokenFile, lockFile)
+        except OSError:
+            pass
+        finally:
+            try:
+                os.remove(brokenFile)
+            except OSError:
+                pass
+
+    def _holds(self, taskId, workerId):
+        try:
+            with open(self._filename('locks', taskId, '.lock'), 'r') as f:
+                return f.read() == workerId
+        except IOError:
+            return False
+
+    def renew(self, taskId, workerId):
+        """
+        Renew the lease of a claimed task.
+
+        Returns
+        -------
+        bool
+            False if the task is no longer held by this worker (its lease expired).
+        """
+        if not self._holds(taskId, workerId):
+            return False
+        try:
+            os.utime(self._filename('locks', taskId, '.lock'), None)
+        except OSError:
+            return False
+        return True
+
+    def release(self, taskId, workerId):
+        """Release a claimed task (if it is still held by this worker)."""
+        if self._holds(taskId, workerId):
+            try:
+                os.remove(self._filename('locks', taskId, '.lock'))
+            except OSError:
+                pass
+
+    def complete(self, taskId, workerId, result):
+        """
+        Save the result of a task, and release it.
+
+        Parameters
+        ----------
+        taskId : str
+            The task id.
+        workerId : str
+            The id of the worker which ran the task.
+        result : dict of numpy.ndarray
+            The result (saved with numpy.savez).
+        """
+        if not os.path.isfile(self._filename('tasks', taskId, '.pkl')):
+            # The queue was cleared (the task was also run by another worker, and the run has finished).
+            return
+        def write(tmpFilename):
+            with open(tmpFilename, 'wb') as f:
+                np.savez(f, **result)
+        self._atomicWrite(self._filename('results', taskId, '.npz'), write)
+        self.release(taskId, workerId)
+
+    def fail(self, taskId, workerId, message):
+        """Save the error from a task which failed, and release it."""
+        if not os.path.isfile(self._filename('tasks', taskId, '.pkl')):
+            return
+        def write(tmpFilename):
+            with open(tmpFilename, 'w') as f:
+                f.write('Worker %s: %s' % (workerId, message))
+        self._atomicWrite(self._filename('errors', taskId, '.txt'), write)
+        self.release(taskId, workerId)
+
+    def getResult(self, taskId):
+        """
+        Read the result of a finished task.
+
+        Raises
+        ------
+        RuntimeError
+            If the task failed.
+        """
+        errorFile = self._filename('errors', taskId, '.txt')
+        if os.path.isfile(errorFile):
+            with open(errorFile, 'r') as f:
+                raise RuntimeError('Task %s failed.\n%s' % (taskId, f.read()))
+        with np.load(self._filename('results', taskId, '.npz'), allow_pickle=True) as restored:
+            return dict([(name, restored[name]) for name in restored.files])
+
+    def clear(self):
+        """Delete all of the tasks, with their locks, results and errors (the queue can then be used again)."""
+        for subdir in self._subdirs:
+            path = os.path.join(self.queueDir, subdir)
+            if not os.path.isdir(path):
+                continue
+            for filename in os.listdir(path):
+                try:
+                    os.remove(os.path.join(path, filename))
+                except OSError as e:
+                    # Files may also be removed by workers (or another clear).
+                    if e.errno != errno.ENOENT:
+                        raise
+        self._makeDirs()
+
+
+class WorkQueueWorker(object):
+    """
+    Run the metric calculation tasks put in a WorkQueue by a MetricBundleGroup (see MetricBundleGroup workQueue).
+
+    Each task calculates the metric values of a compatible list of MetricBundles at a range of slicePoints.
+    The worker queries the data for each task from its own dbObj (so this should connect to the same database
+    as the coordinator's), keeping the data for the last constraint for the next task.
+
+    Parameters
+    ----------
+    workQueue : WorkQueue
+        The work queue.
+    dbObj : Database
+        The database to query for the data.
+    workerId : str, optional
+        An id for this worker (unique among the workers). Default hostname.pid.
+    verbose : bool, optional
+        Print the tasks run. Default False.
+    """
+    def __init__(self, workQueue, dbObj, workerId=None, verbose=False):
+        self.workQueue = workQueue
+        self.dbObj = dbObj
+        if workerId is None:
+            workerId = '%s.%d' % (socket.gethostname(), os.getpid())
+        self.workerId = workerId
+        self.verbose = verbose
+        self.nRun = 0
+        # The data for the last constraint queried: (constraint, dbTable, dbCols), simData and fieldData.
+        self._dataKey = None
+        self._data = None
+
+    def run(self, wait=False):
+        """
+        Run tasks from the queue, until there are none left.
+
+        Parameters
+        ----------
+        wait : bool, optional
+            If True, wait for new tasks (looking every workQueue.pollInterval seconds) instead of stopping
+            when there are none left, until killed. Default False.
+        """
+        while True:
+            if not self.runOne():
+                if not wait:
+                    return
+                time.sleep(self.workQueue.pollInterval)
+
+    def runOne(self, taskIds=None):
+        """
+        Claim and run one task from the queue.
+
+        Parameters
+        ----------
+        taskIds : list of str, optional
+            Only run one of these tasks. Default any task in the queue.
+
+        Returns
+        -------
+        bool
+            True if a task was run, False if there were none to claim.
+        """
+        taskId = self.workQueue.claim(self.workerId, taskIds=taskIds)
+        if taskId is None:
+            return False
+        # Renew the lease while the task runs, so no other worker claims it.
+        stop = threading.Event()
+
+        def renewLease():
+            while not stop.wait(self.workQueue.leaseTime / 4.):
+                if not self.workQueue.renew(taskId, self.workerId):
+                    return
+        renewer = threading.Thread(target=renewLease, name='WorkQueueLease')
+        renewer.daemon = True
+        renewer.start()
+        try:
+            task = self.workQueue.getTask(taskId)
+            if self.verbose:
+                print 'Running task %s: %s (slicePoints %d to %d, constraint %s)' \
+                    % (taskId, task['keys'], task['start'], task['stop'], task['constraint'])
+            result = self.runTask(task)
+        except Exception:
+            result = None
+            error = traceback.format_exc()
+        finally:
+            stop.set()
+            renewer.join()
+        try:
+            if result is None:
+                self.workQueue.fail(taskId, self.workerId, error)
+            else:
+                self.workQueue.complete(taskId, self.workerId, result)
+                self.nRun += 1
+        except (IOError, OSError) as e:
+            # The queue was cleared (the task was also run by another worker, and the run has finished).
+            warnings.warn('Could not save the result of task %s: %s' % (taskId, e))
+        return True
+
+    def runTask(self, task):
+        """
+        Calculate the metric values of a task.
+
+        Returns
+        -------
+        dict of numpy.ndarray
+            The metric values ('data%d') and mask ('mask%d') of each MetricBundle in the task,
+            at the task's slicePoints, and the number of slicePoints where the metrics were run ('nRun').
+        """
+        # Avoid a circular import.
+        from .metricBundle import MetricBundle
+        from .metricBundleGroup import MetricBundleGroup
+        slicerClass, slicerArgs, slicerKwargs = task['slicer']
+        slicer = slicerClass(*slicerArgs, **slicerKwargs)
+        bundleDict = {}
+        for i, (metric, stackerList, mapsList) in enumerate(task['bundles']):
+            bundleDict[i] = MetricBundle(metric, slicer, task['constraint'], stackerList=stackerList,
+                                         mapsList=mapsList, fileRoot='task%d' % (i))
+        group = MetricBundleGroup(bundleDict, self.dbObj, outDir=self.workQueue.queueDir, verbose=False,
+                                  saveEarly=False, dbTable=task['dbTable'])
+        group.setCurrent(task['constraint'])
+        group.dbCols = task['dbCols']
+        dataKey = (task['constraint'], task['dbTable'], tuple(task['dbCols']))
+        if dataKey == self._dataKey:
+            group.simData, group.fieldData = self._data
+        else:
+            self._dataKey = None
+            self._data = None
+            group.getData(task['constraint'])
+            self._dataKey = dataKey
+        bDict, slicer, runDict, duplicateKeys = group._setupCompatible(bundleDict.keys())
+        # The stackers add columns to the data: keep these for the next task.
+        self._data = (group.simData, group.fieldData)
+        if slicer.nslice != task['nslice']:
+            raise ValueError('The slicer has %d slicePoints here, but %d for the coordinator: '
+                             'check that the database and slicer are the same.' % (slicer.nslice, task['nslice']))
+        nRun = group._runSlices(runDict, slicer, start=task['start'], stop=task['stop'])
+        result = {'nRun': np.array(nRun)}
+        for i, b in bundleDict.iteritems():
+            # Bundles the worker found to be duplicates share the metric values calculated for another.
+            metricValues = bundleDict[duplicateKeys.get(i, i)].metricValues
+            result['data%d' % i] = metricValues.data[task['start']:task['stop']]
+            result['mask%d' % i] = metricValues.mask[task['start']:task['stop']]
+        return result
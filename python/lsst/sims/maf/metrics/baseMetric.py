@@ -171,6 +171,21 @@ class BaseMetric(object):
         # Default to only return one metric value per slice
         self.shape = 1
 
+    def __getstate__(self):
+        """Return the state of the metric for pickling (the reduce functions are bound methods, which
+        can't be pickled, so are saved by name).
+        """
+        state = self.__dict__.copy()
+        state['reduceFuncs'] = dict([(reducename, reduceFunc.__name__)
+                                     for reducename, reduceFunc in self.reduceFuncs.iteritems()])
+        return state
+
+    def __setstate__(self, state):
+        """Restore the state of a pickled metric (binding the reduce functions to this metric)."""
+        self.__dict__.update(state)
+        self.reduceFuncs = dict([(reducename, getattr(self, funcName))
+                                 for reducename, funcName in self.reduceFuncs.iteritems()])
+
     def run(self, dataSlice, slicePoint=None):
         """Calculate metric values.
 
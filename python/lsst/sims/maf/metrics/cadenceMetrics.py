@@ -127,47 +127,52 @@ class SupernovaMetric(BaseMetric):
         ind = ind[good]
         right = right[good]
         left = left[good]
-        result = 0
-        # Record the maximum gap near the peak (in rest-frame days)
-        maxGap = []
+        nObs = right - left
+        nWindows = ind.size
+        # Expand each time window into the visits it contains, so the windows can be evaluated together.
+        window = np.repeat(np.arange(nWindows), nObs)
+        visitIdx = np.arange(window.size) - np.repeat(np.cumsum(nObs) - nObs, nObs) + np.repeat(left, nObs)
+        t = time[visitIdx] - finetime[ind][window] + self.Tmin
+        ufilters, filterIdx = np.unique(dataSlice[self.filterCol], return_inverse=True)
+        filterIdx = filterIdx[visitIdx]
+
+        nLess = np.bincount(window[np.where(t < self.Tless)], minlength=nWindows)
+        nMore = np.bincount(window[np.where(t > self.Tmore)], minlength=nWindows)
+        nFilters = self._countFilters(window, filterIdx, nWindows, ufilters.size)
+        # Count the filters observed near the peak deeper than the singleDepthLimit.
+        nearPeak = (t > self.Tless) & (t < self.Tmore)
+        bright = np.where(nearPeak & (dataSlice[self.m5Col][visitIdx] > self.singleDepthLimit))
+        filtersBrightEnough = self._countFilters(window[bright], filterIdx[bright], nWindows, ufilters.size)
+        # Record the maximum gap near the peak (in rest-frame days).
+        # The visits near the peak are consecutive within each window, as time is sorted.
+        nNearPeak = np.bincount(window[np.where(nearPeak)], minlength=nWindows)
+        maxGap = np.zeros(nWindows, dtype=float) + self.peakGap + 1e6
+        pairs = np.where(nearPeak[1:] & nearPeak[:-1] & (window[1:] == window[:-1]))[0]
+        if pairs.size > 0:
+            gaps = t[pairs + 1] - t[pairs]
+            starts = np.concatenate([[0], np.where(np.diff(window[pairs]) != 0)[0] + 1])
+            maxGap[window[pairs][starts]] = np.maximum.reduceat(gaps, starts)
+
+        good = np.where((nLess > self.Nless) & (nMore > self.Nmore) & (nObs > self.Nbetween) &
+                        (nFilters >= self.Nfilt) &  # XXX need to add snr cut here
+                        (filtersBrightEnough >= self.Nfilt) & (nNearPeak >= 2) &
+                        (maxGap < self.peakGap))[0]
+        if self.uniqueBlocks:
+            # Skip sequences starting before the end of the last counted sequence.
+            unique = []
+            right_side = -1
+            for i in good:
+                if i > right_side:
+                    unique.append(i)
+                    right_side = right[i]
+            good = np.array(unique, dtype=int)
         # Record the total number of observations in a sequence.
-        Nobs = []
-        right_side = -1
-        for i, index in enumerate(ind):
-            if i <= right_side:
-                pass
-            else:
-                visits = dataSlice[left[i]:right[i]]
-                t = time[left[i]:right[i]]
-                t = t - finetime[index] + self.Tmin
-
-                if np.size(np.where(t < self.Tless)[0]) > self.Nless:
-                    if np.size(np.where(t > self.Tmore)[0]) > self.Nmore:
-                        if np.size(t) > self.Nbetween:
-                            ufilters = np.unique(visits[self.filterCol])
-                            if np.size(ufilters) >= self.Nfilt:  # XXX need to add snr cut here
-                                filtersBrightEnough = 0
-                                nearPeak = np.where((t > self.Tless) & (t < self.Tmore))
-                                ufilters = np.unique(visits[self.filterCol][nearPeak])
-                                for f in ufilters:
-                                    if np.max(visits[self.m5Col][nearPeak]
-                                              [np.where(visits[self.filterCol][nearPeak] == f)]) \
-                                              > self.singleDepthLimit:
-                                        filtersBrightEnough += 1
-                                if filtersBrightEnough >= self.Nfilt:
-                                    if np.size(nearPeak) >= 2:
-                                        gaps = t[nearPeak][1:] - np.roll(t[nearPeak], 1)[1:]
-                                    else:
-                                        gaps = self.peakGap + 1e6
-                                    if np.max(gaps) < self.peakGap:
-                                        result += 1
-                                        if self.uniqueBlocks:
-                                            right_side = right[i]
-                                        maxGap.append(np.max(gaps))
-                                        Nobs.append(np.size(t))
-        maxGap = np.array(maxGap)
-        Nobs = np.array(Nobs)
-        return {'result': result, 'maxGap': maxGap, 'Nobs': Nobs}
+        return {'result': good.size, 'maxGap': maxGap[good], 'Nobs': nObs[good]}
+
+    def _countFilters(self, window, filterIdx, nWindows, nFilters):
+        """Count the number of unique filters in each window."""
+        observed = np.bincount(window * nFilters + filterIdx, minlength=nWindows * nFilters) > 0
+        return observed.reshape(nWindows, nFilters).sum(axis=1)
 
     def reduceMedianMaxGap(self, data):
         """The median maximum gap near the peak of the light curve """
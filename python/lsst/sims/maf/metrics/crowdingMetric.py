@@ -1,12 +1,110 @@
+import threading
 from lsst.sims.maf.metrics import BaseMetric
 import numpy as np
 from lsst.sims.maf.utils import m52snr
-from scipy.interpolate import interp1d
 
 # Modifying from Knut Olson's fork at:
 # https://github.com/knutago/sims_maf_contrib/blob/master/tutorials/CrowdingMetric.ipynb
 
-__all__ = ['CrowdingMetric', 'CrowdingMagUncertMetric']
+__all__ = ['CrowdingEngine', 'CrowdingMetric', 'CrowdingMagUncertMetric']
+
+
+class CrowdingEngine(object):
+    """
+    Compute the crowding errors for many healpixels of a stellar luminosity function map at once.
+
+    The luminosity function integral (which does not depend on the seeing) is computed for all of the
+    map healpixels when the engine is created, so crowding magnitudes and uncertainties can be
+    evaluated for any number of healpixels (each with its own seeing) in one call.
+    Equation from Olsen, Blum, & Rigaut 2003, AJ, 126, 452
+
+    Parameters
+    ----------
+    magVector : np.array
+        Stellar magnitudes (the map magnitude bins).
+    lumFunc : np.array
+        Stellar luminosity function of each healpixel, shape (number of healpixels, number of magnitudes).
+    lumAreaArcsec : float (3600**2)
+        The area of the map luminosity function units (square arcseconds).
+    """
+    def __init__(self, magVector, lumFunc, lumAreaArcsec=3600.0**2):
+        self.magVector = magVector
+        self.lumAreaArcsec = lumAreaArcsec
+        lumVector = 10**(-0.4*magVector)
+        lumFunc = np.atleast_2d(lumFunc)
+        myIntergral = (np.add.accumulate((lumVector**2*lumFunc)[:, ::-1], axis=1))[:, ::-1]
+        # The crowding error for each healpixel and magnitude is coeff(seeing) * self.temp.
+        self.temp = np.sqrt(myIntergral)/lumVector
+        # Values of temp interpolated to single magnitudes, by magnitude.
+        self._tempAt = {}
+
+    def _coeff(self, seeing):
+        return np.sqrt(np.pi/self.lumAreaArcsec)*seeing/2.
+
+    def _interpTemp(self, singleMag):
+        """Linearly interpolate temp to singleMag for all healpixels (as scipy's interp1d)."""
+        if singleMag not in self._tempAt:
+            if singleMag < self.magVector[0] or singleMag > self.magVector[-1]:
+                raise ValueError('Magnitude %f is outside the range of the luminosity function.' % singleMag)
+            hi = np.clip(np.searchsorted(self.magVector, singleMag), 1, len(self.magVector) - 1)
+            lo = hi - 1
+            slope = (self.temp[:, hi] - self.temp[:, lo]) / (self.magVector[hi] - self.magVector[lo])
+            self._tempAt[singleMag] = slope*(singleMag - self.magVector[lo]) + self.temp[:, lo]
+        return self._tempAt[singleMag]
+
+    def crowdError(self, seeing, pix, singleMag=None):
+        """
+        Compute the crowding errors.
+
+        Parameters
+        ----------
+        seeing : np.array
+            The seeing for each value (such as the best seeing at each healpixel, or the seeing of each visit).
+        pix : np.array
+            The luminosity function healpixel for each value of seeing.
+        singleMag : float (None)
+            If singleMag is None, the crowding error is calculated for each mag in magVector. If
+            singleMag is a float, the crowding error is interpolated to that single value.
+
+        Returns
+        -------
+        np.array
+            Magnitude uncertainties, shape (len(seeing), len(magVector)) or (len(seeing),) with singleMag.
+        """
+        coeff = self._coeff(np.asarray(seeing, float))
+        if singleMag is None:
+            return coeff[:, np.newaxis]*self.temp[pix]
+        return coeff*self._interpTemp(singleMag)[pix]
+
+    def crowdingMag(self, seeing, pix, crowding_error=0.1):
+        """
+        Compute the magnitudes of stars with a crowding error of crowding_error.
+
+        Parameters
+        ----------
+        seeing : np.array
+            The seeing at each healpixel.
+        pix : np.array
+            The luminosity function healpixels.
+        crowding_error : float (0.1)
+            The magnitude uncertainty from crowding. (mags)
+
+        Returns
+        -------
+        np.array
+            The magnitude where the crowding error is first above crowding_error (the previous bin),
+            or the faintest magnitude if it never is.
+        """
+        aboveCrowd = self.crowdError(seeing, pix) >= crowding_error
+        first = np.argmax(aboveCrowd, axis=1)
+        crowdMag = self.magVector[np.maximum(first - 1, 0)]
+        crowdMag = np.where(aboveCrowd.any(axis=1), crowdMag, self.magVector.max())
+        return crowdMag
+
+
+# Crowding engines for the stellar density map files (shared by all the crowding metrics).
+_engines = {}
+_enginesLock = threading.Lock()
 
 class CrowdingMetric(BaseMetric):
     """
@@ -35,6 +133,30 @@ class CrowdingMetric(BaseMetric):
         super(CrowdingMetric, self).__init__(col=cols, maps=maps, units=units, metricName=metricName, **kwargs)
 
 
+    def _engine(self, slicePoint):
+        """
+        Return the crowding engine and the luminosity function healpixel for a slicePoint.
+
+        The engine for the whole stellar density map is shared between metrics and slicePoints;
+        without the map information (such as a slicePoint from an older map), an engine is made
+        for this slicePoint alone.
+        """
+        if 'starMapPix' in slicePoint and 'starMapFile' in slicePoint:
+            key = (slicePoint['starMapFile'], self.lumAreaArcsec)
+            with _enginesLock:
+                engine = _engines.get(key)
+            if engine is None:
+                # The map arrays come from the (memory-mapped) map cache shared with StellarDensityMap.
+                from lsst.sims.maf.maps import mapCache
+                engine = CrowdingEngine(mapCache.get(slicePoint['starMapFile'], 'bins')[1:],
+                                        mapCache.get(slicePoint['starMapFile'], 'starDensity'),
+                                        lumAreaArcsec=self.lumAreaArcsec)
+                with _enginesLock:
+                    engine = _engines.setdefault(key, engine)
+            return engine, slicePoint['starMapPix']
+        return CrowdingEngine(slicePoint['starMapBins'][1:], slicePoint['starLumFunc'],
+                              lumAreaArcsec=self.lumAreaArcsec), 0
+
     def _compCrowdError(self, magVector, lumFunc, seeing, singleMag=None):
         """
         Compute the crowding error for each observation
@@ -60,33 +182,19 @@ class CrowdingMetric(BaseMetric):
 
         Equation from Olsen, Blum, & Rigaut 2003, AJ, 126, 452
         """
-        lumVector = 10**(-0.4*magVector)
-        coeff=np.sqrt(np.pi/self.lumAreaArcsec)*seeing/2.
-        myIntergral = (np.add.accumulate((lumVector**2*lumFunc)[::-1]))[::-1]
-        temp = np.sqrt(myIntergral)/lumVector
-        if singleMag is not None:
-            interp = interp1d(magVector, temp)
-            temp = interp(singleMag)
-
-        crowdError = coeff*temp
-
+        engine = CrowdingEngine(magVector, lumFunc, lumAreaArcsec=self.lumAreaArcsec)
+        seeing = np.atleast_1d(seeing)
+        crowdError = engine.crowdError(seeing, np.zeros(len(seeing), int), singleMag=singleMag)
+        if singleMag is None:
+            crowdError = crowdError[0]
         return crowdError
 
     def run(self, dataSlice, slicePoint=None):
-
-        magVector = slicePoint['starMapBins'][1:]
-        lumFunc = slicePoint['starLumFunc']
-
-        crowdError =self._compCrowdError(magVector, lumFunc, seeing=min(dataSlice[self.seeingCol]) )
-
+        engine, pix = self._engine(slicePoint)
         # Locate at which point crowding error is greater than user-defined limit
-        aboveCrowd = np.where(crowdError >= self.crowding_error)[0]
-
-        if np.size(aboveCrowd) == 0:
-            return max(magVector)
-        else:
-            crowdMag = magVector[max(aboveCrowd[0]-1,0)]
-            return crowdMag
+        crowdMag = engine.crowdingMag(np.array([min(dataSlice[self.seeingCol])]), np.array([pix]),
+                                      crowding_error=self.crowding_error)
+        return crowdMag[0]
 
 class CrowdingMagUncertMetric(CrowdingMetric):
     """
@@ -112,12 +220,10 @@ class CrowdingMagUncertMetric(CrowdingMetric):
                                                       **kwargs)
 
     def run(self, dataSlice, slicePoint=None):
-
-        magVector = slicePoint['starMapBins'][1:]
-        lumFunc = slicePoint['starLumFunc']
+        engine, pix = self._engine(slicePoint)
         # Magnitude uncertainty given crowding
-        dmagCrowd = self._compCrowdError(magVector, lumFunc,
-                                         dataSlice[self.seeingCol], singleMag=self.rmag)
+        seeing = dataSlice[self.seeingCol]
+        dmagCrowd = engine.crowdError(seeing, np.zeros(len(seeing), int) + pix, singleMag=self.rmag)
 
         result = np.mean(dmagCrowd)
         return result
@@ -1,17 +1,18 @@
 import numpy as np
 from .baseMetric import BaseMetric
 from lsst.sims.utils import Site
+from lsst.sims.maf.utils import SiteEphemeris
 
 __all__ = ['HourglassMetric']
 
 
-def nearestVal(A, val):
-    return A[np.argmin(np.abs(np.array(A)-val))]
-
-
 class HourglassMetric(BaseMetric):
-    """Plot the filters used as a function of time. Must be used with the Hourglass Slicer."""
-    def __init__(self, telescope='LSST', **kwargs):
+    """Plot the filters used as a function of time. Must be used with the Hourglass Slicer.
+
+    The sun and moon ephemerides are looked up in a nightly table (see SiteEphemeris),
+    which can be saved to and reused from ephemCacheDir.
+    """
+    def __init__(self, telescope='LSST', ephemCacheDir=None, **kwargs):
 
         metricName = 'hourglass'
         filtercol = "filter"
@@ -23,10 +24,10 @@ class HourglassMetric(BaseMetric):
         self.mjdcol = mjdcol
         self.filtercol = filtercol
         self.telescope = Site(name=telescope)
+        self.siteEphem = SiteEphemeris(self.telescope, cacheDir=ephemCacheDir)
 
     def run(self, dataSlice, slicePoint=None):
 
-        import ephem
         dataSlice.sort(order=self.mjdcol)
         unights, uindx = np.unique(dataSlice[self.nightcol], return_index=True)
 
@@ -36,40 +37,13 @@ class HourglassMetric(BaseMetric):
         pernight = np.zeros(len(unights), dtype=zip(names, types))
         pernight['mjd'] = dataSlice['expMJD'][uindx]
 
-        left = np.searchsorted(dataSlice[self.nightcol], unights)
-
-        lsstObs = ephem.Observer()
-        lsstObs.lat = self.telescope.latitude_rad
-        lsstObs.lon = self.telescope.longitude_rad
-        lsstObs.elevation = self.telescope.height
-        horizons = ['-6', '-12', '-18']
-        key = ['twi6', 'twi12', 'twi18']
-
-        obsList = []
-        S = ephem.Sun()
-        moon = ephem.Moon()
-        for h in horizons:
-            obs = ephem.Observer()
-            obs.lat, obs.lon, obs.elevation = self.telescope.latitude_rad, self.telescope.longitude_rad, self.telescope.height
-            obs.horizon = h
-            obsList.append(obs)
-
-        # Oh for fuck's sake...pyephem uses 1899 as it's zero-day, and MJD has Nov 17 1858 as zero-day.
-        doff = ephem.Date(0)-ephem.Date('1858/11/17')
-
-        for i, mjd in enumerate(pernight['mjd']):
-            mjd = mjd-doff
-
-            pernight['midnight'][i] = nearestVal([lsstObs.previous_antitransit(S, start=mjd),
-                                                  lsstObs.next_antitransit(S, start=mjd)], mjd) + doff
-            moon.compute(mjd)
-            pernight['moonPer'][i] = moon.phase
-            for j, obs in enumerate(obsList):
-                pernight[key[j]+'_rise'][i] = obs.next_rising(S, start=pernight['midnight'][i]-doff,
-                                                              use_center=True) + doff
-
-                pernight[key[j]+'_set'][i] = obs.previous_setting(S, start=pernight['midnight'][i]-doff,
-                                                                  use_center=True) + doff
+        # Look up the nights with midnight (solar antitransit) closest to the first visit of each night.
+        nights = self.siteEphem.nearestNight(pernight['mjd'])
+        pernight['midnight'] = nights['midnight']
+        pernight['moonPer'] = self.siteEphem.moonPhase(pernight['mjd'])
+        for key in ['twi6', 'twi12', 'twi18']:
+            pernight[key+'_rise'] = nights[key+'_rise']
+            pernight[key+'_set'] = nights[key+'_set']
 
         # Define the breakpoints as where either the filter changes OR there's more than a 2 minute gap in observing
         good = np.where((dataSlice[self.filtercol] != np.roll(dataSlice[self.filtercol], 1)) |
@@ -85,9 +59,6 @@ class HourglassMetric(BaseMetric):
         perfilter = np.zeros((good.size), dtype=zip(names, types))
         perfilter['mjd'] = dataSlice['expMJD'][good]
         perfilter['filter'] = dataSlice['filter'][good]
-        for i, mjd in enumerate(perfilter['mjd']):
-            mjd = mjd - doff
-            perfilter['midnight'][i] = nearestVal([lsstObs.previous_antitransit(S, start=mjd),
-                                                   lsstObs.next_antitransit(S, start=mjd)], mjd)+doff
+        perfilter['midnight'] = self.siteEphem.nearestNight(perfilter['mjd'])['midnight']
 
         return {'pernight': pernight, 'perfilter': perfilter}
@@ -8,7 +8,7 @@ class PhaseGapMetric(BaseMetric):
     Measure the maximum gap in phase coverage for observations of periodic variables.
     """
     def __init__(self, col='expMJD', nPeriods=5, periodMin=3., periodMax=35., nVisitsMin=3,
-                 metricName='Phase Gap', **kwargs):
+                 logPeriods=False, metricName='Phase Gap', **kwargs):
         """
         Construct an instance of a PhaseGapMetric class
 
@@ -17,11 +17,15 @@ class PhaseGapMetric(BaseMetric):
         :param periodMin: Minimum period to test (days)
         :param periodMax: Maximimum period to test (days)
         :param nVistisMin: minimum number of visits necessary before looking for the phase gap
+        :param logPeriods: Space the periods to test evenly in log(period), rather than period
         """
         self.periodMin = periodMin
         self.periodMax = periodMax
         self.nPeriods = nPeriods
         self.nVisitsMin = nVisitsMin
+        self.logPeriods = logPeriods
+        # Maximum number of phases to calculate at once (all periods x all visits).
+        self.chunkSize = 1000000
         super(PhaseGapMetric, self).__init__(col, metricName=metricName, units='Fraction, 0-1', **kwargs)
 
     def run(self, dataSlice, slicePoint=None):
@@ -39,18 +43,26 @@ class PhaseGapMetric(BaseMetric):
             periods = np.array([self.periodMin])
         else:
             periods = np.arange(self.nPeriods)
-            periods = periods/np.max(periods)*(self.periodMax-self.periodMin)+self.periodMin
+            if self.logPeriods:
+                periods = np.exp(periods/np.max(periods)*(np.log(self.periodMax)-np.log(self.periodMin)) +
+                                 np.log(self.periodMin))
+            else:
+                periods = periods/np.max(periods)*(self.periodMax-self.periodMin)+self.periodMin
         maxGap = np.zeros(self.nPeriods, float)
 
-        for i, period in enumerate(periods):
+        # Calculate the phases for as many periods at a time as fit in chunkSize.
+        times = dataSlice[self.colname]
+        nChunk = max(int(self.chunkSize / times.size), 1)
+        for i in range(0, periods.size, nChunk):
+            period = periods[i:i + nChunk, np.newaxis]
             # For each period, calculate the phases.
-            phases = (dataSlice[self.colname] % period)/period
-            phases = np.sort(phases)
+            phases = (times % period)/period
+            phases = np.sort(phases, axis=1)
             # Find the largest gap in coverage.
-            gaps = np.diff(phases)
-            start_to_end = np.array([1.0 - phases[-1] + phases[0]], float)
-            gaps = np.concatenate([gaps, start_to_end])
-            maxGap[i] = np.max(gaps)
+            gaps = np.diff(phases, axis=1)
+            start_to_end = 1.0 - phases[:, -1:] + phases[:, :1]
+            gaps = np.concatenate([gaps, start_to_end], axis=1)
+            maxGap[i:i + period.size] = np.max(gaps, axis=1)
 
         return {'periods':periods, 'maxGaps':maxGap}
 
@@ -31,6 +31,10 @@ class TgapsMetric(BaseMetric):
             return self.badval
         times = np.sort(dataSlice[self.timesCol])
         if self.allGaps:
+            # Histogramming all of the gaps directly is faster for small slices, but uses
+            # memory (and time) scaling as the number of pairs of visits.
+            if (np.size(self.bins) > 1) and (times.size > np.size(self.bins)):
+                return self._allGapsHist(times)
             allDiffs = []
             for i in np.arange(1,times.size,1):
                 allDiffs.append( (times-np.roll(times,i))[i:] )
@@ -40,3 +44,36 @@ class TgapsMetric(BaseMetric):
         result, bins = np.histogram(dts, self.bins)
         return result
 
+    def _allGapsHist(self, times):
+        """
+        Histogram the gaps between all pairs of (sorted) times into self.bins, without calculating
+        each gap: count the pairs of times with gaps smaller than each bin edge instead.
+        The result is identical to np.histogram of all the gaps.
+        """
+        edges = np.asarray(self.bins, dtype=float)
+        # np.histogram bins are half-open, except the last bin which includes its right edge.
+        nPairs = np.zeros(edges.size, dtype=int)
+        for i, edge in enumerate(edges):
+            if i < edges.size - 1:
+                nPairs[i] = self._countPairs(times, edge, np.less)
+            else:
+                nPairs[i] = self._countPairs(times, edge, np.less_equal)
+        return np.diff(nPairs)
+
+    def _countPairs(self, times, edge, compare):
+        """
+        Count the pairs of (sorted) times with gaps for which compare(gap, edge) is True.
+        """
+        side = 'left' if compare is np.less else 'right'
+        # The gaps to each time increase with index, so find the first later time which fails the comparison.
+        bound = np.searchsorted(times, times + edge, side=side)
+        # times + edge is rounded: step the boundaries until they agree with the gaps themselves.
+        last = times.size - 1
+        while True:
+            down = (bound > 0) & ~compare(times[bound - 1] - times, edge)
+            up = (bound <= last) & compare(times[np.minimum(bound, last)] - times, edge)
+            if not (np.any(down) or np.any(up)):
+                break
+            bound[down] -= 1
+            bound[up] += 1
+        return np.sum(np.maximum(bound - np.arange(times.size) - 1, 0))
@@ -95,29 +95,34 @@ class TransientMetric(BaseMetric):
         Parameters
         ----------
         time : numpy.ndarray
-            The times of the observations.
+            The times of the observations (in the light curve phase).
+            May have an extra leading dimension (e.g. one row per phase shift).
         filters : numpy.ndarray
             The filters of the observations.
 
         Returns
         -------
         numpy.ndarray
-            The magnitudes of the object at each time, in each filter.
+            The magnitudes of the object at each time, in each filter (same shape as time).
         """
-        lcMags = np.zeros(time.size, dtype=float)
+        lcMags = np.zeros(time.shape, dtype=float)
         rise = np.where(time <= self.peakTime)
         lcMags[rise] += self.riseSlope * time[rise] - self.riseSlope * self.peakTime
         decline = np.where(time > self.peakTime)
         lcMags[decline] += self.declineSlope * (time[decline] - self.peakTime)
+        peakMags = np.zeros(np.size(filters), dtype=float)
         for key in self.peaks.keys():
             fMatch = np.where(filters == key)
-            lcMags[fMatch] += self.peaks[key]
-        return lcMags
+            peakMags[fMatch] += self.peaks[key]
+        return lcMags + peakMags
 
     def run(self, dataSlice, slicePoint=None):
         """"
         Calculate the detectability of a transient with the specified lightcurve.
 
+        All of the phase shifts are evaluated at once, grouping the observations by
+        (phase shift, light curve number), and by filter and light curve section where required.
+
         Parameters
         ----------
         dataSlice : numpy.array
@@ -130,81 +135,56 @@ class TransientMetric(BaseMetric):
         float
             The total number of transients that could be detected.
         """
-        # Total number of transients that could go off back-to-back
-        nTransMax = np.floor(self.surveyDuration / (self.transDuration / 365.25))
         tshifts = np.arange(self.nPhaseCheck) * self.transDuration / float(self.nPhaseCheck)
-        nDetected = 0
-        nTransMax = 0
-        for tshift in tshifts:
-            # Compute the total number of back-to-back transients are possible to detect
-            # given the survey duration and the transient duration.
-            nTransMax += np.floor(self.surveyDuration / (self.transDuration / 365.25))
-            if tshift != 0:
-                nTransMax -= 1
-            if self.surveyStart is None:
-                surveyStart = dataSlice[self.mjdCol].min()
-            time = (dataSlice[self.mjdCol] - surveyStart + tshift) % self.transDuration
-
-            # Which lightcurve does each point belong to
-            lcNumber = np.floor((dataSlice[self.mjdCol] - surveyStart) / self.transDuration)
-
-            lcMags = self.lightCurve(time, dataSlice[self.filterCol])
-
-            # How many criteria needs to be passed
-            detectThresh = 0
-
-            # Flag points that are above the SNR limit
-            detected = np.zeros(dataSlice.size, dtype=int)
-            detected[np.where(lcMags < dataSlice[self.m5Col] + self.detectM5Plus)] += 1
+        # Compute the total number of back-to-back transients are possible to detect
+        # given the survey duration and the transient duration (one fewer for each shifted phase).
+        nTransMax = np.floor(self.surveyDuration / (self.transDuration / 365.25)) * tshifts.size
+        nTransMax -= np.size(np.where(tshifts != 0)[0])
+        if self.surveyStart is None:
+            surveyStart = dataSlice[self.mjdCol].min()
+        else:
+            surveyStart = self.surveyStart
+
+        # Which lightcurve does each point belong to
+        lcNumber = np.floor((dataSlice[self.mjdCol] - surveyStart) / self.transDuration)
+        ulcNumber, lcIdx = np.unique(lcNumber, return_inverse=True)
+        # The phase of each point in its light curve, for each phase shift (nPhaseCheck x nPoints).
+        time = (dataSlice[self.mjdCol] - surveyStart + tshifts[:, np.newaxis]) % self.transDuration
+        lcMags = self.lightCurve(time, dataSlice[self.filterCol])
+        # The (phase shift, light curve) group of each point.
+        nGroups = tshifts.size * ulcNumber.size
+        group = (np.arange(tshifts.size)[:, np.newaxis] * ulcNumber.size + lcIdx).ravel()
+
+        # Flag points that are above the SNR limit
+        detected = (lcMags < dataSlice[self.m5Col] + self.detectM5Plus).ravel()
+        # Count the criteria passed by each light curve, and how many need to be passed.
+        nPassed = (np.bincount(group[detected], minlength=nGroups) > 0).astype(int)
+        detectThresh = 1
+
+        # If we demand points on the rise
+        if self.nPrePeak > 0:
             detectThresh += 1
-
-            # If we demand points on the rise
-            if self.nPrePeak > 0:
-                detectThresh += 1
-                ord = np.argsort(dataSlice[self.mjdCol])
-                dataSlice = dataSlice[ord]
-                detected = detected[ord]
-                lcNumber = lcNumber[ord]
-                time = time[ord]
-                ulcNumber = np.unique(lcNumber)
-                left = np.searchsorted(lcNumber, ulcNumber)
-                right = np.searchsorted(lcNumber, ulcNumber, side='right')
-                # Note here I'm using np.searchsorted to basically do a 'group by'
-                # might be clearer to use scipy.ndimage.measurements.find_objects or pandas, but
-                # this numpy function is known for being efficient.
-                for le, ri in zip(left, right):
-                    # Number of points where there are a detection
-                    good = np.where(time[le:ri] < self.peakTime)
-                    nd = np.sum(detected[le:ri][good])
-                    if nd >= self.nPrePeak:
-                        detected[le:ri] += 1
-
-            # Check if we need multiple points per light curve or multiple filters
-            if (self.nPerLC > 1) | (self.nFilters > 1):
-                # make sure things are sorted by time
-                ord = np.argsort(dataSlice[self.mjdCol])
-                dataSlice = dataSlice[ord]
-                detected = detected[ord]
-                lcNumber = lcNumber[ord]
-                ulcNumber = np.unique(lcNumber)
-                left = np.searchsorted(lcNumber, ulcNumber)
-                right = np.searchsorted(lcNumber, ulcNumber, side='right')
-                detectThresh += self.nFilters
-
-                for le, ri in zip(left, right):
-                    points = np.where(detected[le:ri] > 0)
-                    ufilters = np.unique(dataSlice[self.filterCol][le:ri][points])
-                    phaseSections = np.floor(time[le:ri][points] / self.transDuration * self.nPerLC)
-                    for filtName in ufilters:
-                        good = np.where(dataSlice[self.filterCol][le:ri][points] == filtName)
-                        if np.size(np.unique(phaseSections[good])) >= self.nPerLC:
-                            detected[le:ri] += 1
-
-            # Find the unique number of light curves that passed the required number of conditions
-            nDetected += np.size(np.unique(lcNumber[np.where(detected >= detectThresh)]))
-
-        # Rather than keeping a single "detected" variable, maybe make a mask for each criteria, then
-        # reduce functions like: reduce_singleDetect, reduce_NDetect, reduce_PerLC, reduce_perFilter.
-        # The way I'm running now it would speed things up.
-
+            early = detected & (time.ravel() < self.peakTime)
+            prePeak = np.bincount(group[early], minlength=nGroups) >= self.nPrePeak
+            nPassed += prePeak
+            # Light curves which pass this criteria have all of their points counted below.
+            detected = detected | prePeak[group]
+
+        # Check if we need multiple points per light curve or multiple filters
+        if (self.nPerLC > 1) | (self.nFilters > 1):
+            detectThresh += self.nFilters
+            ufilters, filterIdx = np.unique(dataSlice[self.filterCol], return_inverse=True)
+            filterIdx = np.tile(filterIdx, tshifts.size)
+            nSections = self.nPerLC + 1
+            phaseSections = np.floor(time.ravel() / self.transDuration * self.nPerLC).astype(int)
+            phaseSections = np.clip(phaseSections, 0, self.nPerLC)
+            # Flag which sections of each light curve are sampled by detected points, in each filter.
+            key = (group * ufilters.size + filterIdx) * nSections + phaseSections
+            sampled = np.bincount(key[detected], minlength=nGroups * ufilters.size * nSections) > 0
+            nSampled = sampled.reshape(nGroups, ufilters.size, nSections).sum(axis=2)
+            # Each filter with enough sampled sections counts as a criteria passed.
+            nPassed += np.sum((nSampled >= self.nPerLC) & (nSampled > 0), axis=1)
+
+        # Find the number of light curves that passed the required number of conditions
+        nDetected = np.size(np.where(nPassed >= detectThresh)[0])
         return float(nDetected) / nTransMax
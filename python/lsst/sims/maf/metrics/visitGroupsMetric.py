@@ -71,48 +71,36 @@ class VisitGroupsMetric(BaseMetric):
         than deltaTmin, the two would be counted as 1.5 visits together (if only 1 and 2 existed,
         then there would be 0 visits as none would be within the qualifying time interval).
         """
-        uniquenights = np.unique(dataSlice[self.nights])
-        nights = []
-        visitNum = []
-        # Find the nights with visits within deltaTmin/max of one another and count the number of visits
-        for n in uniquenights:
-            condition = (dataSlice[self.nights] == n)
-            times = np.sort(dataSlice[self.times][condition])
-            nvisits = 0
-            ntooclose = 0
-            # Calculate difference between each visit and time of previous visit (tnext- tnow)
-            timediff = np.diff(times)
-            timegood = np.where((timediff <= self.deltaTmax) & (timediff >= self.deltaTmin), True, False)
-            timetooclose = np.where(timediff < self.deltaTmin, True, False)
-            if len(timegood)>1:
-                # Count visits for all but last index in timediff
-                for tg1, ttc1, tg2, ttc2 in zip(timegood[:-1], timetooclose[:-1], timegood[1:], timetooclose[1:]):
-                    if tg1:
-                        nvisits += 1
-                        if not tg2:
-                            nvisits += 1
-                    if ttc1:
-                        ntooclose += 1
-                        if not tg2 and not ttc2:
-                            ntooclose += 1
-                # Take care of last timediff
-                if timegood[-1]:
-                    nvisits += 2 #close out visit sequence
-                if timetooclose[-1]:
-                    ntooclose += 1
-                    if not timegood[-2] and not timetooclose[-2]:
-                        ntooclose += 1
-            else:
-                if timegood:
-                    nvisits += 2
-            # Count up all visits for night.
-            if nvisits > 0:
-                nvisits = nvisits + ntooclose/2.0
-                visitNum.append(nvisits)
-                nights.append(n)
-        # Convert to numpy arrays.
-        visitNum = np.array(visitNum)
-        nights = np.array(nights)
+        # Sort the visits by night, and by time within each night.
+        order = np.lexsort([dataSlice[self.times], dataSlice[self.nights]])
+        times = dataSlice[self.times][order]
+        uniquenights, nightIdx, nightVisits = np.unique(dataSlice[self.nights][order], return_inverse=True,
+                                                        return_counts=True)
+        # Calculate difference between each visit and time of previous visit (tnext- tnow),
+        # flagging only the differences between visits in the same night.
+        sameNight = (nightIdx[1:] == nightIdx[:-1])
+        timediff = np.diff(times)
+        timegood = sameNight & (timediff <= self.deltaTmax) & (timediff >= self.deltaTmin)
+        timetooclose = sameNight & (timediff < self.deltaTmin)
+        neither = sameNight & ~timegood & ~timetooclose
+        # Flag the same-night time difference following (or preceding) each time difference.
+        nextgood = np.append(timegood[1:], False)
+        nextneither = np.append(neither[1:], False)
+        prevneither = np.append(False, neither[:-1])
+        lastdiff = sameNight & ~np.append(sameNight[1:], False)
+        # Each good time difference counts one visit, plus one more to close out a visit sequence.
+        nvisits = np.where(timegood, np.where(nextgood, 1, 2), 0)
+        # Each time difference which is too close counts one visit, plus one more if it is followed by a
+        # time difference which is neither good or too close (or preceded by one, for the last in the night).
+        ntooclose = np.where(timetooclose, 1 + np.where(lastdiff, prevneither, nextneither), 0)
+        # Count up all visits for each night.
+        nvisits = np.bincount(nightIdx[:-1], weights=nvisits, minlength=uniquenights.size)
+        ntooclose = np.bincount(nightIdx[:-1], weights=ntooclose, minlength=uniquenights.size)
+        # Nights with a single time difference can't have visits too close to a good pair.
+        ntooclose[np.where(nightVisits <= 2)] = 0
+        good = np.where(nvisits > 0)
+        visitNum = nvisits[good] + ntooclose[good]/2.0
+        nights = uniquenights[good]
         metricval = {'visits':visitNum, 'nights':nights}
         if len(visitNum) == 0:
             return self.badval
@@ -127,81 +115,67 @@ class VisitGroupsMetric(BaseMetric):
         condition = (metricval['visits'] >= self.minNVisits)
         return len(metricval['visits'][condition])
 
-    def _inWindow(self, visits, nights, night, window, minNVisits):
-        condition = ((nights >= night) & (nights < night+window))
-        condition2 = (visits[condition] >= minNVisits)
-        return visits[condition][condition2], nights[condition][condition2]
+    def _inWindow(self, metricval, windowEnds=None):
+        """
+        For the windows starting on each night, count the nights with at least minNVisits visits within
+        'window' nights (or before windowEnds, if earlier), and the total visits on those nights.
+        """
+        condition = (metricval['visits'] >= self.minNVisits)
+        visits = metricval['visits'][condition]
+        nights = metricval['nights'][condition]
+        ends = metricval['nights'] + self.window
+        if windowEnds is not None:
+            ends = np.minimum(ends, windowEnds)
+        left = np.searchsorted(nights, metricval['nights'], side='left')
+        right = np.maximum(np.searchsorted(nights, ends, side='left'), left)
+        cumVisits = np.concatenate([[0], np.cumsum(visits)])
+        return right - left, cumVisits[right] - cumVisits[left]
 
     def reduceNVisitsInWindow(self, metricval):
         """Reduce to max number of total visits on all nights with more than minNVisits,
         within any 'window' (default=30 nights)."""
-        maxnvisits = 0
-        for n in metricval['nights']:
-            vw, nw = self._inWindow(metricval['visits'], metricval['nights'], n, self.window, self.minNVisits)
-            maxnvisits = max((vw.sum(), maxnvisits))
-        return maxnvisits
+        nw, vw = self._inWindow(metricval)
+        return max(vw.max(), 0)
 
     def reduceNNightsInWindow(self, metricval):
         """Reduce to max number of nights with more than minNVisits, within 'window' over all windows."""
-        maxnights = 0
-        for n in metricval['nights']:
-            vw, nw = self._inWindow(metricval['visits'], metricval['nights'], n, self.window, self.minNVisits)
-            maxnights = max(len(nw), maxnights)
-        return maxnights
+        nw, vw = self._inWindow(metricval)
+        return max(nw.max(), 0)
 
-    def _inLunation(self, visits, nights, lunationStart, lunationLength):
-        condition = ((nights >= lunationStart) & (nights < lunationStart+lunationLength))
-        return visits[condition], nights[condition]
+    def _inLunation(self, metricval):
+        """
+        Find the lunation (unique 30 day window) of each night, and whether a 'group' starts on each night
+        (considering only the nights within the same lunation).
+        Returns the number of lunations, the lunation of each night and the group flag of each night.
+        """
+        lunationLength = 30
+        lunations = np.arange(metricval['nights'][0], metricval['nights'][-1]+lunationLength/2.0, lunationLength)
+        lunation = np.searchsorted(lunations, metricval['nights'], side='right') - 1
+        nw, vw = self._inWindow(metricval, lunations[lunation] + lunationLength)
+        return lunations.size, lunation, (nw >= self.minNNights)
 
     def reduceNLunations(self, metricval):
         """Reduce to number of lunations (unique 30 day windows) that contain at least one 'group':
         a set of more than minNVisits per night, with more than minNNights of visits within 'window' time period.
         """
-        lunationLength = 30
-        lunations = np.arange(metricval['nights'][0], metricval['nights'][-1]+lunationLength/2.0, lunationLength)
-        nLunations = 0
-        for l in lunations:
-            # Find visits within lunation.
-            vl, nl = self._inLunation(metricval['visits'], metricval['nights'], l, lunationLength)
-            for n in nl:
-                # Find visits which are in groups within the lunation.
-                vw, nw = self._inWindow(vl, nl, n, self.window, self.minNVisits)
-                if len(nw) >= self.minNNights:
-                    nLunations += 1
-                    break
-        return nLunations
+        nLunations, lunation, group = self._inLunation(metricval)
+        return np.size(np.unique(lunation[np.where(group)]))
 
     def reduceMaxSeqLunations(self, metricval):
         """Count the max number of sequential lunations (unique 30 day windows) that contain at least one 'group':
         a set of more than minNVisits per night, with more than minNNights of visits within 'window' time period.
         """
-        lunationLength = 30
-        lunations = np.arange(metricval['nights'][0], metricval['nights'][-1]+lunationLength/2.0, lunationLength)
-        maxSequence = 0
-        curSequence = 0
-        inSeq = False
-        for l in lunations:
-            # Find visits within lunation.
-            vl, nl = self._inLunation(metricval['visits'], metricval['nights'], l, lunationLength)
-            # If no visits this lunation:
-            if len(vl) == 0:
-                inSeq = False
-                maxSequence = max(maxSequence, curSequence)
-                curSequence = 0
-            # Else, look to see if groups can be made from the visits.
-            for n in nl:
-                # Find visits which are in groups within the lunation.
-                vw, nw = self._inWindow(vl, nl, n, self.window, self.minNVisits)
-                # If there was a group within this lunation:
-                if len(nw) >= self.minNNights:
-                    curSequence += 1
-                    inSeq = True
-                    break
-                # Otherwise we're not in a sequence (anymore, or still).
-                else:
-                    inSeq = False
-                    maxSequence = max(maxSequence, curSequence)
-                    curSequence = 0
-        # Pick up last sequence if were in a sequence at last lunation.
-        maxSequence = max(maxSequence, curSequence)
+        nLunations, lunation, group = self._inLunation(metricval)
+        lunationIdx = np.arange(nLunations)
+        # Does a group start on the first night of each lunation, or on any night of each lunation?
+        first = np.searchsorted(lunation, lunationIdx, side='left')
+        firstGroup = np.zeros(nLunations, bool)
+        hasNights = np.where(first < np.searchsorted(lunation, lunationIdx, side='right'))
+        firstGroup[hasNights] = group[first[hasNights]]
+        anyGroup = np.bincount(lunation[np.where(group)], minlength=nLunations) > 0
+        # Only a group starting on the first night of a lunation continues the current sequence.
+        # Otherwise, a group later in the lunation starts a new sequence, and no group ends the sequence.
+        lastBreak = np.maximum.accumulate(np.where(firstGroup, -1, lunationIdx))
+        curSequence = np.where(lastBreak >= 0, anyGroup[np.maximum(lastBreak, 0)], 0) + lunationIdx - lastBreak
+        maxSequence = max(curSequence.max(), 0)
         return maxSequence
@@ -60,6 +60,8 @@ class HealpixSkyMap(BasePlotter):
         cnames = [cls.__name__ for cls in classes]
         if 'HealpixSlicer' not in cnames:
             raise ValueError('HealpixSkyMap is for use with healpix slicers')
+        # Expand values from sparse healpix slicers to the full sky.
+        metricValueIn = slicer.fullSky(metricValueIn)
         fig = plt.figure(fignum)
         # Override the default plotting parameters with user specified values.
         plotDict = {}
@@ -162,8 +164,11 @@ class HealpixPowerSpectrum(BasePlotter):
         """
         Generate and plot the power spectrum of metricValue (calculated on a healpix grid).
         """
-        if slicer.slicerName != 'HealpixSlicer':
+        classes = inspect.getmro(slicer.__class__)
+        cnames = [cls.__name__ for cls in classes]
+        if 'HealpixSlicer' not in cnames:
             raise ValueError('HealpixPowerSpectrum for use with healpix metricBundles.')
+        metricValue = slicer.fullSky(metricValue)
         plotDict = {}
         plotDict.update(self.defaultPlotDict)
         plotDict.update(userPlotDict)
@@ -215,8 +220,12 @@ class HealpixHistogram(BasePlotter):
         """
         Histogram metricValue for all healpix points.
         """
-        if slicer.slicerName != 'HealpixSlicer':
+        classes = inspect.getmro(slicer.__class__)
+        cnames = [cls.__name__ for cls in classes]
+        if 'HealpixSlicer' not in cnames:
             raise ValueError('HealpixHistogram is for use with healpix slicer.')
+        # Histogram the values of each healpixel (expanding those evaluated at lower resolution).
+        metricValue = slicer.expandValues(metricValue)
         plotDict = {}
         plotDict.update(self.defaultPlotDict)
         plotDict.update(userPlotDict)
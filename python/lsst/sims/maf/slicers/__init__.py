@@ -8,4 +8,5 @@ from .baseSpatialSlicer import *
 from .healpixSlicer import *
 from .opsimFieldSlicer import *
 from .healpixSDSSSlicer import *
+from .healpixAdaptiveSlicer import *
 from .userPointsSlicer import *
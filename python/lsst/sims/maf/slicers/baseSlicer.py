@@ -1,14 +1,17 @@
 # Base class for all 'Slicer' objects.
 #
+import os
 import inspect
+import threading
+from collections import Mapping, OrderedDict
 from StringIO import StringIO
 import json
 import warnings
 import numpy as np
 import numpy.ma as ma
-from lsst.sims.maf.utils import getDateVersion
+from lsst.sims.maf.utils import getDateVersion, configHash
 
-__all__ = ['SlicerRegistry', 'BaseSlicer']
+__all__ = ['SlicerRegistry', 'SlicePoint', 'BaseSlicer']
 
 class SlicerRegistry(type):
     """
@@ -26,6 +29,11 @@ class SlicerRegistry(type):
             raise Exception('Redefining metric %s! (there are >1 slicers with the same name)' %(slicername))
         if slicername not in ['BaseSlicer', 'BaseSpatialSlicer']:
             cls.registry[slicername] = cls
+    def __call__(cls, *args, **kwargs):
+        slicer = super(SlicerRegistry, cls).__call__(*args, **kwargs)
+        # Keep all the arguments the slicer was made with (slicer_init may only hold some of them).
+        slicer._initArgs = (args, kwargs)
+        return slicer
     def getClass(cls, slicername):
         return cls.registry[slicername]
     def help(cls, doc=False):
@@ -38,6 +46,42 @@ class SlicerRegistry(type):
 
 
 
+class SlicePoint(Mapping):
+    """
+    Read-only view of the slicePoint metadata for a single slicePoint.
+
+    Values are only looked up when they are used: values given per slicePoint are indexed at islice,
+    while other values (such as the magnitude bins of a stellar luminosity function map) are returned whole.
+
+    Parameters
+    ----------
+    columns : dict
+        Dictionary of (values, perSlicePoint flag) tuples, keyed by slicePoint key.
+    islice : int
+        The index of the slicePoint.
+    """
+    __slots__ = ('_columns', '_islice')
+
+    def __init__(self, columns, islice):
+        self._columns = columns
+        self._islice = islice
+
+    def __getitem__(self, key):
+        values, perSlicePoint = self._columns[key]
+        if perSlicePoint:
+            return values[self._islice]
+        return values
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 class BaseSlicer(object):
     """
     Base class for all slicers: sets required methods and implements common functionality.
@@ -86,6 +130,10 @@ class BaseSlicer(object):
         # Set the y-axis range be on the two-d plot
         if self.nslice is not None:
             self.spatialExtent = [0,self.nslice-1]
+        # Slicers which can return only the data indexes for a slicePoint (and use SlicePoint views
+        #  for the slicePoint metadata) set _sliceIdxs in setupSlicer.
+        self._sliceIdxs = None
+        self._slicePointColumns = {}
 
 
     def _runMaps(self, maps):
@@ -95,6 +143,33 @@ class BaseSlicer(object):
             for m in maps:
                 self.slicePoints = m.run(self.slicePoints)
 
+    def _setupSlicePointColumns(self, globalKeys=(), extraColumns=None):
+        """Classify each slicePoints key as information per slicePoint or not, for SlicePoint views.
+
+        If the first dimension of slicePoints[key] has the same shape as the slicer, assume it is
+        information per slicepoint (unless key is in globalKeys).
+        Otherwise, the whole slicePoints[key] information is passed. Useful for stellar LF maps
+        where we want to pass only the relevant LF and the bins that go with it.
+        extraColumns = optional dictionary of additional per-slicePoint values (not saved in slicePoints).
+        """
+        self._slicePointColumns = {}
+        for key in self.slicePoints:
+            keyShape = np.shape(self.slicePoints[key])
+            perSlicePoint = (len(keyShape) > 0) and (keyShape[0] == self.nslice) and (key not in globalKeys)
+            self._slicePointColumns[key] = (self.slicePoints[key], perSlicePoint)
+        if extraColumns is not None:
+            for key in extraColumns:
+                self._slicePointColumns[key] = (extraColumns[key], True)
+
+    def getInitArgs(self):
+        """Return the class and the arguments this slicer was made with, as (cls, args, kwargs).
+
+        cls(*args, **kwargs) makes a new slicer with the same configuration (not yet set up), such as
+        a copy of the slicer for another process.
+        """
+        args, kwargs = getattr(self, '_initArgs', ((), self.slicer_init))
+        return self.__class__, args, kwargs
+
     def setupSlicer(self, simData, maps=None):
         """Set up Slicer for data slicing.
 
@@ -137,6 +212,32 @@ class BaseSlicer(object):
     def __getitem__(self, islice):
         return self._sliceSimData(islice)
 
+    def iterSlices(self, start=0):
+        """Iterate over the slices, yielding (islice, idxs, slicePoint) for each slicePoint (from slicePoint start).
+
+        idxs are the data indexes relevant for this slice of the slicer and slicePoint is the metadata for
+        the slicePoint. Where the slicer supports it, slicePoint is a SlicePoint view, so that metrics
+        which do not use the slicePoint metadata do not pay for building it.
+        """
+        if self._sliceIdxs is None:
+            for islice in xrange(start, self.nslice):
+                slice_i = self._sliceSimData(islice)
+                yield islice, slice_i['idxs'], slice_i['slicePoint']
+        else:
+            sliceIdxs = self._sliceIdxs
+            columns = self._slicePointColumns
+            for islice in xrange(start, self.nslice):
+                yield islice, sliceIdxs(islice), SlicePoint(columns, islice)
+
+    def expandValues(self, metricValues):
+        """Return metricValues with one value for each of the (equally weighted) points the slicer represents,
+        for summary statistics.
+
+        Slicers which evaluate metrics at fewer points (such as the HealpixAdaptiveSlicer) expand them here;
+        for all others, metricValues are returned unchanged.
+        """
+        return metricValues
+
     def __eq__(self, otherSlicer):
         """
         Evaluate if two slicers are equivalent.
@@ -167,6 +268,14 @@ class BaseSlicer(object):
         """
         Save metric values along with the information required to re-build the slicer.
 
+        If outfilename ends in '.npz', everything is saved in a single npz file (with the header, slicer_init
+        and slicePoints pickled). Otherwise outfilename is a JSON header, and the metric values and mask
+        are saved beside it as uncompressed .npy files (fileroot_values.npy, fileroot_mask.npy), which are
+        memory-mapped when read. The slicePoints are saved once per slicer configuration, in a
+        'slicePoints_<hash of the slicePoints>.npz' file in the same directory which is shared by all the
+        metric data files with the same slicePoints. Items of the plotDict and displayDict which can't be
+        written to JSON (such as colormaps) are left out of the JSON header.
+
         outfilename: the output file
         metricValues: the metric values to save to disk
         """
@@ -191,6 +300,9 @@ class BaseSlicer(object):
             data = metricValues
             mask = None
             fill = None
+        if not outfilename.endswith('.npz'):
+            self._writeNpy(outfilename, header, data, mask, fill)
+            return
         # npz file acts like dictionary: each keyword/value pair below acts as a dictionary in loaded NPZ file.
         np.savez(outfilename,
                  header = header, # header saved as dictionary
@@ -203,6 +315,43 @@ class BaseSlicer(object):
                  slicerNSlice = self.nslice,
                  slicerShape = self.shape)
 
+    def _writeNpy(self, outfilename, header, data, mask, fill):
+        """
+        Save metric values as .npy files, with a JSON header (outfilename) and a shared slicePoints file.
+        """
+        outDir, headFile = os.path.split(outfilename)
+        fileRoot = os.path.splitext(headFile)[0]
+        # The slicePoints file is named by its contents, so it only needs writing once.
+        slicePointsFile = 'slicePoints_%s.npz' % (configHash(self.slicePoints)[:16])
+        if not os.path.isfile(os.path.join(outDir, slicePointsFile)):
+            _atomicWrite(os.path.join(outDir, slicePointsFile),
+                         lambda f: np.savez(f, **dict((str(k), v) for k, v in self.slicePoints.iteritems())))
+        valuesFile = fileRoot + '_values.npy'
+        _atomicWrite(os.path.join(outDir, valuesFile), lambda f: np.save(f, np.asarray(data)))
+        if mask is None or np.ndim(mask) == 0:
+            maskFile = None
+            # A masked array with nothing masked.
+            if mask is not None and mask:
+                mask = np.ones(np.shape(data), bool)
+                maskFile = fileRoot + '_mask.npy'
+        else:
+            maskFile = fileRoot + '_mask.npy'
+        if maskFile is not None:
+            _atomicWrite(os.path.join(outDir, maskFile), lambda f: np.save(f, np.asarray(mask)))
+        header['plotDict'] = _jsonDict(header['plotDict'])
+        header['displayDict'] = _jsonDict(header['displayDict'])
+        contents = {'header': _jsonDict(header),
+                    'metricValues': valuesFile,
+                    'mask': maskFile,
+                    'fill': _toJson(fill) if mask is not None else None,
+                    'slicer_init': _toJson(self.slicer_init),
+                    'slicerName': self.slicerName,
+                    'slicePoints': slicePointsFile,
+                    'slicerNSlice': _toJson(self.nslice),
+                    'slicerShape': _toJson(self.shape)}
+        # The header is written last: once it is there, the whole output is.
+        _atomicWrite(outfilename, lambda f: json.dump(contents, f))
+
     def outputJSON(self, metricValues, metricName='',
                   simDataName ='', metadata='', plotDict=None):
         """
@@ -307,10 +456,38 @@ class BaseSlicer(object):
         """
         Read metric data from disk, along with the info to rebuild the slicer (minus new slicing capability).
 
-        infilename: the filename containing the metric data.
+        infilename: the filename containing the metric data (an npz file, or the JSON header of the .npy files).
+        The .npy metric values are memory-mapped (copy-on-write, so they can be changed without
+        changing the files).
         """
-        import lsst.sims.maf.slicers as slicers
-        restored = np.load(infilename)
+        if infilename.endswith('.npz'):
+            return self._readNpz(infilename)
+        inDir = os.path.dirname(infilename)
+        with open(infilename, 'r') as f:
+            contents = _fromJson(json.load(f))
+        data = _loadNpy(os.path.join(inDir, contents['metricValues']))
+        if contents['mask'] is None:
+            if contents['fill'] is None:
+                metricValues = ma.MaskedArray(data=data)
+            else:
+                metricValues = ma.MaskedArray(data=data, fill_value=contents['fill'])
+        else:
+            metricValues = ma.MaskedArray(data=data,
+                                          mask=_loadNpy(os.path.join(inDir, contents['mask'])),
+                                          fill_value=contents['fill'])
+        slicePoints = _readSlicePoints(os.path.join(inDir, contents['slicePoints']))
+        shape = contents['slicerShape']
+        if isinstance(shape, list):
+            shape = tuple(shape)
+        slicer = self._restoreSlicer(contents['slicerName'], contents['slicer_init'],
+                                     contents['slicerNSlice'], slicePoints, shape)
+        return metricValues, slicer, contents['header']
+
+    def _readNpz(self, infilename):
+        """
+        Read metric data and the info to rebuild the slicer from an npz file.
+        """
+        restored = np.load(infilename, allow_pickle=True)
         # Get metric data set
         if restored['mask'][()] is None:
             metricValues = ma.MaskedArray(data=restored['metricValues'])
@@ -320,8 +497,16 @@ class BaseSlicer(object):
                                           fill_value=restored['fill'])
         # Get Metadata & other simData info.
         header = restored['header'][()]  # extra brackets restore dictionary to dictionary status.
-        # Get slicer instantiated.
-        slicer_init = restored['slicer_init'][()]
+        slicer = self._restoreSlicer(str(restored['slicerName']), restored['slicer_init'][()],
+                                     restored['slicerNSlice'], restored['slicePoints'][()],
+                                     restored['slicerShape'])
+        return metricValues, slicer, header
+
+    def _restoreSlicer(self, slicerName, slicer_init, nslice, slicePoints, shape):
+        """
+        Instantiate a slicer from slicer_init, and restore its slicePoint metadata.
+        """
+        import lsst.sims.maf.slicers as slicers
         # Backwards compatibility issue - map 'spatialkey1/spatialkey2' to 'lonCol/latCol'.
         if 'spatialkey1' in slicer_init:
             slicer_init['lonCol'] = slicer_init['spatialkey1']
@@ -329,9 +514,101 @@ class BaseSlicer(object):
         if 'spatialkey2' in slicer_init:
             slicer_init['latCol'] = slicer_init['spatialkey2']
             del(slicer_init['spatialkey2'])
-        slicer = getattr(slicers, str(restored['slicerName']))(**slicer_init)
+        slicer = getattr(slicers, slicerName)(**slicer_init)
         # Restore slicePoint metadata.
-        slicer.nslice = restored['slicerNSlice']
-        slicer.slicePoints = restored['slicePoints'][()]
-        slicer.shape = restored['slicerShape']
-        return metricValues, slicer, header
+        slicer.nslice = nslice
+        slicer.slicePoints = slicePoints
+        slicer.shape = shape
+        return slicer
+
+
+# The slicePoints files read in this process (these are named by their contents, so never change).
+_slicePointsFiles = OrderedDict()
+_slicePointsLock = threading.Lock()
+
+
+def _readSlicePoints(filename, maxFiles=20):
+    """Read a slicePoints file (keeping the maxFiles most recently read in memory)."""
+    key = os.path.abspath(filename)
+    with _slicePointsLock:
+        if key in _slicePointsFiles:
+            slicePoints = _slicePointsFiles.pop(key)
+            _slicePointsFiles[key] = slicePoints
+            # The arrays are shared (read-only), the dictionary is not.
+            return dict(slicePoints)
+    slicePoints = {}
+    restored = np.load(filename, allow_pickle=True)
+    for name in restored.files:
+        value = restored[name]
+        if value.ndim == 0:
+            # Restore scalars (and other objects, such as None).
+            value = value[()]
+        else:
+            value.setflags(write=False)
+        slicePoints[name] = value
+    restored.close()
+    with _slicePointsLock:
+        _slicePointsFiles[key] = slicePoints
+        while len(_slicePointsFiles) > maxFiles:
+            _slicePointsFiles.popitem(last=False)
+    return dict(slicePoints)
+
+
+def _loadNpy(filename):
+    """Load a .npy file, memory-mapped (copy-on-write) if possible."""
+    try:
+        return np.load(filename, mmap_mode='c')
+    except ValueError:
+        # Arrays of objects (and empty arrays) can't be memory-mapped.
+        return np.load(filename, allow_pickle=True)
+
+
+def _atomicWrite(filename, write):
+    """Write a file with write(fileobject) through a temporary file, so it never appears partly written."""
+    tmpFilename = filename + '.%d.%d.tmp' % (os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmpFilename, 'wb') as f:
+            write(f)
+        os.rename(tmpFilename, filename)
+    finally:
+        if os.path.isfile(tmpFilename):
+            os.remove(tmpFilename)
+
+
+def _toJson(obj):
+    """Convert obj to the python types written by json (raising TypeError if this isn't possible)."""
+    if isinstance(obj, Mapping):
+        return dict((str(k), _toJson(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_toJson(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return _toJson(obj.tolist())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is None or isinstance(obj, (bool, int, long, float, basestring)):
+        return obj
+    raise TypeError('%r can not be written to JSON' % (obj,))
+
+
+def _jsonDict(d):
+    """Convert the items of dictionary d which can be written to JSON (leaving out the others)."""
+    if d is None:
+        return None
+    jsonDict = {}
+    for k, v in d.iteritems():
+        try:
+            jsonDict[str(k)] = _toJson(v)
+        except TypeError:
+            pass
+    return jsonDict
+
+
+def _fromJson(obj):
+    """Convert the unicode strings read by json back to str."""
+    if isinstance(obj, dict):
+        return dict((_fromJson(k), _fromJson(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [_fromJson(v) for v in obj]
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return obj
@@ -15,7 +15,7 @@ from lsst.obs.lsstSim import LsstSimMapper
 from lsst.sims.coordUtils import _chipNameFromRaDec
 from lsst.sims.utils import ObservationMetaData
 
-from .baseSlicer import BaseSlicer
+from .baseSlicer import BaseSlicer, SlicePoint
 
 __all__ = ['BaseSpatialSlicer']
 
@@ -75,43 +75,43 @@ class BaseSpatialSlicer(BaseSlicer):
                 warnings.warn('Warning:  Loading maps but cache on. Should probably set useCache=False in slicer.')
             self._runMaps(maps)
         self._setRad(self.radius)
+        # Classify the slicePoint metadata once, for the SlicePoint views.
         if self.useCamera:
             self._setupLSSTCamera()
             self._presliceFootprint(simData)
+            self._setupSlicePointColumns(extraColumns={'chipNames': self.chipNames})
+
+            def _sliceIdxs(islice):
+                """Return indexes for relevant opsim data at slicepoint, checked against the chip positions."""
+                return self.sliceLookup[islice]
         else:
-            self._buildTree(simData[self.lonCol], simData[self.latCol], self.leafsize)
+            self._setupSlicePointColumns()
+            _sliceIdxs = self._indexPointings(simData)
+        self._sliceIdxs = _sliceIdxs
 
         @wraps(self._sliceSimData)
         def _sliceSimData(islice):
             """Return indexes for relevant opsim data at slicepoint
-            (slicepoint=lonCol/latCol value .. usually ra/dec)."""
-
-            # Build dict for slicePoint info
-            slicePoint = {}
-            if self.useCamera:
-                indices = self.sliceLookup[islice]
-                slicePoint['chipNames'] = self.chipNames[islice]
-            else:
-                sx, sy, sz = self._treexyz(self.slicePoints['ra'][islice], self.slicePoints['dec'][islice])
-                # Query against tree.
-                indices = self.opsimtree.query_ball_point((sx, sy, sz), self.rad)
-
-            # Loop through all the slicePoint keys. If the first dimension of slicepoint[key] has
-            # the same shape as the slicer, assume it is information per slicepoint.
-            # Otherwise, pass the whole slicePoint[key] information. Useful for stellar LF maps
-            # where we want to pass only the relevant LF and the bins that go with it.
-            for key in self.slicePoints.keys():
-                if len(np.shape(self.slicePoints[key])) == 0:
-                    keyShape = 0
-                else:
-                    keyShape = np.shape(self.slicePoints[key])[0]
-                if (keyShape == self.nslice):
-                    slicePoint[key] = self.slicePoints[key][islice]
-                else:
-                    slicePoint[key] = self.slicePoints[key]
-            return {'idxs': indices, 'slicePoint': slicePoint}
+            (slicepoint=lonCol/latCol value .. usually ra/dec), and the slicePoint metadata."""
+            return {'idxs': _sliceIdxs(islice),
+                    'slicePoint': dict(SlicePoint(self._slicePointColumns, islice))}
         setattr(self, '_sliceSimData', _sliceSimData)
 
+    def _indexPointings(self, simData):
+        """Set up the index of the simData pointings used to slice the data.
+
+        Returns a function which returns the indexes of the relevant opsim data at a slicepoint.
+        """
+        self._buildTree(simData[self.lonCol], simData[self.latCol], self.leafsize)
+
+        def _sliceIdxs(islice):
+            """Return indexes for relevant opsim data at slicepoint
+            (slicepoint=lonCol/latCol value .. usually ra/dec)."""
+            sx, sy, sz = self._treexyz(self.slicePoints['ra'][islice], self.slicePoints['dec'][islice])
+            # Query against tree.
+            return self.opsimtree.query_ball_point((sx, sy, sz), self.rad)
+        return _sliceIdxs
+
     def _setupLSSTCamera(self):
         """If we want to include the camera chip gaps, etc"""
 
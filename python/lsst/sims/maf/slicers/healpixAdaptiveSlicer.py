@@ -0,0 +1,174 @@
+# Class for HealpixAdaptiveSlicer (multi-resolution healpixel-based spatial slicer).
+# Metrics are evaluated on a NESTED multi-order healpix grid, which is only refined to the full
+# resolution (nside) where the set of visits changes.
+
+import numpy as np
+import numpy.ma as ma
+import healpy as hp
+
+from .healpixSlicer import HealpixSlicer
+
+
+__all__ = ['HealpixAdaptiveSlicer']
+
+class HealpixAdaptiveSlicer(HealpixSlicer):
+    """Multi-resolution healpix spatial slicer.
+
+    The sky is first divided into healpixels at coarseNside. A healpixel (cell) is kept whole if every
+    visit's field of view either covers all of it or misses all of it, so that every full resolution
+    healpixel within it sees exactly the same visits; otherwise it is split into its four NESTED children,
+    and so on down to nside. Cells without any visits are dropped.
+
+    The slicePoints are these cells: slicePoints['sid'] is the NESTED 'uniq' id of each cell
+    (4 * cellNside**2 + nested pixel number), slicePoints['cellNside'] its nside and slicePoints['ra'/'dec']
+    its center. Metrics which only use the visits get the same values as with the HealpixSlicer at nside;
+    metrics which use the slicePoint location (or maps) are evaluated at the cell centers.
+    expandValues / fullSky expand the metric values to the full resolution, for plots and summary metrics.
+    """
+    def __init__(self, nside=128, coarseNside=16, lonCol='fieldRA', latCol='fieldDec', verbose=True,
+                 useCache=True, radius=1.75, leafsize=100):
+        """Instantiate the adaptive healpix slicer.
+
+        nside = the full resolution of the healpix grid.
+        coarseNside = the resolution of the coarsest cells.
+        """
+        super(HealpixAdaptiveSlicer, self).__init__(nside=nside, lonCol=lonCol, latCol=latCol,
+                                                    verbose=verbose, useCache=useCache, radius=radius,
+                                                    leafsize=leafsize, footprint=np.array([], int))
+        if not(hp.isnsideok(coarseNside)) or coarseNside > self.nside:
+            raise ValueError('coarseNside should be a power of 2, no larger than nside.')
+        self.coarseNside = int(coarseNside)
+        # The cells are not known until setupSlicer; and the slicePoint 'sid' are not pixel numbers at nside.
+        del self.slicePoints['nside']
+        self.slicePoints['cellNside'] = np.array([], int)
+        self.slicer_init = {'nside': nside, 'coarseNside': coarseNside, 'lonCol': lonCol, 'latCol': latCol,
+                            'radius': radius}
+        self.evalFraction = None
+
+    def __eq__(self, otherSlicer):
+        """Evaluate if two slicers are equivalent."""
+        result = False
+        if isinstance(otherSlicer, HealpixAdaptiveSlicer):
+            if otherSlicer.coarseNside == self.coarseNside:
+                result = super(HealpixAdaptiveSlicer, self).__eq__(otherSlicer)
+        return result
+
+    def _chord(self, angle):
+        """Convert an angular distance (radians) to the chord distance used by the kdtree."""
+        return 2.0 * np.sin(angle / 2.0)
+
+    def _splitCells(self, nside, sx, sy, sz):
+        """Find which of the cells (healpixels at nside, with centers sx/sy/sz) to keep whole and which to split.
+
+        A cell is kept whole if the visits within radius of its center +/- the cell radius are the same,
+        as then all of the points in the cell are within radius of the same visits: the visits within
+        radius - cell radius of the center.
+        Returns the keep and split flags, and the (kdtree) radius to use for the kept cells.
+        """
+        # Margin on the cell tests, so that rounding never keeps a cell whole when it should be split.
+        eps = 1e-9
+        # All points within the cell are within pixRad of its center.
+        pixRad = 1.01 * hp.max_pixrad(nside)
+        outerRad = self._chord(np.radians(self.radius) + pixRad) + eps
+        innerAngle = np.radians(self.radius) - pixRad
+        innerRad = self._chord(innerAngle) - eps
+        keep = np.zeros(len(sx), bool)
+        split = np.zeros(len(sx), bool)
+        for i in xrange(len(sx)):
+            nOuter = len(self.opsimtree.query_ball_point((sx[i], sy[i], sz[i]), outerRad))
+            if nOuter == 0:
+                # No visits anywhere in this cell.
+                continue
+            nInner = 0
+            if innerAngle > 0:
+                nInner = len(self.opsimtree.query_ball_point((sx[i], sy[i], sz[i]), innerRad))
+            if nInner == nOuter:
+                keep[i] = True
+            else:
+                split[i] = True
+        return keep, split, innerRad
+
+    def setupSlicer(self, simData, maps=None):
+        """Use simData[self.lonCol] and simData[self.latCol] (in radians) to find the cells, then
+        set up the slicer on them.
+
+        maps = list of map objects (such as dust extinction) that will run to build up
+        additional metadata at each slicePoint (available to metrics via slicePoint dictionary).
+        """
+        self._setRad(self.radius)
+        self._buildTree(simData[self.lonCol], simData[self.latCol], self.leafsize)
+        cellNside = []
+        cellPix = []
+        cellRa = []
+        cellDec = []
+        cellRad = []
+        nside = self.coarseNside
+        pix = np.arange(hp.nside2npix(nside))
+        while pix.size > 0:
+            lat, ra = hp.pix2ang(nside, pix, nest=True)
+            dec = np.pi/2.0 - lat
+            if nside == self.nside:
+                # Full resolution: use the healpixels as they are (empty healpixels are masked when run).
+                keep = np.ones(pix.size, bool)
+                split = np.zeros(pix.size, bool)
+                rad = self.rad
+            else:
+                keep, split, rad = self._splitCells(nside, *self._treexyz(ra, dec))
+            cellNside.append(np.zeros(keep.sum(), int) + nside)
+            cellPix.append(pix[keep])
+            cellRa.append(ra[keep])
+            cellDec.append(dec[keep])
+            cellRad.append(np.zeros(keep.sum()) + rad)
+            # Go on to the NESTED children of the cells which need to be split.
+            pix = (4 * pix[split][:, np.newaxis] + np.arange(4)).ravel()
+            nside *= 2
+        cellNside = np.concatenate(cellNside)
+        self._cellRad = np.concatenate(cellRad)
+        # Set the slicePoints to the cells.
+        self.slicePoints['sid'] = 4 * cellNside**2 + np.concatenate(cellPix)
+        self.slicePoints['cellNside'] = cellNside
+        self.slicePoints['ra'] = np.concatenate(cellRa)
+        self.slicePoints['dec'] = np.concatenate(cellDec)
+        self.nslice = len(cellNside)
+        self.shape = self.nslice
+        nPix = np.sum((self.nside // cellNside)**2)
+        self.evalFraction = self.nslice / float(max(nPix, 1))
+        if self.verbose:
+            print 'Adaptive healpix slicer evaluating %d cells for %d healpixels (fraction %f)' \
+                % (self.nslice, nPix, self.evalFraction)
+        super(HealpixAdaptiveSlicer, self).setupSlicer(simData, maps=maps)
+
+    def _indexPointings(self, simData):
+        """Return a function which returns the indexes of the relevant opsim data at a slicepoint.
+
+        The kdtree (built in setupSlicer) is queried at the cell center, with a radius for which
+        all of the healpixels in the cell see the same visits."""
+        def _sliceIdxs(islice):
+            """Return indexes for relevant opsim data at slicepoint
+            (slicepoint=lonCol/latCol value .. usually ra/dec)."""
+            sx, sy, sz = self._treexyz(self.slicePoints['ra'][islice], self.slicePoints['dec'][islice])
+            return self.opsimtree.query_ball_point((sx, sy, sz), self._cellRad[islice])
+        return _sliceIdxs
+
+    def _cellPixels(self):
+        """Return the (NESTED, full resolution) healpixels in the cells, and the index of each one's cell."""
+        cellNside = self.slicePoints['cellNside']
+        nChildren = (self.nside // cellNside)**2
+        firstPix = (self.slicePoints['sid'] - 4 * cellNside**2) * nChildren
+        offsets = np.arange(nChildren.sum()) - np.repeat(np.cumsum(nChildren) - nChildren, nChildren)
+        return np.repeat(firstPix, nChildren) + offsets, np.repeat(np.arange(self.nslice), nChildren)
+
+    def expandValues(self, metricValues):
+        """Expand metricValues (one value per cell) to one value per full resolution healpixel in the cells."""
+        return metricValues[self._cellPixels()[1]]
+
+    def fullSky(self, metricValues):
+        """Expand metricValues (one value per cell) to a full resolution, full-sky (RING) healpix map.
+
+        Healpixels outside the cells are masked."""
+        pixels, cells = self._cellPixels()
+        shape = (self.npix,) + np.shape(metricValues)[1:]
+        fullValues = ma.MaskedArray(data=np.zeros(shape, dtype=metricValues.dtype),
+                                    mask=np.ones(shape, dtype=bool), fill_value=self.badval)
+        fullValues[hp.nest2ring(self.nside, pixels)] = metricValues[cells]
+        return fullValues
@@ -1,7 +1,5 @@
 import numpy as np
 from .healpixSlicer import HealpixSlicer
-from functools import wraps
-import matplotlib.path as mplPath
 from lsst.sims.maf.utils.mafUtils import gnomonic_project_toxy
 from lsst.sims.maf.plots import HealpixSDSSSkyMap
 
@@ -18,54 +16,76 @@ class HealpixSDSSSlicer(HealpixSlicer):
                                             useCache=useCache,nside=nside )
         self.cornerLables = ['RA1', 'Dec1', 'RA2','Dec2','RA3','Dec3','RA4','Dec4']
         self.plotFuncs = [HealpixSDSSSkyMap,]
+        # Number of images to test against the healpixels at once in setupSlicer.
+        self.chunkSize = 10000
 
     def setupSlicer(self, simData, maps=None):
         """
-        Use simData[self.lonCol] and simData[self.latCol]
-        (in radians) to set up KDTree.
+        Use simData[self.lonCol] and simData[self.latCol] (in radians) and the image corners
+        to find the images containing each healpixel.
         """
-        self._runMaps(maps)
-        self._buildTree(simData[self.lonCol], simData[self.latCol], self.leafsize)
-        self._setRad(self.radius)
         self.corners = simData[self.cornerLables]
-        @wraps(self._sliceSimData)
-        def _sliceSimData(islice):
-            """Return indexes for relevant opsim data at slicepoint
-            (slicepoint=lonCol/latCol value .. usually ra/dec)."""
-            sx, sy, sz = self._treexyz(self.slicePoints['ra'][islice], self.slicePoints['dec'][islice])
-            # Query against tree.
-            initIndices = self.opsimtree.query_ball_point((sx, sy, sz), self.rad)
-            # Loop through all the images and check if the slicepoint is inside the corners of the chip
-            # XXX--should check if there's a better/faster way to do this.
-            # Maybe in the setupSlicer loop through each image, and use the contains_points method to test all the
-            # healpixels simultaneously?  Then just have a dict with keys = healpix id and values = list of indices?
-            # That way _sliceSimData is just doing a dict look-up and we can get rid of the spatialkey kwargs.
+        super(HealpixSDSSSlicer, self).setupSlicer(simData, maps=maps)
 
+    def _indexPointings(self, simData):
+        """Find the images containing each slicePoint, all at once.
 
-            indices=[]
-            # Gnomic project all the corners that are near the slice point, centered on slice point
-            x1,y1 = gnomonic_project_toxy(self.corners['RA1'][initIndices], self.corners['Dec1'][initIndices],
-                                          self.slicePoints['ra'][islice], self.slicePoints['dec'][islice])
-            x2,y2 = gnomonic_project_toxy(self.corners['RA2'][initIndices], self.corners['Dec2'][initIndices],
-                                          self.slicePoints['ra'][islice], self.slicePoints['dec'][islice])
-            x3,y3 = gnomonic_project_toxy(self.corners['RA3'][initIndices], self.corners['Dec3'][initIndices],
-                                          self.slicePoints['ra'][islice], self.slicePoints['dec'][islice])
-            x4,y4 = gnomonic_project_toxy(self.corners['RA4'][initIndices], self.corners['Dec4'][initIndices],
-                                          self.slicePoints['ra'][islice], self.slicePoints['dec'][islice])
+        For each chunk of images, the healpixels within radius of the spatial key (one corner) of each image
+        are found, then tested against the image corners; the pairs which pass are inverted into a
+        slicePoint -> image index, so slicing the data is a lookup.
+        Returns a function which returns the indexes of the images containing a slicePoint.
+        """
+        sid = self.slicePoints['sid']
+        islices = []
+        images = []
+        for start in xrange(0, len(simData), self.chunkSize):
+            pixels, chunkImages = self._pointingPixels(simData[self.lonCol][start:start + self.chunkSize],
+                                                       simData[self.latCol][start:start + self.chunkSize])
+            chunkImages += start
+            # Translate healpixels to slicePoint indexes (dropping healpixels which are not slicePoints).
+            chunkSlices = np.searchsorted(sid, pixels)
+            good = np.where(chunkSlices < self.nslice)[0]
+            good = good[sid[chunkSlices[good]] == pixels[good]]
+            chunkSlices = chunkSlices[good]
+            chunkImages = chunkImages[good]
+            inside = self._insideImages(self.slicePoints['ra'][chunkSlices],
+                                        self.slicePoints['dec'][chunkSlices], chunkImages)
+            islices.append(chunkSlices[inside])
+            images.append(chunkImages[inside])
+        islices = np.concatenate(islices + [np.array([], int)])
+        images = np.concatenate(images + [np.array([], int)])
+        # Invert into a slicePoint -> image index.
+        order = np.lexsort((images, islices))
+        sliceImages = images[order]
+        sliceStart = np.zeros(self.nslice + 1, dtype=int)
+        sliceStart[1:] = np.cumsum(np.bincount(islices, minlength=self.nslice))
 
-            for i,ind in enumerate(initIndices):
-                # Use matplotlib to make a polygon on
-                bbPath = mplPath.Path(np.array([[x1[i], y1[i]],
-                                                [x2[i], y2[i]],
-                                                [x3[i], y3[i]],
-                                                [x4[i], y4[i]],
-                                                [x1[i], y1[i]]] ))
-                # Check if the slicepoint is inside the image corners and append to list if it is
-                if bbPath.contains_point((0.,0.)) == 1:
-                    indices.append(ind)
+        def _sliceIdxs(islice):
+            """Return indexes for relevant opsim data at slicepoint
+            (the images containing the slicepoint)."""
+            return sliceImages[sliceStart[islice]:sliceStart[islice + 1]]
+        return _sliceIdxs
 
-            return {'idxs':indices,
-                    'slicePoint':{'sid':self.slicePoints['sid'][islice],
-                                  'ra':self.slicePoints['ra'][islice],
-                                  'dec':self.slicePoints['dec'][islice]}}
-        setattr(self, '_sliceSimData', _sliceSimData)
+    def _insideImages(self, ra, dec, images):
+        """Test if each point ra/dec (in radians) is inside the corners of the matching image.
+
+        The corners are gnomonic projected around the point, then the crossings of the image edges with the
+        ray from the point along +x are counted (an odd number of crossings means the point is inside).
+        Returns a boolean array.
+        """
+        x = []
+        y = []
+        for i in range(1, 5):
+            xi, yi = gnomonic_project_toxy(self.corners['RA%d' % i][images],
+                                           self.corners['Dec%d' % i][images], ra, dec)
+            x.append(xi)
+            y.append(yi)
+        inside = np.zeros(len(images), dtype=bool)
+        for i in range(4):
+            j = (i + 1) % 4
+            # Edges which cross y=0, and where they cross it.
+            crosses = np.where((y[i] > 0) != (y[j] > 0))[0]
+            xCross = x[i][crosses] - y[i][crosses] * (x[j][crosses] - x[i][crosses]) / \
+                (y[j][crosses] - y[i][crosses])
+            inside[crosses[xCross > 0]] ^= True
+        return inside
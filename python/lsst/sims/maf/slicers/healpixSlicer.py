@@ -5,6 +5,7 @@
 # Also requires numpy and pylab (for histogram and power spectrum plotting)
 
 import numpy as np
+import numpy.ma as ma
 import healpy as hp
 from lsst.sims.maf.plots.spatialPlotters import HealpixSkyMap, HealpixHistogram, HealpixPowerSpectrum
 
@@ -18,8 +19,22 @@ class HealpixSlicer(BaseSpatialSlicer):
     def __init__(self, nside=128, lonCol ='fieldRA' ,
                  latCol='fieldDec', verbose=True,
                  useCache=True, radius=1.75, leafsize=100,
-                 useCamera=False, chipNames='all', rotSkyPosColName='rotSkyPos', mjdColName='expMJD'):
-        """Instantiate and set up healpix slicer object."""
+                 useCamera=False, chipNames='all', rotSkyPosColName='rotSkyPos', mjdColName='expMJD',
+                 indexMethod='auto', sparse=False, footprint=None):
+        """Instantiate and set up healpix slicer object.
+
+        indexMethod = how to find the visits within radius of each healpixel:
+           'kdtree' queries a kdtree of the visit pointings once per healpixel,
+           'disc' finds the healpixels within radius of each unique pointing (one healpy query_disc per
+           pointing) and inverts these into a healpixel -> visit index,
+           'auto' uses 'disc' when there are fewer unique pointings than healpixels.
+           (not used when useCamera is True).
+        sparse = if True, only the healpixels within radius of any visit are used as slicePoints
+           (found in setupSlicer), so metricValues hold one value per covered healpixel, for the healpixels
+           in slicePoints['sid']. Use fullSky to expand these to a full-sky map.
+           Like the OpsimFieldSlicer, a sparse slicer should not be shared between different constraints.
+        footprint = healpixel ids (or a boolean mask over all healpixels) to use as the slicePoints,
+           instead of the full sky. Implies sparse, but the slicePoints do not depend on the visits."""
         super(HealpixSlicer, self).__init__(verbose=verbose,
                                             lonCol=lonCol, latCol=latCol,
                                             badval=hp.UNSEEN, radius=radius, leafsize=leafsize,
@@ -33,16 +48,24 @@ class HealpixSlicer(BaseSpatialSlicer):
         if not(hp.isnsideok(nside)):
             raise ValueError('Valid values of nside are powers of 2.')
         self.nside = int(nside)
+        if indexMethod not in ('auto', 'kdtree', 'disc'):
+            raise ValueError('indexMethod should be one of auto, kdtree or disc.')
+        self.indexMethod = indexMethod
+        # Largest number of (unique pointing, healpixel) pairs for which 'auto' uses the disc index.
+        self.maxDiscPairs = 50000000
         self.pixArea = hp.nside2pixarea(self.nside)
-        self.nslice = hp.nside2npix(self.nside)
-        self.spatialExtent = [0,self.nslice-1]
-        self.shape = self.nslice
+        self.npix = hp.nside2npix(self.nside)
+        self.spatialExtent = [0,self.npix-1]
+        self.sparse = sparse or (footprint is not None)
+        self.footprint = footprint
         if self.verbose:
             print 'Healpix slicer using NSIDE=%d, '%(self.nside) + \
             'approximate resolution %f arcminutes'%(hp.nside2resol(self.nside,arcmin=True))
         # Set variables so slicer can be re-constructed
         self.slicer_init = {'nside':nside, 'lonCol':lonCol, 'latCol':latCol,
                             'radius':radius}
+        if self.sparse:
+            self.slicer_init['sparse'] = True
         if useCache:
             # useCache set the size of the cache for the memoize function in sliceMetric.
             binRes = hp.nside2resol(nside) # Pixel size in radians
@@ -50,8 +73,14 @@ class HealpixSlicer(BaseSpatialSlicer):
             self.cacheSize = int(np.round(4.*np.pi/binRes))
         # Set up slicePoint metadata.
         self.slicePoints['nside'] = nside
-        self.slicePoints['sid'] = np.arange(self.nslice)
-        self.slicePoints['ra'], self.slicePoints['dec'] = self._pix2radec(self.slicePoints['sid'])
+        if footprint is None:
+            self._setPixels(np.arange(self.npix))
+        else:
+            footprint = np.asarray(footprint)
+            if footprint.dtype == bool:
+                self._setPixels(np.where(footprint)[0])
+            else:
+                self._setPixels(np.unique(footprint))
         # Set the default plotting functions.
         self.plotFuncs = [HealpixSkyMap, HealpixHistogram, HealpixPowerSpectrum]
 
@@ -67,9 +96,125 @@ class HealpixSlicer(BaseSpatialSlicer):
                             if otherSlicer.chipsToUse == self.chipsToUse:
                                 if otherSlicer.rotSkyPosColName == self.rotSkyPosColName:
                                     if np.all(otherSlicer.shape == self.shape):
-                                        result = True
+                                        if np.array_equal(otherSlicer.slicePoints['sid'],
+                                                          self.slicePoints['sid']):
+                                            result = True
         return result
 
+    def _setPixels(self, pixels):
+        """Use the healpixels pixels (sorted) as the slicePoints."""
+        self.slicePoints['sid'] = pixels
+        self.slicePoints['ra'], self.slicePoints['dec'] = self._pix2radec(pixels)
+        self.nslice = len(pixels)
+        self.shape = self.nslice
+
+    def setupSlicer(self, simData, maps=None):
+        """Use simData[self.lonCol] and simData[self.latCol] (in radians) to set up the slicer.
+
+        If the slicer is sparse (and no footprint was given), the slicePoints are first reduced to the
+        healpixels within radius of any of the simData pointings.
+        maps = list of map objects (such as dust extinction) that will run to build up
+        additional metadata at each slicePoint (available to metrics via slicePoint dictionary).
+        """
+        if self.sparse and self.footprint is None and len(simData) > 0:
+            self._setRad(self.radius)
+            pointingLon, pointingLat = self._uniquePointings(simData)[2:]
+            pixels = self._pointingPixels(pointingLon, pointingLat)[0]
+            self._setPixels(np.unique(pixels))
+        super(HealpixSlicer, self).setupSlicer(simData, maps=maps)
+
+    def fullSky(self, metricValues):
+        """Expand metricValues (one value per slicePoint) to a full-sky healpix map.
+
+        Healpixels which are not slicePoints are masked. If the slicer is not sparse, metricValues
+        are returned unchanged.
+        """
+        sid = self.slicePoints['sid']
+        if len(sid) == self.npix:
+            return metricValues
+        shape = (self.npix,) + np.shape(metricValues)[1:]
+        fullValues = ma.MaskedArray(data=np.zeros(shape, dtype=metricValues.dtype),
+                                    mask=np.ones(shape, dtype=bool), fill_value=self.badval)
+        fullValues[sid] = metricValues
+        return fullValues
+
+    def _uniquePointings(self, simData):
+        """Group the simData visits by pointing.
+
+        Returns the order of the visits sorted by pointing (the visits at each pointing stay in their
+        original order), the start of each pointing's visits within this order, and the unique pointings.
+        """
+        lon = simData[self.lonCol]
+        lat = simData[self.latCol]
+        if np.any(np.abs(lon) > np.pi*2.0) or np.any(np.abs(lat) > np.pi*2.0):
+            raise ValueError('Expecting RA and Dec values to be in radians.')
+        visitOrder = np.lexsort((lat, lon))
+        newPointing = np.ones(len(lon), dtype=bool)
+        newPointing[1:] = ((lon[visitOrder][1:] != lon[visitOrder][:-1]) |
+                           (lat[visitOrder][1:] != lat[visitOrder][:-1]))
+        pointingStart = np.append(np.where(newPointing)[0], len(lon))
+        return visitOrder, pointingStart, lon[visitOrder][newPointing], lat[visitOrder][newPointing]
+
+    def _pointingPixels(self, pointingLon, pointingLat):
+        """Find the healpixels whose centers are within rad of each pointing.
+
+        Returns the (healpixel, pointing index) pairs.
+        query_disc (inclusive) returns all healpixels overlapping the disc; these are then trimmed with
+        the same chord distance test as the kdtree, so both methods match the same healpixels.
+        """
+        px, py, pz = self._treexyz(pointingLon, pointingLat)
+        pixels = []
+        for vec in zip(px, py, pz):
+            pixels.append(hp.query_disc(self.nside, vec, np.radians(self.radius), inclusive=True))
+        nPix = np.array([len(pix) for pix in pixels], dtype=int)
+        pixels = np.concatenate(pixels).astype(int)
+        pointings = np.repeat(np.arange(len(pointingLon)), nPix)
+        sx, sy, sz = self._treexyz(*self._pix2radec(pixels))
+        dist2 = (sx - px[pointings])**2 + (sy - py[pointings])**2 + (sz - pz[pointings])**2
+        good = np.where(dist2 <= self.rad**2)[0]
+        return pixels[good], pointings[good]
+
+    def _indexPointings(self, simData):
+        """Set up the index of the simData pointings used to slice the data.
+
+        With the 'disc' indexMethod, the visits are grouped by pointing and the healpixels within radius
+        of each unique pointing are found with one healpy query_disc (so dithered surveys, with
+        about as many pointings as visits, are better served by the kdtree).
+        Returns a function which returns the indexes of the relevant opsim data at a slicepoint.
+        """
+        if self.indexMethod == 'kdtree' or len(simData) == 0:
+            return super(HealpixSlicer, self)._indexPointings(simData)
+        visitOrder, pointingStart, pointingLon, pointingLat = self._uniquePointings(simData)
+        nPointings = len(pointingLon)
+        if self.indexMethod == 'auto':
+            discArea = 2.0 * np.pi * (1.0 - np.cos(np.radians(self.radius)))
+            nPairs = nPointings * discArea / self.pixArea
+            if nPointings >= self.nslice or nPairs > self.maxDiscPairs:
+                return super(HealpixSlicer, self)._indexPointings(simData)
+        pixels, pointings = self._pointingPixels(pointingLon, pointingLat)
+        # Translate healpixels to slicePoint indexes (dropping healpixels which are not slicePoints).
+        sid = self.slicePoints['sid']
+        islices = np.searchsorted(sid, pixels)
+        good = np.where(islices < self.nslice)[0]
+        good = good[sid[islices[good]] == pixels[good]]
+        islices = islices[good]
+        pointings = pointings[good]
+        # Invert into a slicePoint -> pointing index.
+        order = np.argsort(islices, kind='mergesort')
+        slicePointings = pointings[order]
+        sliceStart = np.zeros(self.nslice + 1, dtype=int)
+        sliceStart[1:] = np.cumsum(np.bincount(islices, minlength=self.nslice))
+
+        def _sliceIdxs(islice):
+            """Return indexes for relevant opsim data at slicepoint
+            (slicepoint=lonCol/latCol value .. usually ra/dec)."""
+            match = slicePointings[sliceStart[islice]:sliceStart[islice + 1]]
+            nVisits = pointingStart[match + 1] - pointingStart[match]
+            # Expand each matched pointing into the positions of its visits within visitOrder.
+            offsets = np.arange(nVisits.sum()) - np.repeat(np.cumsum(nVisits) - nVisits, nVisits)
+            return np.sort(visitOrder[np.repeat(pointingStart[match], nVisits) + offsets])
+        return _sliceIdxs
+
     def _pix2radec(self, islice):
         """Given the pixel number / sliceID, return the RA/Dec of the pointing, in radians."""
         # Calculate RA/Dec in RADIANS of pixel in this healpix slicer.
@@ -6,6 +6,7 @@ import warnings
 from lsst.sims.maf.plots.spatialPlotters import OpsimHistogram, BaseSkyMap
 
 from .baseSpatialSlicer import BaseSpatialSlicer
+from .baseSlicer import SlicePoint
 
 __all__ = ['OpsimFieldSlicer']
 
@@ -81,18 +82,17 @@ class OpsimFieldSlicer(BaseSpatialSlicer):
                                   simData[self.simDataFieldIDColName].max()]
         self.shape = self.nslice
 
-        @wraps(self._sliceSimData)
+        # Classify the slicePoint metadata once, for the SlicePoint views.
+        self._setupSlicePointColumns(globalKeys=('bins', 'binCol'))
+
+        def _sliceIdxs(islice):
+            return self.simIdxs[self.left[islice]:self.right[islice]]
+        self._sliceIdxs = _sliceIdxs
 
+        @wraps(self._sliceSimData)
         def _sliceSimData(islice):
-            idxs = self.simIdxs[self.left[islice]:self.right[islice]]
-            # Build dict for slicePoint info
-            slicePoint={}
-            for key in self.slicePoints.keys():
-                if (np.shape(self.slicePoints[key])[0] == self.nslice) & (key is not 'bins') & (key is not 'binCol'):
-                    slicePoint[key] = self.slicePoints[key][islice]
-                else:
-                    slicePoint[key] = self.slicePoints[key]
-            return {'idxs':idxs, 'slicePoint':slicePoint}
+            return {'idxs': _sliceIdxs(islice),
+                    'slicePoint': dict(SlicePoint(self._slicePointColumns, islice))}
         setattr(self, '_sliceSimData', _sliceSimData)
 
     def __eq__(self, otherSlicer):
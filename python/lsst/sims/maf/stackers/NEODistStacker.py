@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from .baseStacker import BaseStacker
 
@@ -12,12 +13,15 @@ class NEODistStacker(BaseStacker):
 
     def __init__(self, m5Col='fiveSigmaDepth',
                  stepsize=.001, maxDist=3.,minDist=.3, H=22, elongCol='solarElong',
-                 filterCol='filter',sunAzCol='sunAz', azCol='azimuth', **kwargs):
+                 filterCol='filter',sunAzCol='sunAz', azCol='azimuth', elongStep=0.1,
+                 cacheDir=None, **kwargs):
 
         """
         stepsize:  The stepsize to use when solving (in AU)
         maxDist: How far out to try and measure (in AU)
         H: Asteroid magnitude
+        elongStep: The spacing (in degrees) of the solar elongation grid of the lookup table.
+        cacheDir: If set, the lookup table is saved to (and read from) this directory.
 
         Adds columns:
         MaxGeoDist:  Geocentric distance to the NEO
@@ -50,10 +54,90 @@ class NEODistStacker(BaseStacker):
         self.a2 = 1.87
         self.b2 = 1.22
 
+        self.elongGrid = np.arange(0., 180. + elongStep / 2., elongStep)
+        self.cacheDir = cacheDir
+        self._magTable = None
 
-    def run(self,simData):
+    def _appMag(self, elongRad):
+        """
+        Calculate the apparent magnitude of the NEO at each distance in self.deltas,
+        for each of the solar elongations (radians) in elongRad. Returns an array of shape
+        (len(elongRad), len(self.deltas)).
+        """
+        elong = np.asarray(elongRad)[:, np.newaxis]
+        # Law of cosines:
+        # Heliocentric Radius of the object
+        R = np.sqrt(1.+self.deltas**2-2.*self.deltas*np.cos(elong) )
+        # Angle between sun and earth as seen by NEO
+        alphas = np.arccos( (1.-R**2-self.deltas**2)/(-2.*self.deltas*R) )
+        ta2 = np.tan(alphas/2.)
+        phi1 = np.exp(-self.a1*ta2**self.b1)
+        phi2 = np.exp(-self.a2*ta2**self.b2)
+
+        alpha_term = 2.5*np.log10( (1.- self.G)*phi1+self.G*phi2)
+        appmag = self.H+5.*np.log10(R*self.deltas)-alpha_term
+        return appmag
+
+    def _faintestMag(self, elongRad):
+        """
+        Calculate the faintest apparent magnitude reached by the NEO out to each distance in self.deltas,
+        for each of the solar elongations in elongRad (i.e. the running maximum of self._appMag).
+        """
+        # The grid includes zero elongation, where the phase angle is undefined.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            appmag = self._appMag(elongRad)
+        # Undefined magnitudes never count as too faint.
+        appmag = np.where(np.isnan(appmag), -np.inf, appmag)
+        return np.maximum.accumulate(appmag, axis=1)
+
+    def _tableFile(self):
+        """Name of the on-disk copy of the lookup table for this stacker configuration."""
+        config = (self.H, self.G, self.deltas[0], self.deltas[-1], len(self.deltas),
+                  self.elongGrid[1] - self.elongGrid[0], self.a1, self.b1, self.a2, self.b2)
+        name = 'neoDistTable_%s.npz' % ('_'.join(['%g' % c for c in config]))
+        return os.path.join(self.cacheDir, name)
+
+    def _buildTable(self):
+        """
+        Build the lookup table of the faintest magnitude reached out to each distance in self.deltas,
+        for each solar elongation in self.elongGrid.
+
+        There can be some local minima/maxima in the apparent magnitude with distance, so we
+        need to find the *1st* distance where the NEO is too faint for a limiting magnitude v5: this is the
+        first distance where the faintest magnitude so far is fainter than v5.
+        """
+        if self.cacheDir is not None:
+            filename = self._tableFile()
+            if os.path.isfile(filename):
+                self._magTable = np.load(filename)['magTable']
+                return
+        self._magTable = self._faintestMag(np.radians(self.elongGrid))
+        if self.cacheDir is not None:
+            try:
+                if not os.path.isdir(self.cacheDir):
+                    os.makedirs(self.cacheDir)
+            except OSError:
+                # Another process may have made it.
+                pass
+            # Write to a temporary file first, so other processes never see a partly written file.
+            tmpFilename = filename + '.%d.tmp' % os.getpid()
+            try:
+                with open(tmpFilename, 'wb') as f:
+                    np.savez(f, magTable=self._magTable)
+                os.rename(tmpFilename, filename)
+            except (IOError, OSError):
+                pass
+
+    def _tooFaintIdx(self, elongIdx, v5):
+        """
+        Find the index of the first distance where the NEO is fainter than v5, at the elongation
+        self.elongGrid[elongIdx].
+        """
+        return np.searchsorted(self._magTable[elongIdx], v5, side='right')
 
-        simData=self._addStackers(simData)
+    def _run(self,simData):
+        if self._magTable is None:
+            self._buildTable()
 
         elongRad = np.radians(simData[self.elongCol])
         v5 = np.zeros(simData.size, dtype=float) + simData[self.m5Col]
@@ -61,24 +145,46 @@ class NEODistStacker(BaseStacker):
             fmatch = np.where(simData[self.filterCol] == filterName)
             v5[fmatch] += self.limitingAdjust[filterName]
 
-        for i,elong in enumerate(elongRad):
-            # Law of cosines:
-            # Heliocentric Radius of the object
-            R = np.sqrt(1.+self.deltas**2-2.*self.deltas*np.cos(elong) )
-            # Angle between sun and earth as seen by NEO
-            alphas = np.arccos( (1.-R**2-self.deltas**2)/(-2.*self.deltas*R) )
-            ta2 = np.tan(alphas/2.)
-            phi1 = np.exp(-self.a1*ta2**self.b1)
-            phi2 = np.exp(-self.a2*ta2**self.b2)
-
-            alpha_term = 2.5*np.log10( (1.- self.G)*phi1+self.G*phi2)
-            appmag = self.H+5.*np.log10(R*self.deltas)-alpha_term
-            # There can be some local minima/maxima when solving, so
-            # need to find the *1st* spot where it is too faint, not the
-            # last spot it is bright enough.
-            tooFaint = np.where(appmag > v5[i])
-
-            simData['MaxGeoDist'][i] = np.min(self.deltas[tooFaint])
+        # Find the elongation grid points on either side of each visit.
+        elongStep = self.elongGrid[1] - self.elongGrid[0]
+        gridPos = np.clip(simData[self.elongCol] / elongStep, 0, self.elongGrid.size - 1)
+        lower = np.minimum(np.floor(gridPos).astype(int), self.elongGrid.size - 2)
+        weight = gridPos - lower
+        # Find where the NEO becomes too faint at each of those grid points (grouping visits by grid point).
+        idxLower = np.zeros(simData.size, int)
+        idxUpper = np.zeros(simData.size, int)
+        order = np.argsort(lower)
+        gridIdxs = np.arange(self.elongGrid.size - 1)
+        left = np.searchsorted(lower[order], gridIdxs, side='left')
+        right = np.searchsorted(lower[order], gridIdxs, side='right')
+        for elongIdx in np.where(right > left)[0]:
+            match = order[left[elongIdx]:right[elongIdx]]
+            idxLower[match] = self._tooFaintIdx(elongIdx, v5[match])
+            idxUpper[match] = self._tooFaintIdx(elongIdx + 1, v5[match])
+        # The magnitudes interpolated between the two grid points are also non-decreasing with distance,
+        # and become too faint between these two indexes: bisect to find the first too-faint distance.
+        lo = np.minimum(idxLower, idxUpper)
+        hi = np.maximum(idxLower, idxUpper)
+        # Where the too-faint distance changes rapidly with elongation (near local maxima of the
+        # apparent magnitude), interpolating between grid points is not reliable: solve these visits directly.
+        direct = np.where(hi - lo > 5)[0]
+        for start in range(0, direct.size, 1000):
+            chunk = direct[start:start + 1000]
+            faintestMag = self._faintestMag(elongRad[chunk])
+            lo[chunk] = np.sum(faintestMag <= v5[chunk][:, np.newaxis], axis=1)
+            hi[chunk] = lo[chunk]
+        # (Only the visits still being bisected: finished visits may have lo == hi == self.deltas.size.)
+        active = np.where(lo < hi)[0]
+        while active.size > 0:
+            mid = (lo[active] + hi[active]) // 2
+            mag = (self._magTable[lower[active], mid] * (1. - weight[active]) +
+                   self._magTable[lower[active] + 1, mid] * weight[active])
+            tooFaint = mag > v5[active]
+            hi[active] = np.where(tooFaint, mid, hi[active])
+            lo[active] = np.where(tooFaint, lo[active], mid + 1)
+            active = active[lo[active] < hi[active]]
+        # If the NEO is never too faint, use the maximum distance.
+        simData['MaxGeoDist'] = self.deltas[np.minimum(lo, self.deltas.size - 1)]
 
         # Make coords in heliocentric
         interior = np.where(elongRad <= np.pi/2.)
@@ -58,6 +58,9 @@ class BaseStacker(object):
         self.colsAddedDtypes = None
         # Optional: provide a list of units for the columns defined in colsAdded.
         self.units = [None]
+        # Optional: list of 'key' columns (such as fieldRA/fieldDec) which fully determine the
+        #  values of colsAdded. If set, _run is only evaluated once per unique combination of key values.
+        self.keyCols = None
 
     def __eq__(self, otherStacker):
         """
@@ -128,6 +131,41 @@ class BaseStacker(object):
             newData[col] = simData[col]
         return newData
 
+    def _uniqueKeys(self, simData, keyCols):
+        """
+        Find the unique combinations of values in the columns keyCols of simData.
+
+        Returns the indexes of one representative row in simData for each unique combination of key values,
+        and the inverse index array mapping each row of simData back onto those representatives
+        (equivalent to np.unique(..., return_index=True, return_inverse=True) over multiple columns).
+        """
+        # Sort on all key columns (lexsort sorts on the last key first).
+        order = np.lexsort([simData[col] for col in keyCols[::-1]])
+        # Flag the places in the sorted data where any key value changes.
+        newKey = np.zeros(len(order), dtype=bool)
+        newKey[0] = True
+        for col in keyCols:
+            sortedCol = simData[col][order]
+            newKey[1:] |= (sortedCol[1:] != sortedCol[:-1])
+        uniqueIdxs = order[newKey]
+        inverse = np.empty(len(order), dtype=int)
+        inverse[order] = np.cumsum(newKey) - 1
+        return uniqueIdxs, inverse
+
+    def _runOnKeys(self, simData, keyCols):
+        """
+        Run the stacker only once per unique set of values in keyCols, then broadcast the results
+        in colsAdded back to all rows of simData.
+        """
+        uniqueIdxs, inverse = self._uniqueKeys(simData, keyCols)
+        # Nothing to be gained if every row is unique.
+        if len(uniqueIdxs) == len(simData):
+            return self._run(simData)
+        uniqueData = self._run(simData[uniqueIdxs])
+        for col in self.colsAdded:
+            simData[col] = uniqueData[col][inverse]
+        return simData
+
     def run(self, simData):
         """
         Example: Generate the new stacker columns, given the simdata columns from the database.
@@ -138,6 +176,11 @@ class BaseStacker(object):
             return simData
         simData=self._addStackers(simData)
         # Run the method to calculate/add new data.
+        # If the new columns only depend on a set of key columns (e.g. the pointing), just calculate
+        #  them once per unique set of key values.
+        keyCols = getattr(self, 'keyCols', None)
+        if keyCols is not None:
+            return self._runOnKeys(simData, keyCols)
         return self._run(simData)
 
     def _run(self, simData):
@@ -27,6 +27,8 @@ class GalacticStacker(BaseStacker):
         self.units = ['radians', 'radians']
         self.raCol = raCol
         self.decCol = decCol
+        # Galactic coordinates only depend on the pointing, so only calculate once per field.
+        self.keyCols = [raCol, decCol]
 
     def _run(self, simData):
         # raCol and DecCol in radians, gall/b in radians.
@@ -50,16 +52,22 @@ class EclipticStacker(BaseStacker):
         self.decCol=decCol
 
     def _run(self, simData):
-        for i in np.arange(simData.size):
-            coord = ephem.Equatorial(simData[self.raCol][i],simData[self.decCol][i], epoch=2000)
+        # The ecliptic coordinates only depend on the pointing, so calculate them once per unique RA/Dec.
+        uniqueIdxs, inverse = self._uniqueKeys(simData, [self.raCol, self.decCol])
+        eclipLat = np.zeros(len(uniqueIdxs), float)
+        eclipLon = np.zeros(len(uniqueIdxs), float)
+        for i, idx in enumerate(uniqueIdxs):
+            coord = ephem.Equatorial(simData[self.raCol][idx], simData[self.decCol][idx], epoch=2000)
             ecl = ephem.Ecliptic(coord)
-            simData['eclipLat'][i] = ecl.lat
-            if self.subtractSunLon:
+            eclipLat[i] = ecl.lat
+            eclipLon[i] = ecl.lon
+        simData['eclipLat'] = eclipLat[inverse]
+        simData['eclipLon'] = eclipLon[inverse]
+        if self.subtractSunLon:
+            # The sun's position changes with time, so this part must be done per visit.
+            for i in np.arange(simData.size):
                 djd = mjd2djd(simData[self.mjdCol][i])
                 sun = ephem.Sun(djd)
                 sunEcl = ephem.Ecliptic(sun)
-                lon = wrapRA(ecl.lon - sunEcl.lon)
-                simData['eclipLon'][i] = lon
-            else:
-                simData['eclipLon'][i] = ecl.lon
+                simData['eclipLon'][i] = wrapRA(simData['eclipLon'][i] - sunEcl.lon)
         return simData
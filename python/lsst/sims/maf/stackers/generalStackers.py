@@ -59,6 +59,13 @@ class ZenithDistStacker(BaseStacker):
 class ParallaxFactorStacker(BaseStacker):
     """
     Calculate the parallax factors for each opsim pointing.  Output parallax factor in arcseconds.
+
+    The parallax factors are the offsets (projected onto the tangent plane at the pointing) between the
+    apparent place of a star with a parallax of 1 arcsecond and one with no parallax.
+    The star-independent mean-to-apparent parameters (palpy.mappa) vary smoothly with time, so they
+    are calculated once per day (for the days bracketing each visit) and interpolated to the time of
+    each visit; the mean-to-apparent transformation (as in palpy.mapqk) is then applied to the visits
+    using array operations. This agrees with per-visit palpy.mappa/mapqk calls to better than 0.1 milliarcseconds.
     """
     def __init__(self, raCol='fieldRA', decCol='fieldDec', dateCol='expMJD'):
         self.raCol = raCol
@@ -67,37 +74,80 @@ class ParallaxFactorStacker(BaseStacker):
         self.units = ['arcsec', 'arcsec']
         self.colsAdded = ['ra_pi_amp', 'dec_pi_amp']
         self.colsReq = [raCol, decCol, dateCol]
+        # Spacing (in days) of the table of mean-to-apparent parameters.
+        self.mappaStep = 1.0
+        # Number of visits to process at once.
+        self.chunkSize = 10000
 
-    def _gnomonic_project_toxy(self, RA1, Dec1, RAcen, Deccen):
+    def _mappaTable(self, mjd):
+        """
+        Calculate the palpy.mappa parameters (for equinox 2000) on a grid of times (spaced by
+        self.mappaStep days), covering only the grid points which bracket the values of mjd.
+        Returns the grid node numbers, the parameters at each node and the slope between each node and
+        the next (both arranged as (parameter, node), so each parameter is contiguous in memory).
+        """
+        gridIdx = np.floor(mjd / self.mappaStep).astype(int)
+        nodes = np.unique(np.concatenate([gridIdx, gridIdx + 1]))
+        table = np.array([palpy.mappa(2000., node * self.mappaStep) for node in nodes]).T
+        # Every node in gridIdx is followed by its neighbor (gridIdx + 1) in nodes.
+        slope = np.zeros(table.shape, float)
+        slope[:, :-1] = table[:, 1:] - table[:, :-1]
+        return nodes, table, slope
+
+    def _apparentXY(self, q, eRa, eDec, px, amprms):
         """
-        Calculate x/y projection of RA1/Dec1 in system with center at RAcen, Deccenp.
-        Input radians.
+        Calculate the geocentric apparent place of stars at the mean places q (unit vectors, shape (3, n)),
+        with parallax px (arcseconds) and no proper motion or radial velocity, following palpy.mapqk.
+        amprms are the mean-to-apparent parameters for each star, with shape (21, n).
+        The apparent places are returned as x/y gnomonic projections onto the tangent plane at q
+        (with unit vectors eRa and eDec along the RA and Dec directions).
         """
-        # also used in Global Telescope Network website
-        cosc = np.sin(Deccen) * np.sin(Dec1) + np.cos(Deccen) * np.cos(Dec1) * np.cos(RA1-RAcen)
-        x = np.cos(Dec1) * np.sin(RA1-RAcen) / cosc
-        y = (np.cos(Deccen)*np.sin(Dec1) - np.sin(Deccen)*np.cos(Dec1)*np.cos(RA1-RAcen)) / cosc
+        # Geocentric direction of star (normalised).
+        p = q - np.radians(px / 3600.) * amprms[1:4]
+        pn = p / np.sqrt(np.sum(p**2, axis=0))
+        # Light deflection (restrained within the Sun's disc).
+        ehn = amprms[4:7]
+        pde = np.sum(pn * ehn, axis=0)
+        w = amprms[7] / np.maximum(pde + 1.0, 1.0e-5)
+        p1 = pn + w * (ehn - pde * pn)
+        # Aberration.
+        abv = amprms[8:11]
+        ab1 = amprms[11]
+        p1dv = np.sum(p1 * abv, axis=0)
+        w = 1.0 + p1dv / (ab1 + 1.0)
+        p2 = (ab1 * p1 + w * abv) / (p1dv + 1.0)
+        # Precession and nutation.
+        p3 = np.einsum('ijn,jn->in', amprms[12:21].reshape(3, 3, -1), p2)
+        # Gnomonic projection onto the tangent plane at the mean place.
+        cosc = np.sum(p3 * q, axis=0)
+        x = np.sum(p3 * eRa, axis=0) / cosc
+        y = np.sum(p3 * eDec, axis=0) / cosc
         return x, y
 
     def _run(self, simData):
-        ra_pi_amp = np.zeros(np.size(simData), dtype=[('ra_pi_amp','float')])
-        dec_pi_amp = np.zeros(np.size(simData), dtype=[('dec_pi_amp','float')])
-        ra_geo1 = np.zeros(np.size(simData), dtype='float')
-        dec_geo1 = np.zeros(np.size(simData), dtype='float')
-        ra_geo = np.zeros(np.size(simData), dtype='float')
-        dec_geo = np.zeros(np.size(simData), dtype='float')
-        for i,ack in enumerate(simData):
-            mtoa_params = palpy.mappa(2000., simData[self.dateCol][i])
-            ra_geo1[i],dec_geo1[i] = palpy.mapqk(simData[self.raCol][i],simData[self.decCol][i],
-                                                   0.,0.,1.,0.,mtoa_params)
-            ra_geo[i],dec_geo[i] = palpy.mapqk(simData[self.raCol][i],simData[self.decCol][i],
-                                                 0.,0.,0.,0.,mtoa_params)
-        x_geo1,y_geo1 = self._gnomonic_project_toxy(ra_geo1, dec_geo1, simData[self.raCol],simData[self.decCol])
-        x_geo, y_geo = self._gnomonic_project_toxy(ra_geo, dec_geo, simData[self.raCol], simData[self.decCol])
-        ra_pi_amp[:] = np.degrees(x_geo1-x_geo)*3600.
-        dec_pi_amp[:] = np.degrees(y_geo1-y_geo)*3600.
-        simData['ra_pi_amp'] = ra_pi_amp
-        simData['dec_pi_amp'] = dec_pi_amp
+        nodes, table, slope = self._mappaTable(simData[self.dateCol])
+        # Work through the visits in chunks, to keep the temporary arrays small.
+        for start in range(0, len(simData), self.chunkSize):
+            chunk = slice(start, start + self.chunkSize)
+            ra = simData[self.raCol][chunk]
+            dec = simData[self.decCol][chunk]
+            mjd = simData[self.dateCol][chunk]
+            # Interpolate the mean-to-apparent parameters to the time of each visit.
+            gridIdx = np.floor(mjd / self.mappaStep).astype(int)
+            left = np.searchsorted(nodes, gridIdx)
+            amprms = table[:, left] + slope[:, left] * (mjd / self.mappaStep - gridIdx)
+            # Unit vectors toward the mean place and along the RA and Dec directions.
+            cosRa = np.cos(ra)
+            sinRa = np.sin(ra)
+            cosDec = np.cos(dec)
+            sinDec = np.sin(dec)
+            q = np.array([cosDec * cosRa, cosDec * sinRa, sinDec])
+            eRa = np.array([-sinRa, cosRa, np.zeros(len(ra), float)])
+            eDec = np.array([-sinDec * cosRa, -sinDec * sinRa, cosDec])
+            x_geo1, y_geo1 = self._apparentXY(q, eRa, eDec, 1., amprms)
+            x_geo, y_geo = self._apparentXY(q, eRa, eDec, 0., amprms)
+            simData['ra_pi_amp'][chunk] = np.degrees(x_geo1 - x_geo) * 3600.
+            simData['dec_pi_amp'][chunk] = np.degrees(y_geo1 - y_geo) * 3600.
         return simData
 
 class HourAngleStacker(BaseStacker):
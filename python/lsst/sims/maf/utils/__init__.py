@@ -3,3 +3,5 @@ from .getDateVersion import *
 from .outputUtils import *
 from .opsimUtils import *
 from .astrometryUtils import *
+from .siteEphemeris import *
+from .hashUtils import *
@@ -0,0 +1,139 @@
+import hashlib
+import inspect
+import numpy as np
+
+__all__ = ['configHash', 'metricHash']
+
+
+def configHash(obj, ignore=()):
+    """
+    Calculate a hash identifying the configuration of an object (such as a metric, slicer or stacker).
+
+    Objects are identified by their class and their public (not underscore) attributes (or __slots__),
+    recursively; numpy arrays by their dtype, shape and values; functions and classes by their module and name
+    (and python functions, such as lambdas and closures, also by their code, default arguments and the values
+    they close over).
+    Any other objects are identified by their repr (so objects whose repr does not show their state,
+    only their address, never have the same hash as another object).
+    The hash does not depend on the order of dictionary or set items.
+
+    Parameters
+    ----------
+    obj : object
+        The object to hash.
+    ignore : list of str, optional
+        Attributes (or dictionary keys) of obj to leave out of the hash.
+
+    Returns
+    -------
+    str
+        The md5 hex digest.
+    """
+    md5 = hashlib.md5()
+    _updateHash(md5, obj, ignore, set())
+    return md5.hexdigest()
+
+
+def metricHash(metric):
+    """
+    Calculate a hash identifying the calculation done by a metric.
+
+    Attributes which only label the metric values (the name, units and comment) are left out,
+    as are the reduce functions, which are identified by the metric class.
+
+    Parameters
+    ----------
+    metric : lsst.sims.maf.metrics.BaseMetric
+        The metric to hash.
+
+    Returns
+    -------
+    str
+        The md5 hex digest.
+    """
+    return configHash(metric, ignore=('name', 'units', 'comment', 'reduceFuncs', 'reduceOrder'))
+
+
+def _updateHash(md5, obj, ignore, seen):
+    """Add obj to the md5 hash (see configHash)."""
+    if isinstance(obj, np.ndarray):
+        md5.update('ndarray %s %s' % (obj.dtype.descr, obj.shape))
+        if obj.dtype.hasobject:
+            for item in obj.flat:
+                _updateHash(md5, item, (), seen)
+        else:
+            md5.update(np.ascontiguousarray(obj).tostring())
+    elif obj is None or isinstance(obj, (bool, int, long, float, complex, basestring, np.generic)):
+        md5.update('%s %r' % (type(obj).__name__, obj))
+    elif isinstance(obj, (list, tuple)):
+        md5.update('%s %d' % (type(obj).__name__, len(obj)))
+        for item in obj:
+            _updateHash(md5, item, (), seen)
+    elif isinstance(obj, dict):
+        md5.update('dict')
+        for key in sorted(obj, key=repr):
+            if key not in ignore:
+                _updateHash(md5, key, (), seen)
+                _updateHash(md5, obj[key], (), seen)
+    elif isinstance(obj, (set, frozenset)):
+        md5.update('set %s' % sorted([configHash(item) for item in obj]))
+    elif inspect.isroutine(obj) or inspect.isclass(obj) or isinstance(obj, np.ufunc):
+        md5.update('%s %s' % (getattr(obj, '__module__', None), getattr(obj, '__name__', None)))
+        # Bound methods are also identified by the class of their instance.
+        if getattr(obj, '__self__', None) is not None:
+            md5.update(obj.__self__.__class__.__name__)
+        # Lambdas (and closures made by the same function) share their module and name,
+        # so python functions are also identified by what they do.
+        func = getattr(obj, '__func__', obj)
+        if inspect.isfunction(func):
+            if id(func) in seen:
+                return
+            seen.add(id(func))
+            _updateHash(md5, func.func_code, (), seen)
+            _updateHash(md5, func.func_defaults, (), seen)
+            _updateHash(md5, [_cellContents(cell) for cell in func.func_closure or ()], (), seen)
+    elif inspect.iscode(obj):
+        # Code objects are identified by their bytecode, the (global and attribute) names and the constants
+        # it uses (which include the code of any nested functions), but not where it was defined.
+        md5.update('code %r %r' % (obj.co_code, obj.co_names))
+        _updateHash(md5, obj.co_consts, (), seen)
+    elif hasattr(obj, '__dict__'):
+        md5.update('%s %s' % (obj.__class__.__module__, obj.__class__.__name__))
+        # Avoid loops between objects which refer to each other.
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        state = dict([(key, val) for key, val in vars(obj).iteritems()
+                      if not key.startswith('_') and key not in ignore])
+        _updateHash(md5, state, (), seen)
+    elif _slots(obj):
+        md5.update('%s %s' % (obj.__class__.__module__, obj.__class__.__name__))
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        state = dict([(key, getattr(obj, key)) for key in _slots(obj)
+                      if not key.startswith('_') and key not in ignore and hasattr(obj, key)])
+        _updateHash(md5, state, (), seen)
+    else:
+        # Anything else is identified by its class and repr. If the repr doesn't show its state, it holds the
+        # address of the object, so objects which might differ are never given the same hash.
+        md5.update('%s %s %r' % (obj.__class__.__module__, obj.__class__.__name__, obj))
+
+
+def _cellContents(cell):
+    """Return the value in a closure cell (or None, if the variable has not been assigned yet)."""
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return None
+
+
+def _slots(obj):
+    """Return the __slots__ attribute names of obj (and its base classes)."""
+    slots = []
+    for cls in type(obj).__mro__:
+        clsSlots = cls.__dict__.get('__slots__', ())
+        if isinstance(clsSlots, basestring):
+            clsSlots = [clsSlots]
+        slots.extend([slot for slot in clsSlots if slot not in ('__dict__', '__weakref__')])
+    return slots
@@ -0,0 +1,162 @@
+import os
+import numpy as np
+
+__all__ = ['SiteEphemeris']
+
+
+class SiteEphemeris(object):
+    """
+    Nightly sun and moon ephemeris table for an observing site.
+
+    The table has one row per night, holding the time of local midnight (the sun's antitransit),
+    the times of -6, -12 and -18 degree twilight (sun center) before and after midnight,
+    and the moon phase (percent illumination) and altitude (radians) at midnight. All times are MJD.
+
+    The table is calculated with pyephem in blocks of blockLength days, once per block; the blocks can
+    also be saved to (and read from) cacheDir as numpy .npy files, so they are reused between runs.
+    Values for particular times are then looked up with np.searchsorted.
+
+    Parameters
+    ----------
+    site : lsst.sims.utils.Site
+        The observing site (anything with latitude_rad, longitude_rad and height attributes).
+    cacheDir : str, optional
+        If set, the directory where the tables are saved and read. Default None (not saved).
+    """
+    blockLength = 366
+    horizons = ['-6', '-12', '-18']
+    keys = ['twi6', 'twi12', 'twi18']
+
+    def __init__(self, site, cacheDir=None):
+        self.site = site
+        self.cacheDir = cacheDir
+        self.names = ['midnight', 'moonPhase', 'moonAlt']
+        for key in self.keys:
+            self.names += [key + '_rise', key + '_set']
+        self._blocks = {}
+
+    def _blockFile(self, blockIdx):
+        """Name of the on-disk copy of the table for block blockIdx."""
+        name = 'siteEphem_%.6f_%.6f_%.1f_%d_%d.npy' % (self.site.latitude_rad, self.site.longitude_rad,
+                                                      self.site.height, self.blockLength, blockIdx)
+        return os.path.join(self.cacheDir, name)
+
+    def _calcBlock(self, mjdStart, mjdEnd):
+        """Calculate the table for the nights with midnight between mjdStart and mjdEnd."""
+        import ephem
+        # pyephem uses 1899 as its zero-day, and MJD has Nov 17 1858 as zero-day.
+        doff = ephem.Date(0) - ephem.Date('1858/11/17')
+        obsList = []
+        for h in [None] + self.horizons:
+            obs = ephem.Observer()
+            obs.lat, obs.lon, obs.elevation = self.site.latitude_rad, self.site.longitude_rad, self.site.height
+            if h is not None:
+                obs.horizon = h
+            obsList.append(obs)
+        siteObs = obsList[0]
+        sun = ephem.Sun()
+        moon = ephem.Moon()
+        rows = []
+        midnight = siteObs.next_antitransit(sun, start=mjdStart - doff)
+        while midnight + doff < mjdEnd:
+            row = [midnight + doff]
+            siteObs.date = midnight
+            moon.compute(siteObs)
+            row += [moon.phase, moon.alt]
+            for obs in obsList[1:]:
+                try:
+                    row += [obs.next_rising(sun, start=midnight, use_center=True) + doff,
+                            obs.previous_setting(sun, start=midnight, use_center=True) + doff]
+                except (ephem.AlwaysUpError, ephem.NeverUpError):
+                    row += [np.nan, np.nan]
+            rows.append(tuple(row))
+            midnight = siteObs.next_antitransit(sun, start=midnight + 0.5)
+        return np.array(rows, dtype=zip(self.names, [float] * len(self.names)))
+
+    def _getBlock(self, blockIdx):
+        """Return the table for block blockIdx, calculating (and saving) it if needed."""
+        if blockIdx not in self._blocks:
+            filename = None
+            if self.cacheDir is not None:
+                filename = self._blockFile(blockIdx)
+            if filename is not None and os.path.isfile(filename):
+                self._blocks[blockIdx] = np.load(filename)
+            else:
+                self._blocks[blockIdx] = self._calcBlock(blockIdx * self.blockLength,
+                                                         (blockIdx + 1) * self.blockLength)
+                if filename is not None:
+                    try:
+                        if not os.path.isdir(self.cacheDir):
+                            os.makedirs(self.cacheDir)
+                    except OSError:
+                        # Another process may have made it.
+                        pass
+                    # Write to a temporary file first, so other processes never see a partly written file.
+                    tmpFilename = filename + '.%d.tmp' % os.getpid()
+                    try:
+                        with open(tmpFilename, 'wb') as f:
+                            np.save(f, self._blocks[blockIdx])
+                        os.rename(tmpFilename, filename)
+                    except (IOError, OSError):
+                        pass
+        return self._blocks[blockIdx]
+
+    def nightlyTable(self, mjdMin, mjdMax):
+        """
+        Return the table for (at least) all nights with midnight within a day of mjdMin to mjdMax.
+
+        Parameters
+        ----------
+        mjdMin : float
+            The earliest time to cover (MJD).
+        mjdMax : float
+            The latest time to cover (MJD).
+
+        Returns
+        -------
+        numpy.ndarray
+            Structured array with the nightly ephemerides, sorted by midnight.
+        """
+        first = int(np.floor((mjdMin - 1.) / self.blockLength))
+        last = int(np.floor((mjdMax + 1.) / self.blockLength))
+        return np.concatenate([self._getBlock(blockIdx) for blockIdx in range(first, last + 1)])
+
+    def nearestNight(self, mjd):
+        """
+        Find the night with midnight closest to each time.
+
+        Parameters
+        ----------
+        mjd : numpy.ndarray
+            The times (MJD).
+
+        Returns
+        -------
+        numpy.ndarray
+            The rows of the nightly table with midnight closest to each of the times.
+        """
+        mjd = np.asarray(mjd, dtype=float)
+        table = self.nightlyTable(mjd.min(), mjd.max())
+        right = np.clip(np.searchsorted(table['midnight'], mjd), 1, table.size - 1)
+        left = right - 1
+        nearest = np.where(np.abs(table['midnight'][left] - mjd) <= np.abs(table['midnight'][right] - mjd),
+                           left, right)
+        return table[nearest]
+
+    def moonPhase(self, mjd):
+        """
+        Moon phase (percent illumination) at each time, interpolated between the nightly values.
+
+        Parameters
+        ----------
+        mjd : numpy.ndarray
+            The times (MJD).
+
+        Returns
+        -------
+        numpy.ndarray
+            The moon phase at each time.
+        """
+        mjd = np.asarray(mjd, dtype=float)
+        table = self.nightlyTable(mjd.min(), mjd.max())
+        return np.interp(mjd, table['midnight'], table['moonPhase'])
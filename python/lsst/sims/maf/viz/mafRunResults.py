@@ -1,5 +1,6 @@
 import os
 import re
+import tempfile
 from collections import OrderedDict
 import numpy as np
 import lsst.sims.maf.db as db
@@ -112,9 +113,9 @@ class MafRunResults(object):
         if filename.upper() == 'NULL':
             return None
         datafile = os.path.join(self.outDir, filename)
-        # Read data back into a  bundle.
-        mB = metricBundles.emptyMetricBundle()
-        mB.read(datafile)
+        # Read data back into a  bundle (through the metricFileCache, so each file is only read once).
+        mB = metricBundles.createEmptyMetricBundle()
+        mB.read(datafile, useCache=True)
         io = mB.outputJSON()
         if io is None:
             return None
@@ -122,14 +123,31 @@ class MafRunResults(object):
 
     def getNpz(self, metric):
         """
-        Return the npz data.
+        Return the name and contents of a (single) npz file containing the data for a particular metric.
+
+        Metric data saved as a JSON header with .npy files (which is not usable without them and the
+        slicePoints file) is converted to the npz format.
         """
         filename = metric['metricDataFile']
         if filename.upper() == 'NULL':
             return None
-        else:
-            datafile = os.path.join(self.outDir, filename)
-            return datafile
+        datafile = os.path.join(self.outDir, filename)
+        npzName = os.path.splitext(os.path.basename(datafile))[0] + '.npz'
+        if datafile.endswith('.npz'):
+            with open(datafile, 'rb') as f:
+                return npzName, f.read()
+        mB = metricBundles.createEmptyMetricBundle()
+        mB.read(datafile, useCache=True)
+        fd, tmpFilename = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        try:
+            mB.slicer.writeData(tmpFilename, mB.metricValues, metricName=mB.metric.name,
+                                simDataName=mB.runName, constraint=mB.constraint, metadata=mB.metadata,
+                                displayDict=mB.displayDict, plotDict=mB.plotDict)
+            with open(tmpFilename, 'rb') as f:
+                return npzName, f.read()
+        finally:
+            os.remove(tmpFilename)
 
     def getResultsDb(self):
         """
@@ -41,6 +41,22 @@ class TestCadenceMetrics(unittest.TestCase):
         assert(worstPeriod == 0.25)
         assert(largestGap == 1.)
 
+        # Log-spaced periods
+        pgm = metrics.PhaseGapMetric(nPeriods=3, periodMin=0.25, periodMax=1., logPeriods=True)
+        metricVal = pgm.run(data)
+        np.testing.assert_almost_equal(metricVal['periods'], [0.25, 0.5, 1.])
+        np.testing.assert_almost_equal(metricVal['maxGaps'], [1., 0.5, 0.25])
+
+        # Periods calculated in several chunks should give the same answer
+        np.random.seed(42)
+        data = np.zeros(100, dtype=zip(['expMJD'],[float]))
+        data['expMJD'] = np.random.rand(data.size) * 365.25 + 59580.
+        pgm = metrics.PhaseGapMetric(nPeriods=50)
+        metricVal = pgm.run(data)
+        pgm.chunkSize = 250
+        metricValChunked = pgm.run(data)
+        np.testing.assert_array_equal(metricVal['maxGaps'], metricValChunked['maxGaps'])
+
     def testSNMetric(self):
         """
         Test the SN Cadence Metric.
@@ -58,6 +74,11 @@ class TestCadenceMetrics(unittest.TestCase):
         np.testing.assert_array_almost_equal(metric.reduceMedianMaxGap(result),  1/7.)
         assert(metric.reduceNsequences(result) == 10)
         assert((metric.reduceMedianNobs(result) <  561) & (metric.reduceMedianNobs(result) >  385) )
+        # Only count sequences which do not overlap
+        metric = metrics.SupernovaMetric(uniqueBlocks=True)
+        result = metric.run(data, slicePoint)
+        assert(metric.reduceNsequences(result) == 1)
+        assert(metric.reduceMedianNobs(result) == 561)
 
     def testTemplateExists(self):
         """
@@ -123,6 +144,16 @@ class TestCadenceMetrics(unittest.TestCase):
         Ngaps = np.math.factorial(data.size-1)
         assert(np.sum(result3) == Ngaps)
 
+        # Larger slices are histogrammed without calculating every gap
+        np.random.seed(42)
+        data = np.zeros(500, dtype=zip(names,types))
+        data['expMJD'] = 59580. + np.round(np.random.rand(data.size) * 80., 1)
+        metric = metrics.TgapsMetric(allGaps=True, bins=np.arange(0, 60, 0.5))
+        result4 = metric.run(data)
+        times = np.sort(data['expMJD'])
+        dts = (times - times[:, np.newaxis])[np.triu_indices(times.size, 1)]
+        np.testing.assert_array_equal(result4, np.histogram(dts, metric.bins)[0])
+
     def testRapidRevisitMetric(self):
         data = np.zeros(100, dtype=zip(['expMJD'], [float]))
         # Uniformly distribute time _differences_ between 0 and 100
@@ -213,6 +244,23 @@ class TestCadenceMetrics(unittest.TestCase):
         metric = metrics.TransientMetric(nFilters=2,nPerLC=3, surveyDuration=ndata/365.25 )
         assert(metric.run(dataSlice) == 1.)
 
+        # Check several phase shifts at once (the shifted phases each count one less transient)
+        metric = metrics.TransientMetric(surveyDuration=ndata/365.25, nPhaseCheck=2)
+        np.testing.assert_almost_equal(metric.run(dataSlice), 20./19.)
+        metric = metrics.TransientMetric(nFilters=2, nPerLC=3, surveyDuration=ndata/365.25, nPhaseCheck=4)
+        np.testing.assert_almost_equal(metric.run(dataSlice), 40./37.)
+
+        # The order of the visits should not matter
+        np.random.seed(42)
+        dataSlice['fiveSigmaDepth'] = np.random.rand(ndata) * 2. + 19.
+        dataSlice['filter'] = np.random.choice(['g', 'r'], ndata)
+        metric = metrics.TransientMetric(nFilters=2, nPerLC=2, nPrePeak=1, nPhaseCheck=3,
+                                         riseSlope=-0.5, declineSlope=0.2,
+                                         surveyDuration=ndata/365.25)
+        np.testing.assert_almost_equal(metric.run(dataSlice), 8./28.)
+        shuffled = dataSlice[np.random.permutation(ndata)]
+        self.assertEqual(metric.run(dataSlice), metric.run(shuffled))
+
 if __name__ == '__main__':
 
     unittest.main()
@@ -0,0 +1,75 @@
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import unittest
+from scipy.interpolate import interp1d
+import lsst.sims.maf.metrics as metrics
+
+
+def referenceCrowdError(magVector, lumFunc, seeing, singleMag=None, lumAreaArcsec=3600.0**2):
+    """The crowding error of a single healpixel, calculated as the CrowdingMetric did before the engine
+    (Olsen, Blum, & Rigaut 2003, AJ, 126, 452)."""
+    lumVector = 10**(-0.4*magVector)
+    coeff = np.sqrt(np.pi/lumAreaArcsec)*seeing/2.
+    myIntergral = (np.add.accumulate((lumVector**2*lumFunc)[::-1]))[::-1]
+    temp = np.sqrt(myIntergral)/lumVector
+    if singleMag is not None:
+        interp = interp1d(magVector, temp)
+        temp = interp(singleMag)
+    return coeff*temp
+
+
+class TestCrowdingMetrics(unittest.TestCase):
+    def setUp(self):
+        # A fake stellar luminosity function map.
+        rng = np.random.RandomState(42)
+        self.bins = np.arange(15., 28.01, 0.5)
+        self.lumFunc = rng.lognormal(3., 2., (50, len(self.bins) - 1))
+        self.seeing = [rng.uniform(0.5, 1.5, n) for n in rng.randint(1, 20, len(self.lumFunc))]
+
+    def _slicePoint(self, pix):
+        return {'starMapBins': self.bins, 'starLumFunc': self.lumFunc[pix]}
+
+    def _data(self, seeing):
+        data = np.zeros(len(seeing), dtype=[('finSeeing', float)])
+        data['finSeeing'] = seeing
+        return data
+
+    def testCrowdingEngine(self):
+        """
+        Test the batched crowding engine gives the same results as the metrics at each slicePoint.
+        """
+        engine = metrics.CrowdingEngine(self.bins[1:], self.lumFunc)
+        pix = np.arange(len(self.lumFunc))
+        crowdingMetric = metrics.CrowdingMetric(crowding_error=0.1)
+        crowdMags = [crowdingMetric.run(self._data(self.seeing[i]), self._slicePoint(i)) for i in pix]
+        bestSeeing = np.array([np.min(seeing) for seeing in self.seeing])
+        np.testing.assert_equal(engine.crowdingMag(bestSeeing, pix, crowding_error=0.1), crowdMags)
+        uncertMetric = metrics.CrowdingMagUncertMetric(rmag=21.3)
+        for i in pix:
+            dmag = engine.crowdError(self.seeing[i], np.zeros(len(self.seeing[i]), int) + i, singleMag=21.3)
+            self.assertEqual(uncertMetric.run(self._data(self.seeing[i]), self._slicePoint(i)), np.mean(dmag))
+        # Out of range magnitudes can't be interpolated.
+        self.assertRaises(ValueError, engine.crowdError, bestSeeing, pix, singleMag=30.)
+
+    def testCrowdingReference(self):
+        """
+        Test the crowding engine and metrics against an independent calculation, healpixel by healpixel.
+        """
+        magVector = self.bins[1:]
+        engine = metrics.CrowdingEngine(magVector, self.lumFunc)
+        uncertMetric = metrics.CrowdingMagUncertMetric(rmag=21.3)
+        for i in range(len(self.lumFunc)):
+            seeing = self.seeing[i]
+            pix = np.zeros(len(seeing), int) + i
+            expected = np.array([referenceCrowdError(magVector, self.lumFunc[i], s) for s in seeing])
+            np.testing.assert_allclose(engine.crowdError(seeing, pix), expected, rtol=1e-12)
+            expected = referenceCrowdError(magVector, self.lumFunc[i], seeing, singleMag=21.3)
+            np.testing.assert_allclose(engine.crowdError(seeing, pix, singleMag=21.3), expected, rtol=1e-12)
+            np.testing.assert_allclose(uncertMetric.run(self._data(seeing), self._slicePoint(i)),
+                                       np.mean(expected), rtol=1e-12)
+
+
+if __name__ == '__main__':
+
+    unittest.main()
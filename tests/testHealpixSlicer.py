@@ -10,6 +10,8 @@ import matplotlib.pyplot as plt
 import unittest
 import healpy as hp
 from lsst.sims.maf.slicers.healpixSlicer import HealpixSlicer
+from lsst.sims.maf.slicers.healpixAdaptiveSlicer import HealpixAdaptiveSlicer
+from lsst.sims.maf.slicers.healpixSDSSSlicer import HealpixSDSSSlicer
 from lsst.sims.maf.slicers.uniSlicer import UniSlicer
 
 def makeDataValues(size=100, minval=0., maxval=1., ramin=0, ramax=2*np.pi,
@@ -185,6 +187,141 @@ class TestHealpixSlicerSlicing(unittest.TestCase):
                 sidxs = np.sort(sidxs)
                 np.testing.assert_equal(self.dv['testdata'][didxs], self.dv['testdata'][sidxs])
 
+    def testDiscIndex(self):
+        """Test the disc (pointing-major) index returns the same data points as the kdtree."""
+        # Repeat a few pointings, as in an undithered survey.
+        dv = self.dv[np.random.randint(0, 200, size=len(self.dv))]
+        discslicer = HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                   radius=self.radius, indexMethod='disc')
+        discslicer.setupSlicer(dv)
+        treeslicer = HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                   radius=self.radius, indexMethod='kdtree')
+        treeslicer.setupSlicer(dv)
+        for d, t in zip(discslicer, treeslicer):
+            np.testing.assert_equal(d['idxs'], np.sort(t['idxs']))
+        self.assertRaises(ValueError, HealpixSlicer, nside=self.nside, verbose=False, indexMethod='foo')
+
+
+class TestHealpixSlicerSparse(unittest.TestCase):
+    def setUp(self):
+        self.nside = 64
+        self.radius = 1.8
+        # A single (dithered) field.
+        self.dv = makeDataValues(size=500, minval=0., maxval=1.,
+                                 ramin=1.0, ramax=1.02, decmin=-0.51, decmax=-0.49,
+                                 random=True)
+        self.fullslicer = HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                        radius=self.radius)
+        self.fullslicer.setupSlicer(self.dv)
+
+    def testSparse(self):
+        """Test the sparse slicer only uses the covered healpixels, and slices them as the full sky slicer."""
+        testslicer = HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                   radius=self.radius, sparse=True)
+        testslicer.setupSlicer(self.dv)
+        covered = [s['slicePoint']['sid'] for s in self.fullslicer if len(s['idxs']) > 0]
+        np.testing.assert_equal(testslicer.slicePoints['sid'], covered)
+        self.assertEqual(len(testslicer), len(covered))
+        self.assertTrue(len(testslicer) < hp.nside2npix(self.nside))
+        for s in testslicer:
+            f = self.fullslicer[s['slicePoint']['sid']]
+            np.testing.assert_equal(np.sort(s['idxs']), np.sort(f['idxs']))
+            self.assertEqual(s['slicePoint']['ra'], f['slicePoint']['ra'])
+        # Expand metric values to the full sky.
+        metricValues = ma.MaskedArray(data=np.arange(len(testslicer), dtype=float),
+                                      mask=np.zeros(len(testslicer), bool),
+                                      fill_value=testslicer.badval)
+        metricValues.mask[0] = True
+        fullValues = testslicer.fullSky(metricValues)
+        self.assertEqual(len(fullValues), hp.nside2npix(self.nside))
+        self.assertEqual(fullValues.count(), len(testslicer) - 1)
+        np.testing.assert_equal(fullValues[testslicer.slicePoints['sid']], metricValues)
+        self.assertTrue(self.fullslicer.fullSky(metricValues) is metricValues)
+
+    def testFootprint(self):
+        """Test the slicePoints are set from a footprint."""
+        footprint = np.zeros(hp.nside2npix(self.nside), bool)
+        footprint[100:200] = True
+        testslicer = HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                   radius=self.radius, footprint=footprint)
+        np.testing.assert_equal(testslicer.slicePoints['sid'], np.arange(100, 200))
+        self.assertEqual(testslicer.shape, 100)
+        self.assertTrue(testslicer.slicer_init['sparse'])
+        self.assertNotEqual(testslicer, self.fullslicer)
+        self.assertEqual(testslicer, HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                                   radius=self.radius, footprint=np.arange(100, 200)))
+
+
+class TestHealpixAdaptiveSlicer(unittest.TestCase):
+    def setUp(self):
+        self.nside = 128
+        self.radius = 1.75
+        # Repeated (undithered) pointings.
+        fields = makeDataValues(size=20, minval=0., maxval=1., ramin=0, ramax=2*np.pi,
+                                decmin=-np.pi, decmax=0, random=True)
+        self.dv = fields[np.random.randint(0, len(fields), size=500)]
+        self.testslicer = HealpixAdaptiveSlicer(nside=self.nside, coarseNside=16, verbose=False,
+                                                lonCol='ra', latCol='dec', radius=self.radius)
+
+    def testSlicing(self):
+        """Test each healpixel in a cell sees the same data points as with the full resolution slicer."""
+        self.testslicer.setupSlicer(self.dv)
+        self.assertTrue(self.testslicer.evalFraction < 1)
+        fullslicer = HealpixSlicer(nside=self.nside, verbose=False, lonCol='ra', latCol='dec',
+                                   radius=self.radius)
+        fullslicer.setupSlicer(self.dv)
+        cellIdxs = [np.sort(s['idxs']) for s in self.testslicer]
+        pixels, cells = self.testslicer._cellPixels()
+        pixels = hp.nest2ring(self.nside, pixels)
+        for pix, cell in zip(pixels, cells):
+            np.testing.assert_equal(cellIdxs[cell], np.sort(fullslicer[pix]['idxs']))
+        # And the healpixels outside the cells have no data points.
+        for pix in np.setdiff1d(np.arange(hp.nside2npix(self.nside)), pixels):
+            self.assertEqual(len(fullslicer[pix]['idxs']), 0)
+        # Expand metric values to the full resolution.
+        metricValues = ma.MaskedArray(data=np.array([len(idxs) for idxs in cellIdxs], float),
+                                      mask=np.zeros(len(cellIdxs), bool), fill_value=hp.UNSEEN)
+        expanded = self.testslicer.expandValues(metricValues)
+        self.assertEqual(len(expanded), len(pixels))
+        fullValues = self.testslicer.fullSky(metricValues)
+        self.assertEqual(len(fullValues), hp.nside2npix(self.nside))
+        np.testing.assert_equal(fullValues[pixels], expanded)
+        self.assertEqual(fullValues.count(), len(pixels))
+
+
+class TestHealpixSDSSSlicer(unittest.TestCase):
+    def setUp(self):
+        self.nside = 1024
+        # Two overlapping square images (20 arcminutes on a side) on the equator.
+        self.halfSide = np.radians(10./60.)
+        self.centers = np.array([[1.0, 0.0], [1.0 + self.halfSide, 0.0]])
+        self.dv = np.zeros(len(self.centers), dtype=[('RA1', float), ('Dec1', float), ('RA2', float),
+                                                     ('Dec2', float), ('RA3', float), ('Dec3', float),
+                                                     ('RA4', float), ('Dec4', float)])
+        for i, (dra, ddec) in enumerate([(-1, -1), (1, -1), (1, 1), (-1, 1)]):
+            self.dv['RA%d' % (i + 1)] = self.centers[:, 0] + dra * self.halfSide
+            self.dv['Dec%d' % (i + 1)] = self.centers[:, 1] + ddec * self.halfSide
+        self.testslicer = HealpixSDSSSlicer(nside=self.nside, verbose=False, radius=30./60.)
+
+    def testSlicing(self):
+        """Test the healpixels inside each image (and only those) see the image."""
+        self.testslicer.setupSlicer(self.dv)
+        ra = self.testslicer.slicePoints['ra']
+        dec = self.testslicer.slicePoints['dec']
+        margin = hp.nside2resol(self.nside) / 10.
+        # Check the healpixels near the images.
+        for islice in np.where(np.abs(dec) < 0.02)[0]:
+            idxs = self.testslicer._sliceIdxs(islice)
+            for i, (cra, cdec) in enumerate(self.centers):
+                dra = np.abs(ra[islice] - cra)
+                ddec = np.abs(dec[islice] - cdec)
+                if dra < self.halfSide - margin and ddec < self.halfSide - margin:
+                    self.assertTrue(i in idxs)
+                elif dra > self.halfSide + margin or ddec > self.halfSide + margin:
+                    self.assertFalse(i in idxs)
+        self.assertEqual(len(self.testslicer._sliceIdxs(hp.ang2pix(self.nside, np.pi / 2.,
+                                                                    1.0 - self.halfSide / 2.))), 1)
+        self.assertEqual(len(self.testslicer._sliceIdxs(hp.ang2pix(self.nside, np.pi / 2., 1.1))), 0)
 
 class TestHealpixChipGap(unittest.TestCase):
     # Note that this is really testing baseSpatialSlicer, as slicing is done there for healpix grid
@@ -1,9 +1,12 @@
 import matplotlib
 matplotlib.use("Agg")
 import numpy as np
+import healpy as hp
 import unittest
 import warnings
 import os
+import shutil
+import tempfile
 
 import lsst.sims.maf.slicers as slicers
 import lsst.sims.maf.maps as maps
@@ -97,6 +100,59 @@ class TestMaps(unittest.TestCase):
         else:
             warnings.warn('Did not find stellar density map, skipping test.')
 
+    def testMapCache(self):
+        """Test the map cache reads each map array once, memory-mapped, and drops the oldest arrays."""
+        tmpDir = tempfile.mkdtemp()
+        try:
+            mapFile = os.path.join(tmpDir, 'testMap.npz')
+            np.savez(mapFile, values=np.arange(100, dtype=float), bins=np.arange(10, dtype=np.int64))
+            mapCache = maps.MapCache(cacheDir=os.path.join(tmpDir, 'cache'), maxBytes=850)
+            values = mapCache.get(mapFile, 'values')
+            self.assertTrue(isinstance(values, np.memmap))
+            self.assertFalse(values.flags.writeable)
+            np.testing.assert_equal(values, np.arange(100))
+            self.assertTrue(mapCache.get(mapFile, 'values') is values)
+            self.assertEqual(mapCache.hits, 1)
+            # Adding the bins goes over maxBytes, so the values are dropped.
+            mapCache.get(mapFile, 'bins')
+            self.assertTrue(mapCache.nbytes <= 850)
+            self.assertFalse(mapCache.get(mapFile, 'values') is values)
+            # Another cache (like another process) uses the same .npy file.
+            otherCache = maps.MapCache(cacheDir=os.path.join(tmpDir, 'cache'))
+            np.testing.assert_equal(otherCache.get(mapFile, 'values'), values)
+            self.assertEqual(len(os.listdir(os.path.join(tmpDir, 'cache'))), 2)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testHealpixResampler(self):
+        """Test resampling healpix maps with the cached correspondence tables."""
+        tmpDir = tempfile.mkdtemp()
+        try:
+            resampler = maps.HealpixResampler(cacheDir=tmpDir)
+            mapValues = np.random.rand(hp.nside2npix(16))
+            lat, lon = hp.pix2ang(32, np.arange(hp.nside2npix(32)))
+            np.testing.assert_equal(resampler.resample(mapValues, nsideTo=32), mapValues[hp.ang2pix(16, lat, lon)])
+            np.testing.assert_almost_equal(resampler.resample(mapValues, nsideTo=32, method='bilinear'),
+                                           hp.get_interp_val(mapValues, lat, lon))
+            np.testing.assert_almost_equal(resampler.resample(mapValues, nsideTo=4, method='average'),
+                                           hp.ud_grade(mapValues, 4))
+            # Points, and a subset of the healpixels.
+            ra = np.random.rand(10) * 2. * np.pi
+            dec = np.random.rand(10) - 0.5
+            np.testing.assert_equal(resampler.resample(mapValues, ra=ra, dec=dec),
+                                    mapValues[hp.ang2pix(16, np.pi / 2. - dec, ra)])
+            pixels = np.array([3, 50, 700])
+            np.testing.assert_equal(resampler.resample(mapValues, nsideTo=32, method='bilinear', pixels=pixels),
+                                    resampler.resample(mapValues, nsideTo=32, method='bilinear')[pixels])
+            # The tables are saved, to be used by other resamplers.
+            self.assertEqual(len(os.listdir(tmpDir)), 4)
+            otherResampler = maps.HealpixResampler(cacheDir=tmpDir)
+            np.testing.assert_equal(otherResampler.resample(mapValues, ra=ra, dec=dec, method='bilinear'),
+                                    resampler.resample(mapValues, ra=ra, dec=dec, method='bilinear'))
+            self.assertEqual(len(os.listdir(tmpDir)), 5)
+        finally:
+            shutil.rmtree(tmpDir)
+
 if __name__ == '__main__':
 
     unittest.main()
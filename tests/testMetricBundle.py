@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 import matplotlib
 matplotlib.use("Agg")
 
@@ -10,6 +11,16 @@ import glob
 import os
 import shutil
 
+
+def makeDataValues(size=100, ramin=0., ramax=2. * np.pi):
+    """Generate random airmass values, with RA/Dec (in radians) in the southern sky, between ramin and ramax."""
+    data = np.zeros(size, dtype=[('airmass', float), ('fieldRA', float), ('fieldDec', float)])
+    data['airmass'] = np.random.rand(size) + 1.
+    data['fieldRA'] = np.random.rand(size) * (ramax - ramin) + ramin
+    data['fieldDec'] = np.random.rand(size) * -np.pi / 2.
+    return data
+
+
 class TestMetricBundle(unittest.TestCase):
 
     def setUp(self):
@@ -36,13 +47,378 @@ class TestMetricBundle(unittest.TestCase):
         bgroup.writeAll()
 
         outThumbs = glob.glob(os.path.join(self.outDir, 'thumb*'))
-        outNpz = glob.glob(os.path.join(self.outDir, '*.npz'))
+        outJson = glob.glob(os.path.join(self.outDir, '*.json'))
+        outNpy = glob.glob(os.path.join(self.outDir, '*.npy'))
         outPdf = glob.glob(os.path.join(self.outDir, '*.pdf'))
 
         # By default, make 3 plots for healpix
         assert(len(outThumbs) == 3)
         assert(len(outPdf) == 3)
-        assert(len(outNpz) == 1)
+        # The metric data is saved as a JSON header with .npy values and mask.
+        assert(len(outJson) == 1)
+        assert(len(outNpy) == 2)
+
+    def testResultCache(self):
+        """
+        Check that metric values are read from the result cache when the same bundle is run again
+        """
+        cacheDir = os.path.join(self.outDir, 'cache')
+        sql = 'filter="r"'
+        data = makeDataValues()
+        metricValues = []
+        for airmassOffset in [0., 0., 1.]:
+            data['airmass'] += airmassOffset
+            resultCache = metricBundles.ResultCache(cacheDir)
+            metricB = metricBundles.MetricBundle(metrics.MeanMetric(col='airmass'),
+                                                 slicers.HealpixSlicer(nside=4, verbose=False), sql)
+            bgroup = metricBundles.MetricBundleGroup({0: metricB}, None, outDir=self.outDir,
+                                                     resultCache=resultCache, verbose=False)
+            bgroup.setCurrent(sql)
+            bgroup.runCurrent(sql, simData=data)
+            metricValues.append(metricB.metricValues)
+            if len(metricValues) == 2:
+                # The second run reads the values of the first from the cache.
+                self.assertEqual(resultCache.hits, 1)
+                np.testing.assert_equal(metricValues[1].mask, metricValues[0].mask)
+                np.testing.assert_equal(metricValues[1].compressed(), metricValues[0].compressed())
+            else:
+                self.assertEqual(resultCache.misses, 1)
+        np.testing.assert_almost_equal(metricValues[2].compressed(), metricValues[0].compressed() + 1.)
+        self.assertEqual(len(glob.glob(os.path.join(cacheDir, '*.npz'))), 2)
+
+    def testDuplicateMetrics(self):
+        """
+        Check that metrics which differ only by name are calculated once and give the same values
+        """
+        sql = 'filter="r"'
+        data = makeDataValues()
+        slicer = slicers.HealpixSlicer(nside=4, verbose=False)
+        bundleDict = {}
+        for i, metricName in enumerate(['Mean airmass', 'Airmass mean']):
+            bundleDict[i] = metricBundles.MetricBundle(metrics.MeanMetric(col='airmass', metricName=metricName),
+                                                       slicer, sql)
+        bundleDict[2] = metricBundles.MetricBundle(metrics.MaxMetric(col='airmass'), slicer, sql)
+        bgroup = metricBundles.MetricBundleGroup(bundleDict, None, outDir=self.outDir, verbose=False)
+        bgroup.setCurrent(sql)
+        bgroup.runCurrent(sql, simData=data)
+        self.assertTrue(bgroup.evalsSaved > 0)
+        np.testing.assert_equal(bundleDict[0].metricValues.mask, bundleDict[1].metricValues.mask)
+        np.testing.assert_equal(bundleDict[0].metricValues.compressed(), bundleDict[1].metricValues.compressed())
+        self.assertFalse(bundleDict[0].metricValues is bundleDict[1].metricValues)
+        self.assertTrue(np.all(bundleDict[2].metricValues.compressed() >= bundleDict[0].metricValues.compressed()))
+
+    def testProfiler(self):
+        """
+        Check that the profiler records each stage of running a bundle, and writes the profile
+        """
+        sql = 'filter="r"'
+        data = makeDataValues()
+        metricB = metricBundles.MetricBundle(metrics.MeanMetric(col='airmass'),
+                                             slicers.HealpixSlicer(nside=4, verbose=False), sql)
+        resultsDb = db.ResultsDb(outDir=self.outDir)
+        profiler = metricBundles.Profiler()
+        bgroup = metricBundles.MetricBundleGroup({0: metricB}, None, outDir=self.outDir,
+                                                 resultsDb=resultsDb, profiler=profiler, verbose=False)
+        bgroup.setCurrent(sql)
+        bgroup.runCurrent(sql, simData=data)
+        bgroup.writeProfile()
+        stages = set([row['stage'] for row in profiler.rows])
+        for stage in ['slicerSetup', 'runMetrics', 'metric', 'summary', 'write']:
+            self.assertTrue(stage in stages)
+        metricRow = [row for row in profiler.rows if row['stage'] == 'metric'][0]
+        self.assertTrue(0 < metricRow['nCalls'] <= metricB.slicer.nslice)
+        self.assertEqual(len(resultsDb.getProfile()), len(profiler.rows))
+        self.assertEqual(len(resultsDb.getProfile(stage='metric')), 1)
+        self.assertTrue(os.path.isfile(os.path.join(self.outDir, 'profile.json')))
+        self.assertTrue(os.path.isfile(os.path.join(self.outDir, 'profile.csv')))
+
+    def testReadAll(self):
+        """
+        Check that readAll restores the metric values written by a group, in parallel or lazily
+        """
+        sql = 'filter="r"'
+        data = makeDataValues()
+
+        def makeBundleDict():
+            slicer = slicers.HealpixSlicer(nside=4, verbose=False)
+            return {'mean': metricBundles.MetricBundle(metrics.MeanMetric(col='airmass'), slicer, sql),
+                    'max': metricBundles.MetricBundle(metrics.MaxMetric(col='airmass'), slicer, sql)}
+
+        bundleDict = makeBundleDict()
+        bgroup = metricBundles.MetricBundleGroup(bundleDict, None, outDir=self.outDir, verbose=False)
+        bgroup.setCurrent(sql)
+        bgroup.runCurrent(sql, simData=data)
+        metricBundles.metricFileCache.clear()
+        misses = metricBundles.metricFileCache.misses
+        hits = metricBundles.metricFileCache.hits
+        for lazy in [False, True]:
+            readDict = makeBundleDict()
+            readGroup = metricBundles.MetricBundleGroup(readDict, None, outDir=self.outDir, verbose=False)
+            readGroup.readAll(lazy=lazy, nThreads=2)
+            for key in bundleDict:
+                if lazy:
+                    self.assertTrue(readDict[key]._metricValues is None)
+                np.testing.assert_equal(readDict[key].metricValues.mask, bundleDict[key].metricValues.mask)
+                np.testing.assert_equal(readDict[key].metricValues.compressed(),
+                                        bundleDict[key].metricValues.compressed())
+                # The values read are a copy, which can be changed.
+                readDict[key].metricValues.data[0] = -1
+        # The files are read from disk once, then from the cache.
+        self.assertEqual(metricBundles.metricFileCache.misses - misses, 2)
+        self.assertEqual(metricBundles.metricFileCache.hits - hits, 2)
+        # Changing the values read didn't change the values in the cache.
+        for key in bundleDict:
+            filename = os.path.join(self.outDir, bundleDict[key].fileRoot + '.json')
+            self.assertNotEqual(metricBundles.metricFileCache.read(filename)[0].data[0], -1)
+
+    def testBackgroundWrite(self):
+        """
+        Check that bundles written in the background are all written by flush, and errors are raised
+        """
+        sql = 'filter="r"'
+        data = makeDataValues()
+        slicer = slicers.HealpixSlicer(nside=4, verbose=False)
+        bundleDict = {'mean': metricBundles.MetricBundle(metrics.MeanMetric(col='airmass'), slicer, sql),
+                      'max': metricBundles.MetricBundle(metrics.MaxMetric(col='airmass'), slicer, sql)}
+        resultsDb = db.ResultsDb(outDir=self.outDir)
+        bgroup = metricBundles.MetricBundleGroup(bundleDict, None, outDir=self.outDir, resultsDb=resultsDb,
+                                                 backgroundWrite=True, maxWriteQueue=1, verbose=False)
+        bgroup.setCurrent(sql)
+        bgroup.runCurrent(sql, simData=data)
+        bgroup.writeCurrent()
+        bgroup.flush()
+        self.assertEqual(bgroup.writer.nWritten + bgroup.writer.nCoalesced, 4)
+        for b in bundleDict.itervalues():
+            self.assertTrue(os.path.isfile(os.path.join(self.outDir, b.fileRoot + '.json')))
+        self.assertEqual(len(resultsDb.getMetricDataFiles()), 2)
+        # Errors in the writer thread are raised by flush.
+        bgroup.writer.outDir = os.path.join(self.outDir, 'missing')
+        bgroup.writeCurrent()
+        self.assertRaises(RuntimeError, bgroup.flush)
+
+    def testBackgroundWriteSharedSlicer(self):
+        """
+        Check that bundles written in the background keep their slicePoints when their slicer is set up again
+        """
+        slicer = slicers.HealpixSlicer(nside=4, verbose=False, sparse=True)
+        bundleDict = {}
+        for sql in ['filter="r"', 'filter="g"']:
+            for metric in [metrics.MeanMetric(col='airmass'), metrics.MaxMetric(col='airmass')]:
+                b = metricBundles.MetricBundle(metric, slicer, sql)
+                bundleDict[b.fileRoot] = b
+        resultsDb = db.ResultsDb(outDir=self.outDir)
+        bgroup = metricBundles.MetricBundleGroup(bundleDict, None, outDir=self.outDir, resultsDb=resultsDb,
+                                                 backgroundWrite=True, verbose=False)
+        sids = {}
+        # Holding the resultsDb lock stops the writer after its first bundle, so the other bundles are still
+        # queued when the (shared, sparse) slicer is set up for the next constraint.
+        with bgroup.writer.lock:
+            for sql, data in [('filter="r"', makeDataValues(ramin=0., ramax=np.pi)),
+                              ('filter="g"', makeDataValues(ramin=np.pi, ramax=2. * np.pi))]:
+                bgroup.setCurrent(sql)
+                bgroup.runCurrent(sql, simData=data)
+                sids[sql] = slicer.slicePoints['sid'].copy()
+        bgroup.flush()
+        self.assertFalse(np.array_equal(sids['filter="r"'], sids['filter="g"']))
+        for b in bundleDict.itervalues():
+            metricValues, restoredSlicer, header = slicers.BaseSlicer().readData(os.path.join(self.outDir,
+                                                                                              b.fileRoot + '.json'))
+            np.testing.assert_equal(restoredSlicer.slicePoints['sid'], sids[b.constraint])
+            self.assertEqual(len(metricValues), len(sids[b.constraint]))
+
+    def testCheckpoint(self):
+        """
+        Check that an interrupted, checkpointed run is resumed from the checkpoint with the same results
+        """
+        sql = 'filter="r"'
+        data = makeDataValues()
+        starts = []
+
+        def makeBundleDict(crashAfter=None):
+            bundleDict = {}
+            for nside in [2, 4]:
+                slicer = slicers.HealpixSlicer(nside=nside, verbose=False)
+                bundleDict['mean%d' % nside] = metricBundles.MetricBundle(metrics.MeanMetric(col='airmass'),
+                                                                          slicer, sql)
+                bundleDict['max%d' % nside] = metricBundles.MetricBundle(metrics.MaxMetric(col='airmass'),
+                                                                         slicer, sql)
+            # Record where the nside=4 slicer starts, and interrupt it after crashAfter slicePoints.
+            iterSlices = slicer.iterSlices
+
+            def interruptedIterSlices(start=0):
+                starts.append(start)
+                for n, result in enumerate(iterSlices(start=start)):
+                    if n == crashAfter:
+                        raise KeyboardInterrupt
+                    yield result
+            slicer.iterSlices = interruptedIterSlices
+            return bundleDict
+
+        bundleDict = makeBundleDict()
+        bgroup = metricBundles.MetricBundleGroup(bundleDict, None, outDir=self.outDir, verbose=False)
+        bgroup.setCurrent(sql)
+        bgroup.runCurrent(sql, simData=data)
+
+        for filename in glob.glob(os.path.join(self.outDir, '*.json')):
+            os.remove(filename)
+        crashDict = makeBundleDict(crashAfter=100)
+        bgroup = metricBundles.MetricBundleGroup(crashDict, None, outDir=self.outDir, backgroundWrite=True,
+                                                 checkpoint=True, checkpointEvery=50, verbose=False)
+        bgroup.setCurrent(sql)
+        self.assertRaises(KeyboardInterrupt, bgroup.runCurrent, sql, simData=data)
+        self.assertEqual(set(bgroup.checkpoint.partial.values()), set([100]))
+        # The bundles recorded as finished were written (they are not written again on resuming).
+        finished = [b for b in crashDict.itervalues() if bgroup.checkpoint.getFinished(b) is not None]
+        self.assertEqual(len(finished), 2)
+        for b in finished:
+            self.assertTrue(os.path.isfile(os.path.join(self.outDir, b.fileRoot + '.json')))
+
+        resumeDict = makeBundleDict()
+        bgroup = metricBundles.MetricBundleGroup(resumeDict, None, outDir=self.outDir,
+                                                 checkpoint=True, checkpointEvery=50, verbose=False)
+        bgroup.checkpoint.read()
+        bgroup.setCurrent(sql)
+        bgroup.runCurrent(sql, simData=data)
+        self.assertEqual(starts[-1], 100)
+        for key in bundleDict:
+            np.testing.assert_equal(resumeDict[key].metricValues.mask, bundleDict[key].metricValues.mask)
+            np.testing.assert_equal(resumeDict[key].metricValues.compressed(),
+                                    bundleDict[key].metricValues.compressed())
+        bgroup.checkpoint.clear()
+        self.assertFalse(os.path.isdir(os.path.join(self.outDir, 'checkpoint')))
+
+    def testMemoryBudget(self):
+        """
+        Check that metric values spilled to disk to stay within the memory budget are unchanged
+        """
+        sql = 'filter="r"'
+        data = makeDataValues()
+
+        def makeBundleDict():
+            slicer = slicers.HealpixSlicer(nside=8, verbose=False)
+            bundleDict = {}
+            for name, metric in [('mean', metrics.MeanMetric), ('max', metrics.MaxMetric),
+                                 ('min', metrics.MinMetric), ('median', metrics.MedianMetric)]:
+                bundleDict[name] = metricBundles.MetricBundle(metric(col='airmass'), slicer, sql,
+                                                              summaryMetrics=[metrics.MeanMetric(col='metricdata')])
+            return bundleDict
+
+        bundleDict = makeBundleDict()
+        bgroup = metricBundles.MetricBundleGroup(bundleDict, None, outDir=self.outDir, verbose=False)
+        bgroup.setCurrent(sql)
+        bgroup.runCurrent(sql, simData=data)
+
+        # Allow the metric values (data and mask) of one bundle and a half in memory.
+        nbytes = bundleDict['mean'].metricValues.nbytes + bundleDict['mean'].metricValues.mask.nbytes
+        budgetDict = makeBundleDict()
+        bgroup = metricBundles.MetricBundleGroup(budgetDict, None, outDir=self.outDir, verbose=False,
+                                                 maxMemory=nbytes * 1.5)
+        bgroup.setCurrent(sql)
+        bgroup.runCurrent(sql, simData=data)
+        budget = bgroup.memoryBudget
+        self.assertLessEqual(budget.nbytes, nbytes * 1.5)
+        self.assertGreater(budget.nSpilled, 0)
+        self.assertEqual(len(glob.glob(os.path.join(budget.spillDir, '*_values.npy'))), 3)
+        for key in bundleDict:
+            np.testing.assert_equal(budgetDict[key].metricValues.mask, bundleDict[key].metricValues.mask)
+            np.testing.assert_equal(budgetDict[key].metricValues.compressed(),
+                                    bundleDict[key].metricValues.compressed())
+            self.assertEqual(budgetDict[key].summaryValues, bundleDict[key].summaryValues)
+        # New metric values replace the spilled ones.
+        for b in budgetDict.itervalues():
+            b.metricValues = None
+        self.assertEqual(budget.nbytes, 0)
+        self.assertEqual(len(glob.glob(os.path.join(budget.spillDir, '*.npy'))), 0)
+        budget.close()
+        self.assertIsNone(budget.spillDir)
+
+    def testWorkQueue(self):
+        """
+        Check that tasks of dead workers are run again, and that a run through the work queue gives the same results
+        """
+        queueDir = os.path.join(self.outDir, 'queue')
+        workQueue = metricBundles.WorkQueue(queueDir, leaseTime=60., pollInterval=0.1)
+        taskIds = [workQueue.put({'task': i}) for i in range(2)]
+        self.assertEqual(workQueue.put({'task': 0}), taskIds[0])
+        self.assertEqual(workQueue.claim('dead', taskIds=taskIds[:1]), taskIds[0])
+        self.assertIsNone(workQueue.claim('live', taskIds=taskIds[:1]))
+        self.assertEqual(workQueue.claim('live'), taskIds[1])
+        workQueue.complete(taskIds[1], 'live', {'values': np.arange(3)})
+        np.testing.assert_equal(workQueue.getResult(taskIds[1])['values'], np.arange(3))
+        # The dead worker stops renewing its lease: another worker can then claim its task.
+        lockFile = os.path.join(queueDir, 'locks', taskIds[0] + '.lock')
+        os.utime(lockFile, (os.stat(lockFile).st_mtime - 61., os.stat(lockFile).st_mtime - 61.))
+        expiredStat = os.stat(lockFile)
+        self.assertEqual(workQueue.claim('live'), taskIds[0])
+        self.assertFalse(workQueue.renew(taskIds[0], 'dead'))
+        # Another worker which also found the lock expired doesn't break the new lock.
+        workQueue._breakLock(lockFile, expiredStat, 'late')
+        self.assertTrue(workQueue.renew(taskIds[0], 'live'))
+        self.assertIsNone(workQueue.claim('late', taskIds=taskIds[:1]))
+        workQueue.fail(taskIds[0], 'live', 'Error')
+        self.assertRaises(RuntimeError, workQueue.getResult, taskIds[0])
+        workQueue.clear()
+
+        filepath = os.path.join(os.getenv('SIMS_MAF_DIR'), 'tests/')
+        opsdb = db.OpsimDatabase(database=os.path.join(filepath, 'opsimblitz1_1133_sqlite.db'))
+
+        def makeBundleDict():
+            # The workers must make slicers with all the same arguments (such as the footprint), and the
+            # bundles of each constraint must keep their own sparse slicePoints.
+            slicerDict = {'all': slicers.HealpixSlicer(nside=4, verbose=False),
+                          'footprint': slicers.HealpixSlicer(nside=4, verbose=False, footprint=np.arange(0, 192, 3)),
+                          'sparse': slicers.HealpixSlicer(nside=4, verbose=False, sparse=True)}
+            bundleDict = {}
+            for sql in ['filter="r"', 'filter="g"']:
+                for name, slicer in slicerDict.iteritems():
+                    for metric in [metrics.MeanMetric(col='airmass'), metrics.MaxMetric(col='airmass'),
+                                   metrics.MeanMetric(col='airmass', metricName='Airmass mean')]:
+                        b = metricBundles.MetricBundle(metric, slicer, sql, metadata='%s %s' % (sql, name),
+                                                       summaryMetrics=[metrics.MeanMetric(col='metricdata')])
+                        bundleDict[b.fileRoot] = b
+            return bundleDict
+
+        bundleDict = makeBundleDict()
+        bgroup = metricBundles.MetricBundleGroup(bundleDict, opsdb, outDir=self.outDir, verbose=False)
+        bgroup.runAll()
+
+        queueDict = makeBundleDict()
+        workQueue = metricBundles.WorkQueue(queueDir, pollInterval=0.1)
+        resultsDb = db.ResultsDb(outDir=self.outDir)
+        bgroup = metricBundles.MetricBundleGroup(queueDict, opsdb, outDir=self.outDir, resultsDb=resultsDb,
+                                                 verbose=False, workQueue=workQueue, chunkSize=50)
+        bgroup.runAll()
+        for key in bundleDict:
+            np.testing.assert_equal(queueDict[key].metricValues.mask, bundleDict[key].metricValues.mask)
+            np.testing.assert_equal(queueDict[key].metricValues.compressed(),
+                                    bundleDict[key].metricValues.compressed())
+            self.assertEqual(queueDict[key].summaryValues, bundleDict[key].summaryValues)
+            self.assertEqual(queueDict[key].slicer.nslice, len(queueDict[key].metricValues))
+        self.assertEqual(len(resultsDb.getAllMetricIds()), len(bundleDict))
+        # The work queue is emptied at the end of the run, and can be used again.
+        self.assertEqual(workQueue.taskIds(), [])
+        bgroup.runAll()
+        for key in bundleDict:
+            np.testing.assert_equal(queueDict[key].metricValues.compressed(),
+                                    bundleDict[key].metricValues.compressed())
+        self.assertEqual(workQueue.taskIds(), [])
+
+        # The metric values are only allocated as they are collected, so are limited by the memory budget.
+        budgetDict = makeBundleDict()
+        nbytes = max([b.metricValues.nbytes + b.metricValues.mask.nbytes for b in bundleDict.itervalues()])
+        bgroup = metricBundles.MetricBundleGroup(budgetDict, opsdb, outDir=self.outDir, verbose=False,
+                                                 workQueue=workQueue, chunkSize=50, maxMemory=nbytes * 2)
+        bgroup.setCurrent('filter="r"')
+        bgroup._submitCurrent('filter="r"')
+        for b in budgetDict.itervalues():
+            self.assertIsNone(b._metricValues)
+        workQueue.clear()
+        bgroup.runAll()
+        self.assertGreater(bgroup.memoryBudget.nSpilled, 0)
+        for key in bundleDict:
+            np.testing.assert_equal(budgetDict[key].metricValues.compressed(),
+                                    bundleDict[key].metricValues.compressed())
+        bgroup.memoryBudget.close()
 
     def tearDown(self):
         if os.path.isdir(self.outDir):
@@ -161,6 +161,17 @@ class TestOpsimFieldSlicerIteration(unittest.TestCase):
         self.assertEqual(self.testslicer[n]['slicePoint']['ra'], self.fieldData['fieldRA'][n])
         self.assertEqual(self.testslicer[n]['slicePoint']['dec'], self.fieldData['fieldDec'][n])
 
+    def testIterSlices(self):
+        """Test iterSlices gives the same indexes and slicePoint metadata as indexing."""
+        n = 0
+        for i, idxs, slicePoint in self.testslicer.iterSlices():
+            self.assertEqual(i, n)
+            np.testing.assert_array_equal(idxs, self.testslicer[i]['idxs'])
+            self.assertEqual(dict(slicePoint), self.testslicer[i]['slicePoint'])
+            self.assertEqual(slicePoint['sid'], self.fieldData['fieldID'][i])
+            n += 1
+        self.assertEqual(n, len(self.testslicer))
+
 
 class TestOpsimFieldSlicerSlicing(unittest.TestCase):
     # Note that this is really testing baseSpatialSlicer, as slicing is done there for healpix grid
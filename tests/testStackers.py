@@ -1,10 +1,16 @@
+import os
+import shutil
+import tempfile
 import numpy as np
 import matplotlib
 import warnings
 import unittest
+import ephem
+import palpy
 
 import lsst.sims.maf.stackers as stackers
 from lsst.sims.utils import _galacticFromEquatorial
+from lsst.sims.maf.utils import gnomonic_project_toxy
 
 matplotlib.use("Agg")
 
@@ -67,6 +73,32 @@ class TestStackerClasses(unittest.TestCase):
         self.assertGreater(min(np.abs(data['ra_pi_amp'])), 0.)
         self.assertGreater(min(np.abs(data['dec_pi_amp'])), 0.)
 
+    def testParallaxFactorPalpy(self):
+        """
+        Test the parallax factors match those from per-visit palpy calls.
+        """
+        np.random.seed(42)
+        ndata = 200
+        data = np.zeros(ndata, dtype=zip(['fieldRA', 'fieldDec', 'expMJD'],
+                                         [float, float, float]))
+        data['fieldRA'] = np.random.rand(ndata) * 2. * np.pi
+        data['fieldDec'] = np.arcsin(np.random.rand(ndata) * 2. - 1.)
+        data['expMJD'] = np.sort(np.random.rand(ndata) * 3650. + 59580.)
+        stacker = stackers.ParallaxFactorStacker()
+        stacker.chunkSize = 64
+        data = stacker.run(data)
+        for i in np.arange(ndata):
+            ra = data['fieldRA'][i]
+            dec = data['fieldDec'][i]
+            mtoa_params = palpy.mappa(2000., data['expMJD'][i])
+            ra_geo1, dec_geo1 = palpy.mapqk(ra, dec, 0., 0., 1., 0., mtoa_params)
+            ra_geo, dec_geo = palpy.mapqk(ra, dec, 0., 0., 0., 0., mtoa_params)
+            x_geo1, y_geo1 = gnomonic_project_toxy(ra_geo1, dec_geo1, ra, dec)
+            x_geo, y_geo = gnomonic_project_toxy(ra_geo, dec_geo, ra, dec)
+            # Agreement should be better than a milliarcsecond.
+            self.assertLess(np.abs(np.degrees(x_geo1 - x_geo) * 3600. - data['ra_pi_amp'][i]), 1e-3)
+            self.assertLess(np.abs(np.degrees(y_geo1 - y_geo) * 3600. - data['dec_pi_amp'][i]), 1e-3)
+
     def _tDitherRange(self, diffsra, diffsdec, ra, dec, maxDither):
         self.assertTrue(np.all(np.abs(diffsra) <= np.radians(maxDither)))
         self.assertTrue(np.all(np.abs(diffsdec) <= np.radians(maxDither)))
@@ -278,6 +310,79 @@ class TestStackerClasses(unittest.TestCase):
         assert(q3.size > 0)
         assert(q4.size > 0)
 
+    def testKeyColsStacker(self):
+        """
+        Test that stackers with keyCols give the same results as running per visit.
+        """
+        np.random.seed(42)
+        nfields = 50
+        fieldRA = np.random.rand(nfields) * 2. * np.pi
+        fieldDec = np.random.rand(nfields) * np.pi - np.pi / 2.
+        fieldIdx = np.random.randint(0, nfields, 1000)
+        data = np.zeros(fieldIdx.size, dtype=zip(['fieldRA', 'fieldDec', 'expMJD'], [float] * 3))
+        data['fieldRA'] = fieldRA[fieldIdx]
+        data['fieldDec'] = fieldDec[fieldIdx]
+        data['expMJD'] = np.arange(data.size) * 0.5 + 49000.
+        s = stackers.GalacticStacker()
+        uniqueIdxs, inverse = s._uniqueKeys(data, s.keyCols)
+        self.assertEqual(uniqueIdxs.size, np.unique(fieldIdx).size)
+        np.testing.assert_array_equal(data['fieldRA'][uniqueIdxs][inverse], data['fieldRA'])
+        newData = s.run(data)
+        expectedL, expectedB = _galacticFromEquatorial(data['fieldRA'], data['fieldDec'])
+        np.testing.assert_array_equal(newData['gall'], expectedL)
+        np.testing.assert_array_equal(newData['galb'], expectedB)
+        # Ecliptic stacker, with and without the time-dependent part.
+        for subtractSunLon in (False, True):
+            s = stackers.EclipticStacker(subtractSunLon=subtractSunLon)
+            newData = s.run(data)
+            for i in np.arange(0, data.size, 97):
+                coord = ephem.Equatorial(data['fieldRA'][i], data['fieldDec'][i], epoch=2000)
+                ecl = ephem.Ecliptic(coord)
+                lon = ecl.lon
+                if subtractSunLon:
+                    sunEcl = ephem.Ecliptic(ephem.Sun(stackers.mjd2djd(data['expMJD'][i])))
+                    lon = stackers.wrapRA(ecl.lon - sunEcl.lon)
+                self.assertAlmostEqual(newData['eclipLat'][i], ecl.lat)
+                self.assertAlmostEqual(newData['eclipLon'][i], lon)
+
+    def testNEODistStacker(self):
+        """
+        Test the NEODistStacker lookup table against solving each visit directly.
+        """
+        np.random.seed(42)
+        names = ['solarElong', 'filter', 'fiveSigmaDepth', 'sunAz', 'azimuth']
+        types = [float, '|S1', float, float, float]
+        data = np.zeros(2000, dtype=zip(names, types))
+        data['solarElong'] = np.random.rand(data.size) * 150. + 30.
+        data['filter'] = np.random.choice(['u', 'g', 'r', 'i', 'z', 'y'], data.size)
+        data['fiveSigmaDepth'] = np.random.rand(data.size) * 4. + 21.
+        data['sunAz'] = np.random.rand(data.size) * 2. * np.pi
+        data['azimuth'] = np.random.rand(data.size) * 2. * np.pi
+        tempDir = tempfile.mkdtemp()
+        s = stackers.NEODistStacker(cacheDir=tempDir)
+        newData = s.run(data)
+        for i in range(data.size):
+            appmag = s._appMag(np.radians([data['solarElong'][i]]))[0]
+            v5 = data['fiveSigmaDepth'][i] + s.limitingAdjust[data['filter'][i]]
+            expected = np.min(s.deltas[np.where(appmag > v5)])
+            self.assertLessEqual(np.abs(newData['MaxGeoDist'][i] - expected), 0.0011)
+        # The lookup table should be reused from the cache directory.
+        self.assertTrue(os.path.isfile(s._tableFile()))
+        s2 = stackers.NEODistStacker(cacheDir=tempDir)
+        newData2 = s2.run(data)
+        np.testing.assert_array_equal(newData['MaxGeoDist'], newData2['MaxGeoDist'])
+        # A visit where the NEO is never too faint, in the same batch as a visit which is still being bisected.
+        mixed = data[:2].copy()
+        mixed['solarElong'] = [90., 78.77]
+        mixed['filter'] = 'u'
+        mixed['fiveSigmaDepth'] = [30., 25.35]
+        mixed = s.run(mixed)
+        self.assertEqual(mixed['MaxGeoDist'][0], s.deltas[-1])
+        appmag = s._appMag(np.radians([mixed['solarElong'][1]]))[0]
+        expected = np.min(s.deltas[np.where(appmag > mixed['fiveSigmaDepth'][1] + s.limitingAdjust['u'])])
+        self.assertLessEqual(np.abs(mixed['MaxGeoDist'][1] - expected), 0.0011)
+        shutil.rmtree(tempDir)
+
 
 if __name__ == '__main__':
 
@@ -1,6 +1,13 @@
 import matplotlib
 matplotlib.use("Agg")
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+import numpy as np
+import ephem
+from lsst.sims.utils import Site
 
 import lsst.sims.maf.utils as utils
 
@@ -37,6 +44,83 @@ class TestUtils(unittest.TestCase):
         sqlWhere = utils.createSQLWhere(tag, propTags)
         self.assertEqual(sqlWhere, badprop)
 
+    def testSiteEphemeris(self):
+        """
+        Test the nightly ephemeris table against pyephem.
+        """
+        tempDir = tempfile.mkdtemp()
+        site = Site(name='LSST')
+        siteEphem = utils.SiteEphemeris(site, cacheDir=tempDir)
+        mjds = np.array([59580.2, 59581.9, 59700.5])
+        nights = siteEphem.nearestNight(mjds)
+        # Calculate the same values directly.
+        doff = ephem.Date(0)-ephem.Date('1858/11/17')
+        obs = ephem.Observer()
+        obs.lat, obs.lon, obs.elevation = site.latitude_rad, site.longitude_rad, site.height
+        sun = ephem.Sun()
+        for mjd, night in zip(mjds, nights):
+            midnights = np.array([obs.previous_antitransit(sun, start=mjd-doff),
+                                  obs.next_antitransit(sun, start=mjd-doff)]) + doff
+            midnight = midnights[np.argmin(np.abs(midnights - mjd))]
+            self.assertAlmostEqual(night['midnight'], midnight, places=6)
+            obs.horizon = '-18'
+            self.assertAlmostEqual(night['twi18_rise'],
+                                   obs.next_rising(sun, start=midnight-doff, use_center=True) + doff, places=6)
+            obs.horizon = '0'
+        # Midnights are about a day apart.
+        table = siteEphem.nightlyTable(mjds.min(), mjds.max())
+        np.testing.assert_allclose(np.diff(table['midnight']), 1., atol=0.01)
+        # The tables should be saved, and reused.
+        self.assertTrue(len(os.listdir(tempDir)) > 0)
+        siteEphem2 = utils.SiteEphemeris(site, cacheDir=tempDir)
+        np.testing.assert_array_equal(siteEphem2.nearestNight(mjds), nights)
+        shutil.rmtree(tempDir)
+
+    def testConfigHash(self):
+        """Test the configuration hash identifies objects by their class and attributes."""
+        import lsst.sims.maf.metrics as metrics
+        metric = metrics.MeanMetric(col='airmass')
+        self.assertEqual(utils.metricHash(metric), utils.metricHash(metrics.MeanMetric(col='airmass')))
+        # The metric name does not change the calculation.
+        self.assertEqual(utils.metricHash(metric),
+                         utils.metricHash(metrics.MeanMetric(col='airmass', metricName='Airmass')))
+        self.assertNotEqual(utils.metricHash(metric), utils.metricHash(metrics.MeanMetric(col='seeing')))
+        self.assertNotEqual(utils.metricHash(metric), utils.metricHash(metrics.MedianMetric(col='airmass')))
+        self.assertNotEqual(utils.configHash(metric), utils.configHash(metrics.MeanMetric(col='airmass',
+                                                                                          metricName='A')))
+        # Dictionary order does not matter, array values do.
+        self.assertEqual(utils.configHash({'a': 1, 'b': np.arange(3)}), utils.configHash({'b': np.arange(3),
+                                                                                           'a': 1}))
+        self.assertNotEqual(utils.configHash(np.arange(3)), utils.configHash(np.arange(1, 4)))
+        # Objects without a __dict__ are identified by their __slots__, or else never match another object.
+        self.assertEqual(utils.configHash(SlotsConfig(1)), utils.configHash(SlotsConfig(1)))
+        self.assertNotEqual(utils.configHash(SlotsConfig(1)), utils.configHash(SlotsConfig(2)))
+        locks = [threading.Lock(), threading.Lock()]
+        self.assertNotEqual(utils.configHash(locks[0]), utils.configHash(locks[1]))
+        # Functions are identified by their code, default arguments and the values they close over,
+        # as well as their name (which is the same for all lambdas).
+        self.assertEqual(utils.configHash(lambda x: np.mean(x)), utils.configHash(lambda x: np.mean(x)))
+        self.assertNotEqual(utils.configHash(lambda x: np.mean(x)), utils.configHash(lambda x: np.median(x)))
+        self.assertNotEqual(utils.configHash(lambda x: x + 1), utils.configHash(lambda x: x + 2))
+        self.assertNotEqual(utils.configHash(lambda x, y=1: x + y), utils.configHash(lambda x, y=2: x + y))
+        self.assertEqual(utils.configHash(makeClosure(1)), utils.configHash(makeClosure(1)))
+        self.assertNotEqual(utils.configHash(makeClosure(1)), utils.configHash(makeClosure(2)))
+
+
+def makeClosure(value):
+    """Return a function which closes over value."""
+    def addValue(x):
+        return x + value
+    return addValue
+
+
+class SlotsConfig(object):
+    """A configuration object with __slots__ (and so without a __dict__)."""
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
 
 if __name__ == "__main__":
     unittest.main()
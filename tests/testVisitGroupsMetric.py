@@ -78,6 +78,12 @@ class TestVisitGroupsMetric(unittest.TestCase):
         metricval = testmetric.run(testdata)
         self.assertEqual(testmetric.reduceNLunations(metricval), 4)
         self.assertEqual(testmetric.reduceMaxSeqLunations(metricval), 3)
+        # The order of the visits should not matter.
+        np.random.seed(42)
+        shuffled = testdata[np.random.permutation(len(testdata))]
+        metricval2 = testmetric.run(shuffled)
+        np.testing.assert_equal(metricval2['visits'], metricval['visits'])
+        np.testing.assert_equal(metricval2['nights'], metricval['nights'])
 
                 
 if __name__ == '__main__':
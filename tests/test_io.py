@@ -6,6 +6,7 @@ import unittest
 import lsst.sims.maf.slicers as slicers
 import healpy as hp
 import os
+import glob
 
 
 class TestSlicers(unittest.TestCase):
@@ -66,6 +67,33 @@ class TestSlicers(unittest.TestCase):
         for att in attr2check:
             assert(getattr(slicer,att) == getattr(slicerBack,att))
 
+    def test_healpixSlicer_npy(self):
+        nside = 32
+        slicer = slicers.HealpixSlicer(nside=nside)
+        metricValues = np.random.rand(hp.nside2npix(nside))
+        metricValues = ma.MaskedArray(data=metricValues,
+                                      mask = np.where(metricValues < .1, True, False),
+                                      fill_value=slicer.badval)
+        for filename in ['healpix_test1.json', 'healpix_test2.json']:
+            slicer.writeData(filename, metricValues, metadata='testdata', plotDict={'units': 'mag'})
+            self.filenames += [filename, filename.replace('.json', '_values.npy'),
+                               filename.replace('.json', '_mask.npy')]
+        # The slicePoints are written once, for both files.
+        slicePointsFiles = glob.glob('slicePoints_*.npz')
+        self.filenames += slicePointsFiles
+        assert(len(slicePointsFiles) == 1)
+        metricValuesBack, slicerBack, header = self.baseslicer.readData('healpix_test2.json')
+        assert(isinstance(metricValuesBack.data, np.memmap))
+        np.testing.assert_almost_equal(metricValuesBack, metricValues)
+        np.testing.assert_equal(metricValuesBack.mask, metricValues.mask)
+        assert(metricValuesBack.fill_value == slicer.badval)
+        assert(slicer == slicerBack)
+        assert(header['metadata'] == 'testdata')
+        assert(header['plotDict']['units'] == 'mag')
+        attr2check = ['nside', 'nslice', 'columnsNeeded', 'lonCol', 'latCol']
+        for att in attr2check:
+            assert(getattr(slicer,att) == getattr(slicerBack,att))
+
     def test_oneDSlicer(self):
         slicer=slicers.OneDSlicer(sliceColName='testdata')
         dataValues = np.zeros(10000, dtype=[('testdata','float')])